@@ -10,6 +10,9 @@ print("Logged in to QI account ({} seconds)".format(str(time.time() - start_logi
 
 backend = qi.get_backend_type_by_name('QX single-node simulator')
 
+# qi can also be any Backend from src.backends.backends, such as LocalBackend() to simulate without logging in,
+# or route([LocalBackend(), QIBackend(qi, backend)], qasm) to only send large programs to Quantum Inspire
+
 shot_count = 500
 
 # whether to apply optimization to our generated QASM
@@ -19,8 +22,11 @@ apply_optimization_to_qasm = True
 # MODES:
 #   - normal: use toffoli gates and ancillary qubits for max speed
 #   - no toffoli: same as normal, but replace toffoli gates for 2-gate equivalent circuits. uses ancillary qubits.
+#   - log depth: same as normal, but the toffoli gates form a balanced tree of parallel layers
 #   - crot: no ancillary qubits or toffoli gates, but scales with 3^n gates for n bits
 #   - fancy cnot: no ancillary qubits or toffoli gates, scales 2^n
+#   - poly crot: no ancillary qubits, uses toffoli gates on borrowed qubits, scales n^2
+#   - borrowed: toffoli gates on idle qubits in any state (such as SAT ancillaries), scales n. no extra qubits.
 mode = "normal"
 
 
@@ -35,6 +41,11 @@ execute_search_qasm(search_targets, qi, qasm, shot_count, backend, qubit_count,
 
 
 # SAT example
+# SAT MODES:
+#   - reuse gates: every sub-expression is calculated once, on its own ancillary qubit. fewest gates.
+#   - reuse qubits: results are uncomputed as soon as they are used, so their qubits are reused. fewest qubits.
+#   - pebbling: keeps the results that save the most gates, using at most max_ancillas ancillary qubits.
+#   - cnf: for expressions in conjunctive normal form (such as k-SAT), one multi-controlled NOT per clause.
 boolean_expr = "(not(a) and not(b) and not(c))"
 
 qasm, _, qubit_count, data_qubits = generate_sat_qasm(boolean_expr, mode, sat_mode="reuse gates", apply_optimization=apply_optimization_to_qasm)
@@ -0,0 +1,290 @@
+import hashlib
+import json
+import os
+import tempfile
+from abc import ABC, abstractmethod
+import numpy as np
+from src.grover.parser import parse_qasm
+from src.simulator.statevector import execute_qasm_locally, single_qubit_matrices
+
+
+class Backend(ABC):
+    """
+    A place where cQASM programs can be executed.
+    Executing a program is split into submit (start the job) and result (wait for its histogram),
+    so callers can have several jobs in flight at once.
+    Subclasses must implement submit, result and capabilities.
+    """
+
+    name = "backend"
+
+    @abstractmethod
+    def submit(self, qasm, shot_count):
+        """
+        Start executing a cQASM program.
+
+        Args:
+            qasm: A valid cQASM program
+            shot_count: The number of shots to execute on the circuit
+
+        Returns: A job handle to pass to result
+        """
+
+    @abstractmethod
+    def result(self, job):
+        """
+        Wait for a job to finish.
+
+        Args:
+            job: A job handle returned by submit
+
+        Returns: A result dictionary with at least a histogram and execution_time_in_seconds (as qi.execute_qasm)
+        """
+
+    @abstractmethod
+    def capabilities(self):
+        """
+        Describe what this backend can run.
+
+        Returns: A dictionary with the following values:
+            - max_qubits: The largest number of qubits a program may use, or None if there is no limit
+            - native_gates: A list of the gate names this backend supports, or None if it accepts anything
+        """
+
+    def execute_qasm(self, qasm, shot_count):
+        """
+        Execute a cQASM program and wait for the result.
+
+        Args:
+            qasm: A valid cQASM program
+            shot_count: The number of shots to execute on the circuit
+
+        Returns: A result dictionary (see result)
+        """
+        return self.result(self.submit(qasm, shot_count))
+
+    def accepts(self, qubit_count, gate_names):
+        """
+        Check whether a program fits the capabilities of this backend.
+
+        Args:
+            qubit_count: The number of qubits of the program
+            gate_names: A set of the gate names used by the program
+
+        Returns: True if the program can be executed here
+        """
+        capabilities = self.capabilities()
+        max_qubits, native_gates = capabilities["max_qubits"], capabilities["native_gates"]
+        if max_qubits is not None and qubit_count > max_qubits:
+            return False
+        return native_gates is None or gate_names <= set(native_gates)
+
+
+class QIBackend(Backend):
+    """
+    Adapter for the Quantum Inspire API.
+    QuantumInspireAPI.execute_qasm blocks until the job is done, so submit only records the job
+    and the remote call happens in result.
+    """
+
+    def __init__(self, qi, backend_type):
+        """
+        Args:
+            qi: An instance of the Quantum Inspire API
+            backend_type: A QI API backend type, for example qi.get_backend_type_by_name('QX single-node simulator')
+        """
+        self.qi = qi
+        self.backend_type = backend_type
+        self.name = backend_type["name"]
+
+    def submit(self, qasm, shot_count):
+        return qasm, shot_count
+
+    def result(self, job):
+        qasm, shot_count = job
+        return self.qi.execute_qasm(qasm, backend_type=self.backend_type, number_of_shots=shot_count)
+
+    def capabilities(self):
+        return {
+            "max_qubits": self.backend_type.get("number_of_qubits"),
+            "native_gates": None
+        }
+
+
+class LocalBackend(Backend):
+    """
+    Adapter for the local statevector simulator (see src.simulator.statevector).
+    """
+
+    native_gates = list(single_qubit_matrices) + ["Rx", "Ry", "Rz", "CNOT", "Toffoli", "CZ", "CR", "SWAP",
+                                                  "measure", "measure_all", "measure_z", "display", "barrier"]
+
+    def __init__(self, max_qubits=24, sample=False, seed=None, dtype=np.complex128, directory=None):
+        """
+        Args:
+            max_qubits: The largest program to accept, the state vector takes 2^max_qubits amplitudes
+            sample: Whether to sample measurements instead of returning the exact probabilities
+            seed: The seed for the random number generator used in sampling
+            dtype: The NumPy data type of the amplitudes, complex64 halves the memory that is needed
+            directory: A directory to keep state vectors in as memory-mapped files (for programs that do not fit
+                       in memory), or None to keep them in memory
+        """
+        self.max_qubits = max_qubits
+        self.sample = sample
+        self.seed = seed
+        self.dtype = dtype
+        self.directory = directory
+
+        # the name is part of the cache key, so simulators that give different results need different names
+        if sample:
+            self.name = "local simulator (sampled, seed {}, {})".format(seed, np.dtype(dtype).name)
+        else:
+            self.name = "local simulator (exact, {})".format(np.dtype(dtype).name)
+
+    def submit(self, qasm, shot_count):
+        return qasm, shot_count
+
+    def result(self, job):
+        qasm, shot_count = job
+        if self.directory is None:
+            return execute_qasm_locally(qasm, shot_count, self.sample, self.seed, self.dtype)
+
+        handle, path = tempfile.mkstemp(suffix=".state", dir=self.directory)
+        os.close(handle)
+        try:
+            return execute_qasm_locally(qasm, shot_count, self.sample, self.seed, self.dtype, path)
+        finally:
+            os.remove(path)
+
+    def capabilities(self):
+        return {
+            "max_qubits": self.max_qubits,
+            "native_gates": self.native_gates
+        }
+
+
+class ReplayBackend(Backend):
+    """
+    Stand-in that returns results recorded on disk, one JSON file per program and shot count.
+    If another backend is given, missing results are executed there and recorded, otherwise they raise a KeyError.
+    """
+
+    def __init__(self, directory, backend=None):
+        """
+        Args:
+            directory: The directory that holds the recorded results
+            backend: The backend used to record missing results, or None to only replay
+        """
+        self.directory = directory
+        self.backend = backend
+        self.name = "replay" if backend is None else "replay of {}".format(backend.name)
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, qasm, shot_count):
+        """
+        Find the file in which the result of a program is recorded.
+
+        Args:
+            qasm: A valid cQASM program
+            shot_count: The number of shots
+
+        Returns: The path of the JSON file
+        """
+        key = hashlib.sha256("{}\n{}".format(shot_count, qasm).encode()).hexdigest()
+        return os.path.join(self.directory, key + ".json")
+
+    def submit(self, qasm, shot_count):
+        path = self.path(qasm, shot_count)
+        if os.path.exists(path) or self.backend is None:
+            return path, None
+        return path, self.backend.submit(qasm, shot_count)
+
+    def result(self, job):
+        path, recording = job
+        if recording is None:
+            if not os.path.exists(path):
+                raise KeyError("No recorded result for this program: {}".format(path))
+            with open(path) as file:
+                return json.load(file)
+
+        result = self.backend.result(recording)
+        with open(path, "w") as file:
+            json.dump(result, file)
+        return result
+
+    def capabilities(self):
+        if self.backend is None:
+            return {"max_qubits": None, "native_gates": None}
+        return self.backend.capabilities()
+
+
+def route(backends, qasm):
+    """
+    Pick the first backend that can run a program, for example [LocalBackend(), QIBackend(...)]
+    runs small programs locally and only sends the large ones to Quantum Inspire.
+
+    Args:
+        backends: A list of backends in order of preference
+        qasm: A valid cQASM program
+
+    Returns: The chosen backend
+    """
+    circuit = parse_qasm(qasm)
+    gate_names = {g.name for sub in circuit.subcircuits for moment in sub.moments for g in moment}
+
+    for backend in backends:
+        if backend.accepts(circuit.qubit_count, gate_names):
+            return backend
+    raise ValueError("None of the backends can run a program with {} qubits".format(circuit.qubit_count))
+
+
+def backend_name(qi, backend=None):
+    """
+    Find the name of the backend a program is executed on, for example as part of a cache key.
+
+    Args:
+        qi: A Backend, or an instance of the Quantum Inspire API
+        backend: The QI API backend type, only used when qi is not a Backend
+
+    Returns: The name of the backend, or None if it is not known (so results should not be cached)
+    """
+    if isinstance(qi, Backend):
+        return qi.name
+    if isinstance(backend, dict) and "name" in backend:
+        return backend["name"]
+    # the API picks some default backend, which may not be the same every time
+    return None
+
+
+def execute_on(qi, qasm, shot_count, backend=None, cache=None):
+    """
+    Execute a program on either a Backend or a Quantum Inspire API instance (with a backend type),
+    so the execute_* functions accept both.
+
+    Args:
+        qi: A Backend, or an instance of the Quantum Inspire API
+        qasm: A valid cQASM program
+        shot_count: The number of shots to execute on the circuit
+        backend: The QI API backend type, only used when qi is not a Backend
+        cache: A ResultCache to look in before executing (see src.backends.cache), or None to always execute.
+               Programs are always executed when the name of the backend is not known (see backend_name)
+
+    Returns: A result dictionary with at least a histogram and execution_time_in_seconds
+    """
+    name = backend_name(qi, backend)
+    if name is None:
+        cache = None
+
+    if cache is not None:
+        result = cache.get(qasm, shot_count, name)
+        if result is not None:
+            return result
+
+    if isinstance(qi, Backend):
+        result = qi.execute_qasm(qasm, shot_count)
+    else:
+        result = qi.execute_qasm(qasm, backend_type=backend, number_of_shots=shot_count)
+
+    if cache is not None:
+        cache.put(qasm, shot_count, name, result)
+    return result
@@ -0,0 +1,88 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import heapq
+import time
+
+# The outcome of a single job in a batch.
+# index is the position of the job in the list that was given, result is the result dictionary
+# (or None if the job failed), error is the exception of the last attempt (or None if it succeeded)
+# and attempts is the number of times the job was executed.
+BatchResult = namedtuple("BatchResult", ["index", "result", "error", "attempts"])
+
+
+def execute_batch(jobs, max_workers=4, retries=2, retry_delay=1.0):
+    """
+    Execute many jobs at the same time, with at most max_workers jobs in flight.
+    Most of the time of a remote job is spent waiting in the queue, so running them side by side
+    hides that latency. Failed jobs are retried with an exponentially growing delay.
+    Jobs are only handed to a worker when one is free (and a retry only when its delay has passed), so when the caller
+    stops iterating, the jobs that have not started yet are never executed.
+
+    Args:
+        jobs: A list of (qasm, shot_count, backend) tuples, where backend is a Backend (see src.backends.backends)
+        max_workers: The largest number of jobs that run at the same time
+        retries: How many times a failing job is tried again before giving up
+        retry_delay: The number of seconds to wait before the first retry, doubled for every next one
+
+    Returns: A generator of BatchResult records, in the order in which the jobs finish
+    """
+    jobs = list(jobs)
+    if max_workers < 1:
+        raise ValueError("Invalid number of workers: {}, should be at least 1".format(max_workers))
+
+    # a heap of (time from which the job may start, index of the job, number of attempts so far)
+    waiting = [(0, index, 0) for index in range(len(jobs))]
+    # maps every running future to the index of its job and the number of attempts so far (including this one)
+    running = {}
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while len(waiting) > 0 or len(running) > 0:
+            # start the jobs that are ready, as long as there are free workers
+            now = time.monotonic()
+            while len(waiting) > 0 and waiting[0][0] <= now and len(running) < max_workers:
+                _, index, attempts = heapq.heappop(waiting)
+                qasm, shot_count, backend = jobs[index]
+                running[pool.submit(backend.execute_qasm, qasm, shot_count)] = (index, attempts + 1)
+
+            # wait for a job to finish, or until the next retry may start
+            timeout = None
+            if len(waiting) > 0 and len(running) < max_workers:
+                timeout = max(waiting[0][0] - time.monotonic(), 0)
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                index, attempts = running.pop(future)
+                error = future.exception()
+
+                if error is None:
+                    yield BatchResult(index, future.result(), None, attempts)
+                elif attempts <= retries:
+                    delay = retry_delay * 2 ** (attempts - 1)
+                    heapq.heappush(waiting, (time.monotonic() + delay, index, attempts))
+                else:
+                    yield BatchResult(index, None, error, attempts)
+    finally:
+        # also runs when the caller stops early (or raises), so do not wait for jobs whose results nobody reads
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def execute_batch_in_order(jobs, max_workers=4, retries=2, retry_delay=1.0):
+    """
+    Execute many jobs at the same time (see execute_batch), and collect the results in the order of the jobs.
+
+    Args:
+        jobs: A list of (qasm, shot_count, backend) tuples, where backend is a Backend (see src.backends.backends)
+        max_workers: The largest number of jobs that run at the same time
+        retries: How many times a failing job is tried again before giving up
+        retry_delay: The number of seconds to wait before the first retry, doubled for every next one
+
+    Returns: A list of result dictionaries, in the same order as the jobs
+    """
+    jobs = list(jobs)
+    results = [None] * len(jobs)
+    for batch_result in execute_batch(jobs, max_workers, retries, retry_delay):
+        if batch_result.error is not None:
+            raise batch_result.error
+        results[batch_result.index] = batch_result.result
+    return results
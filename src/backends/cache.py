@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+# where results are cached when no other directory is given
+default_cache_directory = os.path.join(os.path.expanduser("~"), ".cache", "grover-cqasm")
+
+# the default size bound of the cache in bytes
+default_cache_size = 64 * 1024 * 1024
+
+whitespace_pattern = re.compile(r"\s+")
+
+
+def normalise_qasm(qasm):
+    """
+    Normalise a cQASM program so that programs that only differ in comments or whitespace are the same.
+
+    Args:
+        qasm: A valid cQASM program
+
+    Returns: The program without comments, empty lines and redundant whitespace
+    """
+    lines = []
+    for line in qasm.split("\n"):
+        line = whitespace_pattern.sub(" ", line.split("#", 1)[0]).strip()
+        if line != "":
+            lines.append(line)
+    return "\n".join(lines)
+
+
+class ResultCache:
+    """
+    On-disk cache of execution results, one JSON file per program.
+    Files are named after a hash of the normalised cQASM, the shot count and the backend name.
+    When the cache grows beyond its size bound the least recently used results are removed,
+    using the modification time of each file as the time it was last used.
+    """
+
+    def __init__(self, directory=default_cache_directory, max_size=default_cache_size, enabled=True):
+        """
+        Args:
+            directory: The directory that holds the cached results
+            max_size: The largest total size of the cached results in bytes
+            enabled: Whether to use the cache at all, when False every lookup is a miss and nothing is stored
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        # the counters are updated from the worker threads of execute_batch
+        self.lock = threading.Lock()
+
+    def key(self, qasm, shot_count, name):
+        """
+        Calculate the cache key of a program.
+
+        Args:
+            qasm: A valid cQASM program
+            shot_count: The number of shots
+            name: The name of the backend
+
+        Returns: A hexadecimal hash
+        """
+        content = "{}\n{}\n{}".format(name, shot_count, normalise_qasm(qasm))
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def path(self, key):
+        """
+        Find the file in which the result with the given key is stored.
+
+        Args:
+            key: A cache key (see key)
+
+        Returns: The path of the JSON file
+        """
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, qasm, shot_count, name):
+        """
+        Look up the result of a program.
+
+        Args:
+            qasm: A valid cQASM program
+            shot_count: The number of shots
+            name: The name of the backend
+
+        Returns: The cached result dictionary, or None if it is not in the cache
+        """
+        if not self.enabled:
+            self.count(hit=False)
+            return None
+
+        path = self.path(self.key(qasm, shot_count, name))
+        try:
+            with open(path) as file:
+                result = json.load(file)
+            # mark the result as recently used
+            os.utime(path)
+        except (OSError, ValueError):
+            self.count(hit=False)
+            return None
+
+        self.count(hit=True)
+        return result
+
+    def count(self, hit):
+        """
+        Update the hit or miss counter.
+
+        Args:
+            hit: Whether the lookup was a hit
+        """
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, qasm, shot_count, name, result):
+        """
+        Store the result of a program, and remove the least recently used results if the cache is too large.
+
+        Args:
+            qasm: A valid cQASM program
+            shot_count: The number of shots
+            name: The name of the backend
+            result: The result dictionary
+        """
+        if not self.enabled:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(self.key(qasm, shot_count, name))
+
+        # write to a temporary file first, so concurrent readers never see half a result
+        temporary_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(temporary_path, "w") as file:
+            json.dump(result, file)
+        os.replace(temporary_path, path)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used results until the cache fits in its size bound.
+        """
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith(".json"):
+                stat = os.stat(os.path.join(self.directory, file_name))
+                entries.append((stat.st_mtime, stat.st_size, file_name))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except OSError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        """
+        Remove all cached results and reset the counters.
+        """
+        if os.path.isdir(self.directory):
+            for file_name in os.listdir(self.directory):
+                if file_name.endswith(".json"):
+                    os.remove(os.path.join(self.directory, file_name))
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+
+
+# the cache used by the execute_* functions unless they are given another one
+result_cache = ResultCache()
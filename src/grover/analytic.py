@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def grover_iterations(data_qubits, target_count):
+    """
+    Calculate the number of Grover iterations used for a search, as in generate_search_qasm.
+
+    Args:
+        data_qubits: The number of qubits used by Grover's Algorithm (aka non-ancillary), or a NumPy array of them
+        target_count: The number of search targets, or a NumPy array of them
+
+    Returns: The number of iterations (a NumPy array if any of the arguments is one)
+    """
+    return np.floor(np.pi * np.sqrt(2.0 ** np.asarray(data_qubits) / target_count) / 4).astype(int)
+
+
+def success_probability(data_qubits, target_count, iterations=None):
+    """
+    Calculate the ideal outcome of a search without building or running a circuit.
+    Grover's Algorithm only ever moves the state within the plane spanned by the uniform superposition of the
+    targets and that of the other outcomes, and every iteration rotates it by 2 * theta in that plane,
+    where sin(theta)^2 = M / N. After k iterations the total target probability is sin((2k + 1) * theta)^2.
+    All arguments may be NumPy arrays, so entire parameter sweeps are calculated at once.
+
+    Args:
+        data_qubits: The number of qubits used by Grover's Algorithm (aka non-ancillary), so N = 2^data_qubits
+        target_count: The number of distinct search targets M
+        iterations: The number of Grover iterations, or None to use the number generate_search_qasm picks
+
+    Returns: A tuple of the following values:
+        - target_prob: The probability of each single target (so the total is target_count * target_prob)
+        - non_target_prob: The total probability not to find one of the targets
+    """
+    data_qubits = np.asarray(data_qubits)
+    target_count = np.asarray(target_count)
+    size = 2.0 ** data_qubits
+    if np.any(target_count < 1) or np.any(target_count > size):
+        raise ValueError("Invalid number of targets: should be between 1 and 2^data_qubits")
+
+    if iterations is None:
+        iterations = grover_iterations(data_qubits, target_count)
+
+    theta = np.arcsin(np.sqrt(target_count / size))
+    total_target_prob = np.sin((2 * np.asarray(iterations) + 1) * theta) ** 2
+
+    return total_target_prob / target_count, 1 - total_target_prob
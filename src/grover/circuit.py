@@ -0,0 +1,178 @@
+from collections import namedtuple
+
+# A single gate application.
+# The name is the cQASM opcode (such as "H", "CNOT" or "CR"), qubits is a tuple of qubit indices
+# and angle is only used by rotation gates such as CR.
+Gate = namedtuple("Gate", ["name", "qubits", "angle"], defaults=[None])
+
+# A named block of moments, such as the ".grover_loop(n)" block that is repeated n times.
+# The implicit block at the start of a program (before any header) has name None and 1 iteration.
+# Every moment is a tuple of gates that act on disjoint qubits and are executed in parallel.
+Subcircuit = namedtuple("Subcircuit", ["name", "iterations", "moments"])
+
+# A complete program: the number of qubits and the list of subcircuits in order.
+Circuit = namedtuple("Circuit", ["qubit_count", "subcircuits"])
+
+def is_single_qubit(gate):
+    """
+    Check whether a gate is a plain single-qubit gate that can be grouped with others (so no rotation angle).
+
+    Args:
+        gate: The Gate record to check
+
+    Returns: True if this gate only acts on a single qubit
+    """
+    return len(gate.qubits) == 1 and gate.angle is None
+
+
+def format_indices(indices, compact=True):
+    """
+    Format a list of qubit indices as the inside of a cQASM qubit list.
+    For example, [0, 1, 2] becomes "0:2" when compact, and "0,1,2" otherwise.
+
+    Args:
+        indices: A list of qubit indices
+        compact: Whether to use the q[a:b] notation for contiguous ranges
+
+    Returns: A string to put between the brackets of q[...]
+    """
+    if compact and max(indices) - min(indices) + 1 == len(set(indices)) == len(indices) > 1:
+        return "{}:{}".format(min(indices), max(indices))
+    return ",".join(map(str, indices))
+
+
+def render_gate(gate):
+    """
+    Render a single (multi-qubit) gate application as cQASM.
+
+    Args:
+        gate: The Gate record to render
+
+    Returns: A cQASM instruction without a newline, for example "CR q[0],q[1],0.5"
+    """
+    rendered = "{} {}".format(gate.name, ",".join("q[{}]".format(q) for q in gate.qubits))
+    if gate.angle is not None:
+        rendered += ",{}".format(gate.angle)
+    return rendered
+
+
+def render_moment(moment, compact=True):
+    """
+    Render a moment as a single line of cQASM.
+    Single-qubit gates with the same name are grouped, so (X q[0], X q[1], H q[2]) becomes "{ X q[0:1] | H q[2] }".
+
+    Args:
+        moment: A tuple of gates that are executed in parallel
+        compact: Whether to use the q[a:b] notation for contiguous ranges
+
+    Returns: A line of cQASM without a newline
+    """
+    # group the single-qubit gates by name, but keep the order in which they first appear
+    groups = {}
+    elements = []
+    for g in moment:
+        if is_single_qubit(g):
+            if g.name not in groups:
+                groups[g.name] = []
+                elements.append(g.name)
+            groups[g.name].append(g.qubits[0])
+        else:
+            elements.append(g)
+
+    rendered = []
+    for e in elements:
+        if isinstance(e, str):
+            rendered.append("{} q[{}]".format(e, format_indices(groups[e], compact)))
+        else:
+            rendered.append(render_gate(e))
+
+    if len(rendered) > 1:
+        return "{ " + " | ".join(rendered) + " }"
+    return rendered[0]
+
+
+def iter_qasm(circuit, compact=True):
+    """
+    Render a circuit as cQASM one line at a time.
+    The moments of each subcircuit may be any iterable, such as a generator, so very large circuits never
+    have to be in memory at once.
+
+    Args:
+        circuit: The Circuit to render
+        compact: Whether to use the q[a:b] notation for contiguous ranges
+
+    Returns: A generator of lines of cQASM, each ending in a newline
+    """
+    yield "version 1.0\n"
+    yield "qubits {}\n".format(circuit.qubit_count)
+    for sub in circuit.subcircuits:
+        if sub.name is not None:
+            yield ".{}({})\n".format(sub.name, sub.iterations)
+        for moment in sub.moments:
+            if len(moment) > 0:
+                yield render_moment(moment, compact) + "\n"
+
+
+def render_qasm(circuit, compact=True):
+    """
+    Render a complete circuit as a cQASM program.
+    This is the only place where cQASM text is generated, all other code works on the Circuit records.
+
+    Args:
+        circuit: The Circuit to render
+        compact: Whether to use the q[a:b] notation for contiguous ranges
+
+    Returns: A valid cQASM program
+    """
+    return "".join(iter_qasm(circuit, compact))
+
+
+def write_qasm(circuit, file, compact=True):
+    """
+    Write a circuit as cQASM straight to a file-like object, without building the program as a string.
+
+    Args:
+        circuit: The Circuit to write, the moments may be generators (see iter_qasm)
+        file: A file-like object with a write method
+        compact: Whether to use the q[a:b] notation for contiguous ranges
+
+    Returns: The depth of the circuit that was written (see src.optimizations.scheduler.circuit_depth)
+    """
+    file.write("version 1.0\n")
+    file.write("qubits {}\n".format(circuit.qubit_count))
+
+    depth = 0
+    for sub in circuit.subcircuits:
+        if sub.name is not None:
+            file.write(".{}({})\n".format(sub.name, sub.iterations))
+        moment_count = 0
+        for moment in sub.moments:
+            if len(moment) > 0:
+                file.write(render_moment(moment, compact) + "\n")
+                moment_count += 1
+        depth += sub.iterations * moment_count
+
+    return depth
+
+
+def relabel(moments, mapping):
+    """
+    Move a list of moments to other qubits, for example to reuse a cached template at another offset.
+
+    Args:
+        moments: A list (or tuple) of moments
+        mapping: A dictionary or sequence that gives the new index for every old qubit index
+
+    Returns: A list of moments acting on the new qubits
+    """
+    # templates tend to repeat the same gates many times, so every gate is only relabelled once
+    relabelled = {}
+    new_moments = []
+    for moment in moments:
+        new_moment = []
+        for g in moment:
+            if g not in relabelled:
+                relabelled[g] = Gate(g.name, tuple(mapping[q] for q in g.qubits), g.angle)
+            new_moment.append(relabelled[g])
+        new_moments.append(tuple(new_moment))
+    return new_moments
@@ -0,0 +1,194 @@
+from boolean.boolean import AND, OR, NOT, Symbol
+
+
+class ExpressionDAG:
+    """
+    Hash-consed, canonical form of boolean expressions.
+    Every distinct sub-expression is stored once, as a node with an integer id, so equal sub-expressions
+    are found with a single dictionary lookup on a small tuple instead of comparing whole subtrees.
+    AND and OR are flattened and their operands are sorted and deduplicated before they are split into
+    binary nodes, so commuted or regrouped sub-terms (such as "b and a" and "a and b") become the same node.
+    When a combination contains the operands of a node that already exists, that node is used as a whole,
+    so sub-terms that were built before stay shared however they are written. Pairs of literals that occur
+    together in several combinations (such as "e or not(f)" in two clauses) are paired up first, so that every
+    one of those combinations builds the same node for them.
+    """
+
+    def __init__(self):
+        # every node is a tuple ("symbol", symbol), ("not", child) or ("and"/"or", left, right)
+        self.nodes = []
+        self.ids = {}
+        # maps the set of flattened operands of every "and" and "or" node to its id
+        self.groups = {"and": {}, "or": {}}
+        # counts in how many combinations of each operation every pair of literals occurs (see count_pairs)
+        self.pair_counts = {"and": {}, "or": {}}
+
+    def intern(self, node):
+        """
+        Find the id of a node, adding it to the DAG if it is new.
+
+        Args:
+            node: The node tuple
+
+        Returns: The id of the node
+        """
+        node_id = self.ids.get(node)
+        if node_id is None:
+            node_id = len(self.nodes)
+            self.nodes.append(node)
+            self.ids[node] = node_id
+            if node[0] in self.groups:
+                group = frozenset(self.operands(node[0], node_id))
+                self.groups[node[0]].setdefault(group, node_id)
+        return node_id
+
+    def symbol(self, symbol):
+        """
+        Args:
+            symbol: A boolean.Symbol
+
+        Returns: The id of the variable
+        """
+        return self.intern(("symbol", symbol))
+
+    def negate(self, child):
+        """
+        Args:
+            child: The id of the node to negate
+
+        Returns: The id of the negation, where not(not(x)) is x itself
+        """
+        if self.nodes[child][0] == "not":
+            return self.nodes[child][1]
+        return self.intern(("not", child))
+
+    def combine(self, operation, children):
+        """
+        Combine any number of nodes with AND or OR, as a balanced tree of binary nodes.
+
+        Args:
+            operation: "and" or "or"
+            children: A list of node ids
+
+        Returns: The id of the combined node
+        """
+        # flatten nested nodes of the same operation, so that the grouping does not matter
+        operands = set()
+        for child in children:
+            operands.update(self.operands(operation, child))
+
+        if frozenset(operands) in self.groups[operation]:
+            return self.groups[operation][frozenset(operands)]
+
+        # take the largest existing nodes that fit first, as every one of them saves all of its binary nodes
+        parts = []
+        groups = sorted(self.groups[operation].items(), key=lambda item: (-len(item[0]), item[1]))
+        for group, node in groups:
+            if len(group) < len(operands) and group <= operands:
+                parts.append(node)
+                operands = operands - group
+
+        # then pair up the literals that also occur together in other combinations, most frequent first,
+        # so that all of those combinations build the same node for them
+        pair_counts = self.pair_counts[operation]
+        while True:
+            pairs = [(pair_counts.get((x, y), 0), x, y) for x in operands for y in operands if x < y]
+            pairs = [pair for pair in pairs if pair[0] > 1]
+            if not pairs:
+                break
+            _, x, y = max(pairs, key=lambda pair: (pair[0], -pair[1], -pair[2]))
+            parts.append(self.intern((operation, x, y)))
+            operands = operands - {x, y}
+
+        return self.split(operation, sorted(parts + list(operands)))
+
+    def operands(self, operation, node):
+        """
+        Find the operands of a chain of binary nodes of the same operation.
+
+        Args:
+            operation: "and" or "or"
+            node: The id of the top node
+
+        Returns: A list of node ids
+        """
+        if self.nodes[node][0] != operation:
+            return [node]
+        return self.operands(operation, self.nodes[node][1]) + self.operands(operation, self.nodes[node][2])
+
+    def split(self, operation, operands):
+        """
+        Build binary nodes from a sorted list of operands.
+        The left half takes the extra operand, so clauses with a common prefix share their first node.
+
+        Args:
+            operation: "and" or "or"
+            operands: A sorted list of distinct node ids, which may be nodes of the same operation themselves
+
+        Returns: The id of the top node
+        """
+        if len(operands) == 1:
+            return operands[0]
+        halfway = len(operands) - len(operands) // 2
+        left = self.split(operation, operands[:halfway])
+        right = self.split(operation, operands[halfway:])
+        return self.intern((operation, left, right))
+
+    def add(self, expr):
+        """
+        Add a boolean expression to the DAG.
+
+        Args:
+            expr: The boolean expression (instance of boolean.Expression, not a string)
+
+        Returns: The id of the root node of the expression
+        """
+        self.count_pairs(expr)
+        return self.build(expr)
+
+    def build(self, expr):
+        """
+        Add the nodes of a boolean expression to the DAG (see add).
+
+        Args:
+            expr: The boolean expression (instance of boolean.Expression, not a string)
+
+        Returns: The id of the root node of the expression
+        """
+        if type(expr) == Symbol:
+            return self.symbol(expr)
+        elif type(expr) == NOT:
+            return self.negate(self.build(expr.args[0]))
+        elif type(expr) == AND:
+            return self.combine("and", [self.build(arg) for arg in expr.args])
+        elif type(expr) == OR:
+            return self.combine("or", [self.build(arg) for arg in expr.args])
+        raise ValueError("Unknown boolean expr type: {}".format(type(expr)))
+
+    def count_pairs(self, expr):
+        """
+        Count how often every pair of literals (variables and negated variables) occurs in the same AND or OR,
+        before any node is built, so that combine knows which pairs are worth sharing.
+
+        Args:
+            expr: The boolean expression (instance of boolean.Expression, not a string)
+        """
+        if type(expr) not in (AND, OR):
+            for arg in expr.args:
+                self.count_pairs(arg)
+            return
+
+        operation = "and" if type(expr) == AND else "or"
+        literals = set()
+        for arg in expr.args:
+            if type(arg) == Symbol:
+                literals.add(self.symbol(arg))
+            elif type(arg) == NOT and type(arg.args[0]) == Symbol:
+                literals.add(self.negate(self.symbol(arg.args[0])))
+            else:
+                self.count_pairs(arg)
+
+        literals = sorted(literals)
+        for i, x in enumerate(literals):
+            for y in literals[i + 1:]:
+                self.pair_counts[operation][(x, y)] = self.pair_counts[operation].get((x, y), 0) + 1
@@ -0,0 +1,158 @@
+from collections import namedtuple
+import numpy as np
+
+
+def bit_string(index, qubit_count):
+    """
+    Format a measurement outcome as a bit string, with q[0] as the last bit.
+
+    Args:
+        index: The outcome as an integer
+        qubit_count: The number of bits to pad to
+
+    Returns: A string of 0's and 1's
+    """
+    return format(int(index), "0{}b".format(qubit_count))
+
+
+class Histogram:
+    """
+    Sparse view of a measurement histogram.
+    Only the outcomes that the API returned (the non-zero ones) are stored, as a sorted NumPy array of indices
+    with a matching array of probabilities, so nothing ever scales with 2^qubit_count unless dense is called.
+    Iterating over a Histogram gives (bit string, probability) pairs of the non-zero outcomes in ascending order.
+    """
+
+    def __init__(self, indices, probabilities, qubit_count, data_qubits):
+        """
+        Args:
+            indices: A NumPy array of measurement outcomes as integers, in ascending order
+            probabilities: A NumPy array with the probability of each outcome
+            qubit_count: The total number of qubits used in the qasm program
+            data_qubits: The number of qubits used by Grover's Algorithm (aka non-ancillary)
+        """
+        self.indices = indices
+        self.probabilities = probabilities
+        self.qubit_count = qubit_count
+        self.data_qubits = data_qubits
+
+    @classmethod
+    def from_result(cls, result_dict, qubit_count, data_qubits):
+        """
+        Build a histogram from the dictionary given by qi.execute_qasm, which maps outcomes such as "3" to probabilities.
+
+        Args:
+            result_dict: The dictionary given by qi.execute_qasm
+            qubit_count: The total number of qubits used in the qasm program
+            data_qubits: The number of qubits used by Grover's Algorithm (aka non-ancillary)
+
+        Returns: A Histogram
+        """
+        bars = result_dict["histogram"]
+        indices = np.fromiter((int(k) for k in bars), dtype=np.int64, count=len(bars))
+        probabilities = np.fromiter(bars.values(), dtype=np.float64, count=len(bars))
+
+        order = np.argsort(indices, kind="stable")
+        return cls(indices[order], probabilities[order], qubit_count, data_qubits)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        for index, probability in zip(self.indices, self.probabilities):
+            yield bit_string(index, self.qubit_count), float(probability)
+
+    def data_indices(self):
+        """
+        Project out the ancillary qubits, keeping only the bits of the data qubits.
+
+        Returns: A NumPy array with the data part of every outcome
+        """
+        return self.indices & ((1 << self.data_qubits) - 1)
+
+    def leaked(self):
+        """
+        Find the outcomes in which some ancillary qubit was measured as 1 (which should not happen).
+
+        Returns: A boolean NumPy array, True for outcomes with a non-zero ancillary qubit
+        """
+        return (self.indices >> self.data_qubits) != 0
+
+    def data_probabilities(self):
+        """
+        The outcomes in which all ancillary qubits are 0, as indices of the data qubits only.
+
+        Returns: A tuple of NumPy arrays: the data indices and their probabilities
+        """
+        clean = ~self.leaked()
+        return self.data_indices()[clean], self.probabilities[clean]
+
+    def dense(self, data_only=False):
+        """
+        Build the full list of bars, including all the zero-valued ones.
+        This takes 2^qubit_count entries, so it should only be used for small programs.
+
+        Args:
+            data_only: Whether to only list the outcomes in which all ancillary qubits are 0,
+                       named by the data qubits alone (2^data_qubits entries)
+
+        Returns: A list of pairs, specifying a name and probability, in ascending order
+        """
+        if data_only:
+            size, width = 2 ** self.data_qubits, self.data_qubits
+            indices, probabilities = self.data_probabilities()
+        else:
+            size, width = 2 ** self.qubit_count, self.qubit_count
+            indices, probabilities = self.indices, self.probabilities
+
+        bars = np.zeros(size)
+        bars[indices] = probabilities
+        return [(bit_string(i, width), float(bar)) for i, bar in enumerate(bars)]
+
+
+# The score of a search: target_probs is a NumPy array with the probability of each target (in the given order),
+# non_target_prob is the total probability of all other outcomes and ancilla_leakage is the part of that
+# in which some ancillary qubit was measured as 1.
+SearchScore = namedtuple("SearchScore", ["target_probs", "non_target_prob", "ancilla_leakage"])
+
+
+class SearchScorer:
+    """
+    Scores histograms against a fixed list of search targets.
+    The index of every target is calculated once, after which each histogram is scored with a single
+    vectorized lookup of all targets in its sorted index array, instead of comparing bit strings.
+    """
+
+    def __init__(self, search_targets):
+        """
+        Args:
+            search_targets: A list of bit strings to search for (with q[0] as the first bit, as in generate_search_qasm)
+        """
+        self.search_targets = search_targets
+        # the ancillary qubits of a target outcome are all 0, so its index only depends on the data bits
+        self.target_indices = np.array([int(t[::-1], 2) for t in search_targets], dtype=np.int64)
+
+    def score(self, histogram):
+        """
+        Find the probability of every target in a histogram.
+
+        Args:
+            histogram: A Histogram (see Histogram.from_result)
+
+        Returns: A SearchScore
+        """
+        indices, probabilities = histogram.indices, histogram.probabilities
+
+        if len(indices) == 0:
+            return SearchScore(np.zeros(len(self.target_indices)), 0.0, 0.0)
+
+        positions = np.minimum(np.searchsorted(indices, self.target_indices), len(indices) - 1)
+        found = indices[positions] == self.target_indices
+        target_probs = np.where(found, probabilities[positions], 0.0)
+
+        # a target that is listed twice should only be counted once
+        unique_positions = np.unique(positions[found])
+        non_target_prob = probabilities.sum() - probabilities[unique_positions].sum()
+        ancilla_leakage = probabilities[histogram.leaked()].sum()
+
+        return SearchScore(target_probs, float(non_target_prob), float(ancilla_leakage))
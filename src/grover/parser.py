@@ -0,0 +1,106 @@
+import re
+from src.grover.circuit import Gate, Subcircuit, Circuit
+
+# an operand is either a qubit list such as q[0,2:4] (which may contain commas) or a plain value such as an angle
+operand_pattern = re.compile(r"q\[[^\]]*\]|[^,\s]+")
+header_pattern = re.compile(r"\.(\w+)(?:\((\d+)\))?$")
+
+
+def parse_indices(index_string):
+    """
+    Parse the inside of a cQASM qubit list, supporting both comma lists and ranges.
+    For example, "0,2:4" becomes [0, 2, 3, 4].
+
+    Args:
+        index_string: The text between the brackets of q[...]
+
+    Returns: A list of qubit indices
+    """
+    indices = []
+    for part in index_string.split(","):
+        if ":" in part:
+            start, end = part.split(":")
+            indices += range(int(start), int(end) + 1)
+        else:
+            indices.append(int(part))
+    return indices
+
+
+def parse_instruction(instruction):
+    """
+    Parse a single cQASM instruction (so no parallel bars) into gate records.
+    A single-qubit gate applied to a list of qubits, such as "H q[0:2]", becomes one record per qubit.
+    Multi-qubit gates with lists, such as "CNOT q[0,1],q[2,3]", are applied pairwise.
+
+    Args:
+        instruction: The instruction to parse, for example "CR q[0],q[1],0.5"
+
+    Returns: A list of Gate records
+    """
+    parts = instruction.split(None, 1)
+    name = parts[0]
+    if len(parts) == 1:
+        return [Gate(name, ())]
+
+    qubit_lists = []
+    angle = None
+    for operand in operand_pattern.findall(parts[1]):
+        if operand.startswith("q["):
+            qubit_lists.append(parse_indices(operand[2:-1]))
+        else:
+            try:
+                angle = float(operand)
+            except ValueError:
+                raise ValueError("Unknown operand '{}' in instruction: {}".format(operand, instruction))
+
+    widths = set(map(len, qubit_lists))
+    if len(widths) > 1:
+        raise ValueError("Qubit lists of different lengths in instruction: {}".format(instruction))
+
+    return [Gate(name, tuple(qubits), angle) for qubits in zip(*qubit_lists)]
+
+
+def parse_qasm(qasm):
+    """
+    Parse a cQASM program into a Circuit in a single pass over its lines.
+    Supports parallel blocks ({ a | b }), qubit ranges (q[0:3]), comma lists (q[0,1]),
+    rotation angles (CR q[0],q[1],0.5) and subcircuit headers such as .grover_loop(3).
+
+    Args:
+        qasm: A valid cQASM program
+
+    Returns: The equivalent Circuit
+    """
+    qubit_count = None
+    subcircuits = [Subcircuit(None, 1, [])]
+
+    for line_number, line in enumerate(qasm.split("\n")):
+        # remove comments and surrounding whitespace
+        line = line.split("#", 1)[0].strip()
+        if line == "" or line.startswith("version"):
+            continue
+
+        if line.startswith("qubits"):
+            qubit_count = int(line.split()[1])
+        elif line.startswith("."):
+            match = header_pattern.match(line)
+            if match is None:
+                raise ValueError("Invalid subcircuit header on line {}: {}".format(line_number + 1, line))
+            iterations = int(match.group(2)) if match.group(2) is not None else 1
+            subcircuits.append(Subcircuit(match.group(1), iterations, []))
+        else:
+            moment = []
+            for instruction in line.strip("{}").split("|"):
+                instruction = instruction.strip()
+                if instruction != "":
+                    moment += parse_instruction(instruction)
+            subcircuits[-1].moments.append(tuple(moment))
+
+    if qubit_count is None:
+        raise ValueError("No 'qubits' statement found in cQASM program")
+
+    # drop the implicit first subcircuit if nothing was placed in it
+    if len(subcircuits[0].moments) == 0 and len(subcircuits) > 1:
+        subcircuits = subcircuits[1:]
+
+    return Circuit(qubit_count, subcircuits)
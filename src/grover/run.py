@@ -1,10 +1,15 @@
 from src.grover.search_utilities import *
 from src.grover.sat_utilities import *
 from src.optimizations.optimizer import *
+from src.grover.circuit import Circuit, Subcircuit, render_qasm, iter_qasm, write_qasm
+from src.backends.backends import execute_on
+from src.backends.cache import result_cache
+from src.grover.histogram import SearchScorer
+from src.grover.analytic import grover_iterations
 import math
 
 
-def generate_search_qasm(search_targets, mode, apply_optimization=True):
+def generate_search_qasm(search_targets, mode, apply_optimization=True, relative_phase=None):
     """
     Generate the QASM needed to perform an unordered search using Grover's Algorithm.
 
@@ -12,6 +17,7 @@ def generate_search_qasm(search_targets, mode, apply_optimization=True):
         search_targets: A list of bit strings to search for
         mode: The mode for CNOTs (see main.py)
         apply_optimization: Whether to apply the optimization algorithm
+        relative_phase: Whether to use Margolus gates in "no toffoli" mode (see optimize_search_circuit)
 
     Returns: A tuple of the following values:
         - qasm: The QASM representing the requested Grover search
@@ -20,125 +26,224 @@ def generate_search_qasm(search_targets, mode, apply_optimization=True):
         - data qubits: The number of data qubits
     """
 
+    circuit, data_qubits = build_search_circuit(search_targets, mode)
+    circuit = optimize_search_circuit(circuit, mode, apply_optimization, relative_phase=relative_phase)
+
+    # the circuit is only turned into text once, at the very end
+    qasm = render_qasm(circuit, compact=apply_optimization)
+
+    return qasm, circuit_depth(circuit), circuit.qubit_count, data_qubits
+
+
+def iter_search_qasm(search_targets, mode, apply_optimization=True, window=stream_window, relative_phase=None):
+    """
+    Generate the same QASM as generate_search_qasm, but one line at a time.
+    The circuit is generated and optimized while the lines are consumed, so memory use stays bounded,
+    even in "fancy cnot" mode where the program grows as 2^n.
+
+    Args:
+        search_targets: A list of bit strings to search for
+        mode: The mode for CNOTs (see main.py)
+        apply_optimization: Whether to apply the optimization algorithm
+        window: The number of moments the optimizations keep in memory (see stream_optimizations)
+        relative_phase: Whether to use Margolus gates in "no toffoli" mode (see optimize_search_circuit)
+
+    Returns: A tuple of the following values:
+        - lines: A generator of lines of QASM
+        - qubit count: The total number of qubits required
+        - data qubits: The number of data qubits
+    """
+    circuit, data_qubits = build_search_circuit(search_targets, mode, stream=True)
+    circuit = optimize_search_circuit(circuit, mode, apply_optimization, window, relative_phase)
+    return iter_qasm(circuit, compact=apply_optimization), circuit.qubit_count, data_qubits
+
+
+def write_search_qasm(search_targets, mode, file, apply_optimization=True, window=stream_window,
+                      relative_phase=None):
+    """
+    Write the QASM of generate_search_qasm straight to a file-like object, without building it as a string.
+
+    Args:
+        search_targets: A list of bit strings to search for
+        mode: The mode for CNOTs (see main.py)
+        file: A file-like object to write to, such as an open file
+        apply_optimization: Whether to apply the optimization algorithm
+        window: The number of moments the optimizations keep in memory (see stream_optimizations)
+        relative_phase: Whether to use Margolus gates in "no toffoli" mode (see optimize_search_circuit)
+
+    Returns: A tuple of the following values:
+        - line count: The total number of parallel lines that is executed (including grover loops)
+        - qubit count: The total number of qubits required
+        - data qubits: The number of data qubits
+    """
+    circuit, data_qubits = build_search_circuit(search_targets, mode, stream=True)
+    circuit = optimize_search_circuit(circuit, mode, apply_optimization, window, relative_phase)
+    line_count = write_qasm(circuit, file, compact=apply_optimization)
+    return line_count, circuit.qubit_count, data_qubits
+
+
+def build_search_circuit(search_targets, mode, stream=False):
+    """
+    Build the (unoptimized) circuit for an unordered search using Grover's Algorithm.
+
+    Args:
+        search_targets: A list of bit strings to search for
+        mode: The mode for CNOTs (see main.py)
+        stream: Whether the moments of the Grover loop should be generated lazily, instead of kept in a list
+
+    Returns: A tuple of the following values:
+        - circuit: The Circuit representing the requested Grover search
+        - data qubits: The number of data qubits
+    """
+
     data_qubits = len(search_targets[0])
 
-    if mode in ["crot", "fancy cnot"]:
+    if mode in ["crot", "fancy cnot", "poly crot", "borrowed"]:
         ancillary_qubits = 0
-    elif mode in ["normal", "no toffoli"]:
+    elif mode in ["normal", "no toffoli", "log depth"]:
         ancillary_qubits = data_qubits - 3
     else:
         raise ValueError("Invalid value for MODE: {}".format(mode))
 
     qubit_count = data_qubits + ancillary_qubits
 
-    qasm = "version 1.0\n" \
-           "qubits {}\n".format(qubit_count)
-
     # initialisation
-    qasm += fill("H", data_qubits)
+    init_moments = fill("H", data_qubits)
 
     # looping grover
-    iterations = int(math.pi * math.sqrt((2 ** data_qubits) / len(search_targets)) / 4)
-    qasm += ".grover_loop({})\n".format(iterations)
+    iterations = int(grover_iterations(data_qubits, len(search_targets)))
 
-    # oracle
-    for s in range(len(search_targets)):
-        qasm += search_oracle(search_targets[s], data_qubits)
-        qasm += cnot_pillar(mode, data_qubits)
-        qasm += search_oracle(search_targets[s], data_qubits)
+    def generate_loop(pillar):
+        # oracle
+        for s in range(len(search_targets)):
+            yield from search_oracle(search_targets[s], data_qubits)
+            yield from pillar(mode, data_qubits)
+            yield from search_oracle(search_targets[s], data_qubits)
+
+        # diffusion
+        yield from fill("H", data_qubits)
+        yield from fill("X", data_qubits)
+        yield from pillar(mode, data_qubits)
+        yield from fill("X", data_qubits)
+        yield from fill("H", data_qubits)
+
+    if stream:
+        loop_moments = generate_loop(iter_cnot_pillar)
+    else:
+        loop_moments = list(generate_loop(cnot_pillar))
+
+    circuit = Circuit(qubit_count, [Subcircuit(None, 1, init_moments),
+                                    Subcircuit("grover_loop", iterations, loop_moments)])
+    return circuit, data_qubits
 
-    # diffusion
-    qasm += fill("H", data_qubits)
-    qasm += fill("X", data_qubits)
-    qasm += cnot_pillar(mode, data_qubits)
-    qasm += fill("X", data_qubits)
-    qasm += fill("H", data_qubits)
+
+def optimize_search_circuit(circuit, mode, apply_optimization, window=None, relative_phase=None):
+    """
+    Apply the optimizations (and Toffoli replacements in "no toffoli" mode) to a search circuit.
+
+    Args:
+        circuit: The Circuit from build_search_circuit
+        mode: The mode for CNOTs (see main.py)
+        apply_optimization: Whether to apply the optimization algorithm
+        window: If given, use the streaming passes with this many moments in memory
+        relative_phase: Whether to replace Toffoli gates that are computed and uncomputed by Margolus gates
+                        in "no toffoli" mode. They take 3 instead of 5 two-qubit gates, but can make a circuit deeper,
+                        so by default (None) they are only used in the subcircuits where they do not add layers.
+                        For example a search on 10 data qubits then takes 1752 instead of 2024 layers, while on
+                        8 data qubits Margolus gates would take 729 instead of 697 layers, so they are not used
+
+    Returns: The optimized Circuit
+    """
+    if window is None:
+        optimize_func = apply_optimizations
+        replace_func = replace_toffoli_with_alt
+    else:
+        optimize_func = lambda c: stream_optimizations(c, window)
+        replace_func = lambda c, relative_phase: stream_replace_toffoli_with_alt(c, relative_phase, window)
 
     if mode != "no toffoli":
         if apply_optimization:
-            qasm = apply_optimizations(qasm, qubit_count, data_qubits)
+            circuit = optimize_func(circuit)
 
     elif mode == "no toffoli":
         if apply_optimization:
-            qasm = optimize_toffoli(qasm)
+            # cancel Toffoli gates and put them in parallel, so their replacements are also parallel
+            circuit = optimize_func(circuit)
 
         # replace toffoli gates at the last minute, after optimisation, to ensure smallest circuit
-        qasm = replace_toffoli_with_alt(qasm)
+        # Toffoli gates that are uncomputed later only need to be correct up to a relative phase, if requested
+        circuit = replace_func(circuit, relative_phase=relative_phase)
 
         if apply_optimization:
-            qasm = apply_optimizations(qasm, qubit_count, data_qubits)
+            circuit = optimize_func(circuit)
 
-    return qasm, iterations * qasm.count("\n"), qubit_count, data_qubits
+    return circuit
 
 
-def execute_search_qasm(search_targets, qi, qasm, shot_count, backend, qubit_count, data_qubits, plot):
+def execute_search_qasm(search_targets, qi, qasm, shot_count, backend, qubit_count, data_qubits, plot,
+                        cache=result_cache):
     """
     Execute the given QASM code and parse the results as though we are running an unordered search.
 
     Args:
         search_targets: A list of bit strings to search for
-        qi: An instance of the Quantum Inspire API
+        qi: A Backend (see src.backends.backends), or an instance of the Quantum Inspire API
         qasm: The qasm program
         shot_count: The number of shots to execute on the circuit
-        backend: An instance a QI API backend
+        backend: An instance a QI API backend (not used when qi is a Backend)
         qubit_count: The total number of qubits used in the qasm program
         data_qubits: The number of qubits used by Grover's Algorithm (aka non-ancillary)
         plot: Whether to plot the results of this run
+        cache: The ResultCache to look in before executing (see src.backends.cache), or None to always execute
 
     Returns: A tuple of the following values:
-        - histogram_list: a list of pairs, specifying a name and probability, as returned from QI
-        - target_probs: The probabilities for each of the targets
+        - histogram: a Histogram of the non-zero results (see src.grover.histogram),
+                     iterating over it gives pairs of a name and probability, histogram.dense() gives the full list
+        - target_probs: A NumPy array with the probability of each of the targets
         - non_target_prob: The total probability not to find one of the targets
         - runtime: The execution time on the QI backend
     """
 
     print("Executing QASM code ({} qubits, {} shots)".format(qubit_count, shot_count))
-    result = qi.execute_qasm(qasm, backend_type=backend, number_of_shots=shot_count)
+    result = execute_on(qi, qasm, shot_count, backend, cache)
     runtime = result["execution_time_in_seconds"]
     print("Ran on simulator in {} seconds".format(str(runtime)[:5]))
 
-    if qubit_count > 15:
+    # the plot has a bar for every data qubit outcome, which gets unreadable (and slow) for large searches
+    if data_qubits > 15:
         print("No plot because of large qubit count")
-        histogram_list = interpret_results(result, qubit_count, data_qubits, False)
+        histogram = interpret_results(result, qubit_count, data_qubits, False, dense=False)
     else:
-        histogram_list = interpret_results(result, qubit_count, data_qubits, plot)
+        histogram = interpret_results(result, qubit_count, data_qubits, plot, dense=False)
 
-    non_target_prob = 0
-    target_probs = [0 for _ in range(len(search_targets))]
-    for h in histogram_list:
-        name, prob = h[0], h[1]
-        is_target = False
-        for s in range(len(search_targets)):
-            # the bit string should have leading zeroes
-            if name == "0" * (qubit_count - data_qubits) + search_targets[s][::-1]:
-                is_target = True
-                target_probs[s] = prob
-                print("Search target {}:".format(s + 1))
-                print("\tBinary: '{}'".format(search_targets[s]))
-                print("\tProbability: {}".format(prob))
-                print()
-        if not is_target:
-            non_target_prob += prob
+    target_probs, non_target_prob, ancilla_leakage = SearchScorer(search_targets).score(histogram)
+    for s in range(len(search_targets)):
+        print("Search target {}:".format(s + 1))
+        print("\tBinary: '{}'".format(search_targets[s]))
+        print("\tProbability: {}".format(target_probs[s]))
+        print()
 
+    if ancilla_leakage > 0:
+        print("Probability of a non-zero ancillary qubit is {}".format(round(ancilla_leakage, 5)))
     print("Probability of any non-target is {}".format(round(non_target_prob, 5)))
 
-    return histogram_list, target_probs, non_target_prob, runtime
+    return histogram, target_probs, non_target_prob, runtime
 
 
-def generate_sat_qasm(expr_string, cnot_mode, sat_mode, apply_optimization=True):
+def generate_sat_oracle(expr_string, sat_mode, max_ancillas=None, cnot_mode="normal"):
     """
-    Generate the QASM needed to evaluate the SAT problem for a given boolean expression.
+    Generate the oracle for a boolean expression, as used by generate_sat_qasm.
 
     Args:
         expr_string: A boolean expression as a string
-        cnot_mode: The mode for CNOTs (see main.py)
         sat_mode: The mode for the SAT solving circuit
-        apply_optimization: Whether to apply the optimization algorithm
+        max_ancillas: The maximum number of ancillary qubits for the oracle in "pebbling" mode (None for no limit)
+        cnot_mode: The mode for the multi-controlled NOTs of the oracle in "cnf" mode
+                   (see main.py, and generate_sat_qasm for the modes that are replaced)
 
     Returns: A tuple of the following values:
-        - qasm: The QASM representing the requested Grover search
-        - line count: The total number of parallel lines that is executed (including grover loops)
-        - qubit count: The total number of qubits required
+        - oracle_qasm: The list of moments of the oracle
+        - qubit count: The number of qubits used by the oracle
         - data qubits: The number of data qubits
     """
 
@@ -150,85 +255,145 @@ def generate_sat_qasm(expr_string, cnot_mode, sat_mode, apply_optimization=True)
     # note that the number of data qubits also includes an extra bit which must be 1 for the algorithm to succeed
     data_qubits = len(control_names) + 1
 
-    expr = split_expression_evenly(expr.simplify())
+    if sat_mode == "cnf":
+        # the clauses are used as they are, instead of being split into 2-argument gates
+        oracle_qasm, _, last_qubit_index = generate_sat_oracle_cnf(algebra.cnf(expr), control_names, cnot_mode)
+        return oracle_qasm, last_qubit_index + 1, data_qubits
+
+    # the other modes split the expression into 2-argument gates themselves (see ExpressionDAG)
+    expr = expr.simplify()
 
     if sat_mode == "reuse gates":
-        oracle_qasm, _, last_qubit_index = generate_sat_oracle_reuse_gates(expr, control_names, is_toplevel=True)
+        oracle_qasm, _, last_qubit_index = generate_sat_oracle_reuse_gates(expr, control_names)
     elif sat_mode == "reuse qubits":
-        oracle_qasm, _, last_qubit_index = generate_sat_oracle_reuse_qubits(expr, control_names, [], is_toplevel=True)
+        oracle_qasm, _, last_qubit_index = generate_sat_oracle_reuse_qubits(expr, control_names)
+    elif sat_mode == "pebbling":
+        oracle_qasm, _, last_qubit_index = generate_sat_oracle_pebbling(expr, control_names, max_ancillas)
     else:
-        raise ValueError("Invalid SAT mode: {} instead of 'reuse gates' or 'reuse qubits'".format(sat_mode))
+        raise ValueError("Invalid SAT mode: {} instead of 'reuse gates', 'reuse qubits', 'pebbling' or 'cnf'".format(
+            sat_mode))
+
+    return oracle_qasm, last_qubit_index + 1, data_qubits
+
 
-    qubit_count = last_qubit_index + 1
+def sat_oracle_cost(expr_string, sat_mode, max_ancillas=None, cnot_mode="normal"):
+    """
+    Find what the oracle for a boolean expression costs in a given SAT mode, without building the full circuit.
+    "reuse gates" needs the fewest gates and "reuse qubits" the fewest qubits, so comparing both shows the tradeoff.
+    "pebbling" lies in between, depending on max_ancillas. "cnf" only works on expressions in conjunctive normal form
+    (any other expression is converted first), but there it needs fewer qubits than "reuse gates" and fewer gates
+    than either of them.
+
+    Args:
+        expr_string: A boolean expression as a string
+        sat_mode: The mode for the SAT solving circuit
+        max_ancillas: The maximum number of ancillary qubits for the oracle in "pebbling" mode (None for no limit)
+        cnot_mode: The mode for the multi-controlled NOTs of the oracle in "cnf" mode (see main.py)
+
+    Returns: An OracleCost
+    """
+    oracle_qasm, qubit_count, _ = generate_sat_oracle(expr_string, sat_mode, max_ancillas, cnot_mode)
+    return OracleCost(qubit_count, sum(len(moment) for moment in oracle_qasm))
+
+
+def generate_sat_qasm(expr_string, cnot_mode, sat_mode, apply_optimization=True, max_ancillas=None):
+    """
+    Generate the QASM needed to evaluate the SAT problem for a given boolean expression.
+
+    Args:
+        expr_string: A boolean expression as a string
+        cnot_mode: The mode for CNOTs (see main.py). The diffusion operator always uses this mode, but the oracle in
+                   "cnf" mode does not: it uses "log depth" for the modes with clean ancillary qubits ("normal",
+                   "no toffoli" and "log depth") and "borrowed" for all others (see generate_sat_oracle_cnf)
+        sat_mode: The mode for the SAT solving circuit
+        apply_optimization: Whether to apply the optimization algorithm
+        max_ancillas: The maximum number of ancillary qubits for the oracle in "pebbling" mode (None for no limit).
+                      The total qubit count is then at most the number of data qubits plus max_ancillas,
+                      unless the CNOT mode needs more ancillary qubits for the diffusion operator
+
+    Returns: A tuple of the following values:
+        - qasm: The QASM representing the requested Grover search
+        - line count: The total number of parallel lines that is executed (including grover loops)
+        - qubit count: The total number of qubits required
+        - data qubits: The number of data qubits
+    """
+
+    oracle_qasm, qubit_count, data_qubits = generate_sat_oracle(expr_string, sat_mode, max_ancillas, cnot_mode)
+
+    # the ancillary lines of the oracle are idle during diffusion, so "borrowed" mode can use them as they are
+    borrowed = list(range(data_qubits, qubit_count))
 
     # some modes may require many ancillary qubits for the diffusion operator!
-    if cnot_mode in ["normal", "no toffoli"]:
+    if cnot_mode in ["normal", "no toffoli", "log depth"]:
         qubit_count = max(qubit_count, data_qubits * 2 - 3)
 
-    qasm = "version 1.0\n" \
-           "qubits {}\n".format(qubit_count)
-
     # initialisation
-    qasm += fill("H", data_qubits)
+    init_moments = fill("H", data_qubits)
 
     # looping grover
     iterations = int(math.pi * math.sqrt(2 ** data_qubits - 1) / 4)
-    qasm += ".grover_loop({})\n".format(iterations)
-
-    qasm += oracle_qasm + "\n"
+    loop_moments = oracle_qasm[:]
 
     # diffusion
-    qasm += fill("H", data_qubits)
-    qasm += fill("X", data_qubits)
-    qasm += cnot_pillar(cnot_mode, data_qubits)
-    qasm += fill("X", data_qubits)
-    qasm += fill("H", data_qubits)
+    loop_moments += fill("H", data_qubits)
+    loop_moments += fill("X", data_qubits)
+    loop_moments += cnot_pillar(cnot_mode, data_qubits, borrowed)
+    loop_moments += fill("X", data_qubits)
+    loop_moments += fill("H", data_qubits)
+
+    circuit = Circuit(qubit_count, [Subcircuit(None, 1, init_moments),
+                                    Subcircuit("grover_loop", iterations, loop_moments)])
 
     if apply_optimization:
-        qasm = apply_optimizations(qasm, qubit_count, data_qubits)
+        circuit = apply_optimizations(circuit)
+
+    qasm = render_qasm(circuit, compact=apply_optimization)
 
-    return qasm, iterations * qasm.count("\n"), qubit_count, data_qubits
+    return qasm, circuit_depth(circuit), qubit_count, data_qubits
 
 
-def execute_sat_qasm(qi, qasm, shot_count, backend, qubit_count, data_qubits, plot):
+def execute_sat_qasm(qi, qasm, shot_count, backend, qubit_count, data_qubits, plot, cache=result_cache):
     """
     Execute the given QASM code and parse the results as though we are evaluating a SAT problem.
 
     Args:
-        qi: An instance of the Quantum Inspire API
+        qi: A Backend (see src.backends.backends), or an instance of the Quantum Inspire API
         qasm: The qasm program
         shot_count: The number of shots to execute on the circuit
-        backend: An instance a QI API backend
+        backend: An instance a QI API backend (not used when qi is a Backend)
         qubit_count: The total number of qubits used in the qasm program
         data_qubits: The number of qubits used by Grover's Algorithm (aka non-ancillary)
         plot: Whether to plot the results of this run
+        cache: The ResultCache to look in before executing (see src.backends.cache), or None to always execute
 
     Returns: A tuple of the following values:
-        - histogram_list: a list of pairs, specifying a name and probability, as returned from QI
+        - histogram: a Histogram of the non-zero results (see src.grover.histogram),
+                     iterating over it gives pairs of a name and probability, histogram.dense() gives the full list
         - likely_solutions: a list of bit strings, all of which seem to solve the given formula, according to grover
         - runtime: The execution time on the QI backend
     """
 
     line_count = qasm.count("\n")
     print("Executing QASM code ({} instructions, {} qubits, {} shots)".format(line_count, qubit_count, shot_count))
-    result = qi.execute_qasm(qasm, backend_type=backend, number_of_shots=shot_count)
+    result = execute_on(qi, qasm, shot_count, backend, cache)
     runtime = result["execution_time_in_seconds"]
     print("Ran on simulator in {} seconds".format(str(runtime)[:5]))
 
-    if qubit_count > 15:
+    # the plot has a bar for every data qubit outcome, which gets unreadable (and slow) for large searches
+    if data_qubits > 15:
         print("No plot because of large qubit count")
-        histogram_list = interpret_results(result, qubit_count, data_qubits, False)
+        histogram = interpret_results(result, qubit_count, data_qubits, False, dense=False)
     else:
-        histogram_list = interpret_results(result, qubit_count, data_qubits, plot)
+        histogram = interpret_results(result, qubit_count, data_qubits, plot, dense=False)
 
     likely_solutions = []
     print("Interpreting SAT results:")
-    highest_prob = max(map(lambda _: _[1], histogram_list))
-    for h in histogram_list:
+    highest_prob = histogram.probabilities.max()
+    for h in histogram:
         # remove all ancillaries and the lowest order data bit: in SAT this is always 1
         name, prob = h[0][-data_qubits+1:], h[1]
         if prob > highest_prob / 2:
             print("{} seems to satisfy the formula:".format(name))
             likely_solutions.append(name)
 
-    return histogram_list, likely_solutions, runtime
+    return histogram, likely_solutions, runtime
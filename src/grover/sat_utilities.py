@@ -1,212 +1,747 @@
 import boolean
-from boolean.boolean import AND, OR, NOT, Symbol
+from boolean.boolean import AND, OR, NOT, Symbol, BaseElement
+from collections import namedtuple
+import heapq
 import random
+from src.grover.circuit import Gate
+from src.grover.expression_dag import ExpressionDAG
+from src.grover.search_utilities import multi_controlled_not, ancillas_needed
 
 
-def generate_sat_oracle_reuse_gates(expr: boolean.Expression, control_names, is_toplevel=False):
+# The size of a SAT oracle: qubit_count is the number of qubits it uses (data and ancillary)
+# and gate_count is the total number of gates in all of its moments.
+OracleCost = namedtuple("OracleCost", ["qubit_count", "gate_count"])
+
+# in the CNF oracle, every line that holds a variable is read by at most this many clauses (see generate_sat_oracle_cnf)
+clauses_per_line = 3
+
+
+def generate_sat_oracle_reuse_gates(expr: boolean.Expression, control_names):
     """
     Generate the circuit needed for an oracle solving the SAT problem, given a boolean expression.
     This uses a new ancillary qubit for every boolean gate, UNLESS that sub-expression has already been calculated before.
+    The expression is first turned into a canonical ExpressionDAG, so sub-expressions are also shared when their
+    operands are given in another order or grouping.
+    All state lives in a new ReuseGatesOracleBuilder, so this can be called from several threads at once.
 
     Args:
         expr: The boolean expression (instance of boolean.Expression, not a string)
         control_names: The names of the control variables
-        is_toplevel: Whether this is the main call, or a recursive call
 
     Returns: A tuple of the following values:
-        - qasm: The QASM for this expression
+        - qasm: The list of moments for this expression
         - target_qubit: The qubit line on which the output of this expression is placed
+        - highest_qubit_used: The highest qubit index used by the oracle
     """
+    dag = ExpressionDAG()
+    root = dag.add(expr)
+    return ReuseGatesOracleBuilder(control_names, dag).build(root)
 
-    global highest_qubit_used
-    global expressions_calculated
-
-    if is_toplevel:
-        highest_qubit_used = len(control_names)
-        expressions_calculated = {}
-    local_qasm = ""
-
-    # go through possible types
-    if type(expr) == AND or type(expr) == OR:
-        # left side
-        left_qasm, left_qubit, _ = generate_sat_oracle_reuse_gates(expr.args[0], control_names)
-        expressions_calculated[expr.args[0]] = left_qubit
-        right_qasm, right_qubit, _ = generate_sat_oracle_reuse_gates(expr.args[1], control_names)
-        expressions_calculated[expr.args[1]] = right_qubit
-        local_qasm += left_qasm
-        local_qasm += right_qasm
-    elif type(expr) == NOT:
-        inner_qasm, inner_qubit, _ = generate_sat_oracle_reuse_gates(expr.args[0], control_names)
-        local_qasm += inner_qasm
-        local_qasm += "X q[{}]\n".format(inner_qubit)
-        return local_qasm, inner_qubit, highest_qubit_used
-    elif type(expr) == Symbol:
-        # nothing to do here
-        return local_qasm, control_names.index(expr), highest_qubit_used
-    else:
-        raise ValueError("Unknown boolean expr type: {}".format(type(expr)))
 
-    if expr in expressions_calculated:
-        already_calculated_index = expressions_calculated[expr]
-        # we don't need to add any qasm, just say where this expression can be found
-        return "", already_calculated_index, highest_qubit_used
+class ReuseGatesOracleBuilder:
+    """
+    Builds a single "reuse gates" oracle (see generate_sat_oracle_reuse_gates).
+    It owns the qubit allocator and the table of sub-expressions that have been calculated already,
+    so builders never share state: every oracle needs its own builder.
+    """
 
-    if is_toplevel:
-        target_qubit = len(control_names)
-        local_qasm += "H q[{}]\n".format(len(control_names))
-        left_half_qasm = local_qasm[:]
-    else:
-        # we need another ancillary bit
-        highest_qubit_used += 1
-        target_qubit = highest_qubit_used
+    def __init__(self, control_names, dag):
+        """
+        Args:
+            control_names: The names of the control variables
+            dag: The ExpressionDAG that holds the expression
+        """
+        self.control_qubits = {name: i for i, name in enumerate(control_names)}
+        self.dag = dag
+        # the qubit right after the control qubits is the output of the oracle
+        self.highest_qubit_used = len(control_names)
+        # maps the id of every DAG node that has been calculated to the qubit that holds its value
+        self.expressions_calculated = {}
+
+    def allocate(self):
+        """
+        Take a new ancillary qubit.
+
+        Returns: The index of the qubit
+        """
+        self.highest_qubit_used += 1
+        return self.highest_qubit_used
+
+    def build(self, root):
+        """
+        Generate the oracle for the whole expression, with its output on the qubit after the control qubits.
+
+        Args:
+            root: The id of the root node of the expression in the DAG
+
+        Returns: A tuple of the following values:
+            - qasm: The list of moments for this expression
+            - target_qubit: The qubit line on which the output of this expression is placed
+            - highest_qubit_used: The highest qubit index used by the oracle
+        """
+        local_qasm, target_qubit = self.generate(root, is_toplevel=True)
+        return local_qasm, target_qubit, self.highest_qubit_used
+
+    def generate(self, node, is_toplevel=False):
+        """
+        Generate the moments that calculate a node of the DAG.
+
+        Args:
+            node: The id of the node
+            is_toplevel: Whether this is the main call, or a recursive call
+
+        Returns: A tuple of the following values:
+            - qasm: The list of moments for this expression
+            - target_qubit: The qubit line on which the output of this expression is placed
+        """
+        operation = self.dag.nodes[node]
+
+        if operation[0] == "symbol":
+            # nothing to do here
+            return [], self.control_qubits[operation[1]]
+        elif operation[0] == "not":
+            inner_qasm, inner_qubit = self.generate(operation[1])
+            return inner_qasm + [(Gate("X", (inner_qubit,)),)], inner_qubit
+
+        if node in self.expressions_calculated:
+            # we don't need to add any qasm, just say where this expression can be found
+            return [], self.expressions_calculated[node]
+
+        _, left, right = operation
+        left_qasm, left_qubit = self.generate(left)
+        right_qasm, right_qubit = self.generate(right)
+        local_qasm = left_qasm + right_qasm
+
+        if is_toplevel:
+            target_qubit = len(self.control_qubits)
+            local_qasm += [(Gate("H", (target_qubit,)),)]
+            left_half_qasm = local_qasm[:]
+        else:
+            # we need another ancillary bit
+            target_qubit = self.allocate()
 
-    if type(expr) == AND:
-        local_qasm += generate_and(left_qubit, right_qubit, target_qubit)
-    elif type(expr) == OR:
-        local_qasm += generate_or(left_qubit, right_qubit, target_qubit)
+        if operation[0] == "and":
+            local_qasm += generate_and(left_qubit, right_qubit, target_qubit)
+        else:
+            local_qasm += generate_or(left_qubit, right_qubit, target_qubit)
 
-    # undo NOT applications
-    if len(expr.args) == 2 and not is_toplevel:
-        if type(expr.args[0]) == NOT:
-            local_qasm += "X q[{}]\n".format(left_qubit)
-        if type(expr.args[1]) == NOT:
-            local_qasm += "X q[{}]\n".format(right_qubit)
+        # undo NOT applications
+        if not is_toplevel:
+            if self.dag.nodes[left][0] == "not":
+                local_qasm += [(Gate("X", (left_qubit,)),)]
+            if self.dag.nodes[right][0] == "not":
+                local_qasm += [(Gate("X", (right_qubit,)),)]
 
-    # indicate to other calls of this function that this expression has been generated already
-    expressions_calculated[expr] = target_qubit
+        # indicate to other calls of this function that this expression has been generated already
+        self.expressions_calculated[node] = target_qubit
 
-    if is_toplevel:
-        local_qasm += "\n".join(left_half_qasm.split("\n")[::-1])
-        return local_qasm, target_qubit, highest_qubit_used
+        if is_toplevel:
+            # every moment in here is its own inverse, so reversing the moments uncomputes them
+            local_qasm += left_half_qasm[::-1]
 
-    return local_qasm, target_qubit, highest_qubit_used
+        return local_qasm, target_qubit
 
 
-def generate_sat_oracle_reuse_qubits(expr, control_names, avoid, last_qubit=-1, is_toplevel=False):
+def generate_sat_oracle_reuse_qubits(expr: boolean.Expression, control_names):
     """
     Generate a SAT oracle that saves on ancillary qubits by resetting them, so that they can be reused.
+    Every sub-expression is uncomputed as soon as its parent has used it, and the order in which the operands
+    are evaluated is chosen to keep the number of ancillary qubits that are live at the same time minimal.
 
     Args:
-        expr: The boolean expression to generate an oracle for
-        avoid: The ancillary lines that we can't use because they already contain data (default is an empty list)
+        expr: The boolean expression (instance of boolean.Expression, not a string)
         control_names: The names of the variables in the expression (such as "a", "b" and "c")
-        last_qubit: The highest qubit index we have ever used. This is needed to calculate the total number of ancillaries
-        is_toplevel: Whether this function call is the "original". In that case, its output is a specific qubit line
 
     Returns: A tuple of the following values:
-        - target_line: The output line of the qasm representing the input expression
-                       All other lines are guaranteed to be reset to 0
-        - qasm: The QASM code
-        - last_qubit: The highest ancillary qubit index encountered in this expression
+        - qasm: The list of moments for this expression
+        - target_qubit: The qubit line on which the output of this expression is placed
+                        All other lines are guaranteed to be reset to 0
+        - highest_qubit_used: The highest qubit index used by the oracle
     """
+    dag = ExpressionDAG()
+    root = dag.add(expr)
+    return ReuseQubitsOracleBuilder(control_names, dag).build(root)
 
-    first_ancillary_bit = len(control_names) + 1
 
-    if len(expr.args) > 2:
-        raise ValueError("Fancy SAT Oracle expects only 1 and 2-argument expressions, but got {}".format(expr.args))
-
-    if type(expr) == Symbol:
-        return "", control_names.index(expr), last_qubit
-    elif type(expr) == NOT:
-        qubit_index = control_names.index(expr.args[0])
-        return "X q[{}]".format(qubit_index), qubit_index, last_qubit
-    elif type(expr) == AND:
-        generate_func = generate_and
-    elif type(expr) == OR:
-        generate_func = generate_or
-    else:
-        raise ValueError("Unknown type in Boolean expression: {}".format(type(expr)))
-
-    left_expr = expr.args[0]
-    right_expr = expr.args[1]
-
-    left_qasm, left_target_qubit, left_last_qubit = generate_sat_oracle_reuse_qubits(left_expr, control_names,
-                                                                                     avoid[:],
-                                                                                     last_qubit)
-    avoid.append(left_target_qubit)
-    right_qasm, right_target_qubit, right_last_qubit = generate_sat_oracle_reuse_qubits(right_expr, control_names,
-                                                                                        avoid[:],
-                                                                                        last_qubit)
-    avoid.append(right_target_qubit)
-
-    target_qubit = -1
-    # if toplevel, we know what to target: the specific line that is set to the |1> state
-    if is_toplevel:
-        target_qubit = first_ancillary_bit - 1
-        my_qasm = "H q[{}]\n".format(target_qubit) + \
-                  generate_func(left_target_qubit, right_target_qubit, target_qubit) + \
-                  "H q[{}]\n".format(target_qubit)
-    else:
-        # find the lowest line we can use
-        # if necessary, we can target an entirely new line (if all the others are used)
-        for i in range(first_ancillary_bit, first_ancillary_bit + max(avoid) + 1):
-            if i not in avoid:
-                target_qubit = i
-                break
-        my_qasm = generate_func(left_target_qubit, right_target_qubit, target_qubit)
-
-    last_qubit = max(last_qubit, max(avoid), left_last_qubit, right_last_qubit, target_qubit)
+def generate_sat_oracle_pebbling(expr: boolean.Expression, control_names, max_ancillas=None):
+    """
+    Generate a SAT oracle that keeps some intermediate results (as "reuse gates" does) and recalculates the others
+    (as "reuse qubits" does), so that it uses as few gates as possible with at most max_ancillas ancillary qubits.
+    See plan_pebbling for how the results to keep are chosen.
 
-    local_qasm = "\n".join([
-        left_qasm,
-        right_qasm,
-        my_qasm,
-        *right_qasm.split("\n")[::-1],
-        *left_qasm.split("\n")[::-1]
-    ])
+    Args:
+        expr: The boolean expression (instance of boolean.Expression, not a string)
+        control_names: The names of the variables in the expression (such as "a", "b" and "c")
+        max_ancillas: The maximum number of ancillary qubits the oracle may use, or None for no limit
 
-    return local_qasm, target_qubit, last_qubit
+    Returns: A tuple of the following values:
+        - qasm: The list of moments for this expression
+        - target_qubit: The qubit line on which the output of this expression is placed
+                        All other lines are guaranteed to be reset to 0
+        - highest_qubit_used: The highest qubit index used by the oracle
+    """
+    dag = ExpressionDAG()
+    root = dag.add(expr)
+    kept, _ = plan_pebbling(dag, root, control_names, max_ancillas)
+    return ReuseQubitsOracleBuilder(control_names, dag, kept).build(root)
 
 
-def generate_and(qubit_1, qubit_2, target_qubit):
+class AncillaAllocator:
     """
-    Generate an AND in qasm code (just a Toffoli).
+    Hands out ancillary qubits, always reusing the lowest line that has been freed.
+    The free lines are kept in a heap and the live ones in a set, so both allocating and freeing
+    take O(log n) time, no matter how many lines are in use.
     """
-    if qubit_1 == qubit_2:
-        return "CNOT q[{}],q[{}]\n".format(qubit_1, target_qubit)
 
-    return "Toffoli q[{}],q[{}],q[{}]\n".format(qubit_1, qubit_2, target_qubit)
+    def __init__(self, first_qubit):
+        """
+        Args:
+            first_qubit: The lowest qubit index that may be used as an ancillary qubit
+        """
+        self.next_qubit = first_qubit
+        self.free_qubits = []
+        self.live_qubits = set()
+
+    @property
+    def highest_qubit_used(self):
+        return self.next_qubit - 1
+
+    def allocate(self):
+        """
+        Take an ancillary qubit, which must be reset to 0 before it is freed.
+
+        Returns: The index of the qubit
+        """
+        if self.free_qubits:
+            qubit = heapq.heappop(self.free_qubits)
+        else:
+            qubit = self.next_qubit
+            self.next_qubit += 1
+
+        self.live_qubits.add(qubit)
+        return qubit
 
+    def free(self, qubit):
+        """
+        Give back an ancillary qubit, so that it can be allocated again.
 
-def generate_or(qubit_1, qubit_2, target_qubit):
+        Args:
+            qubit: The index of the qubit
+        """
+        if qubit not in self.live_qubits:
+            raise ValueError("Qubit {} is freed, but it is not in use".format(qubit))
+
+        self.live_qubits.remove(qubit)
+        heapq.heappush(self.free_qubits, qubit)
+
+
+class ReuseQubitsOracleBuilder:
     """
-    Generate an OR in qasm code (Toffoli with X gates).
+    Builds a single "reuse qubits" or "pebbling" oracle (see generate_sat_oracle_reuse_qubits).
+    The output qubit of every AND/OR node is allocated before its operands are calculated and freed right after
+    they have been uncomputed, so the uncomputation of an operand is simply its list of moments in reverse:
+    it runs with exactly the same lines in use as when the operand was calculated.
+    Nodes in the kept set are the exception: they are calculated once, before anything else, and only uncomputed
+    at the very end, so every use of them is free but their lines stay in use for the whole oracle.
     """
-    if qubit_1 == qubit_2:
-        return "CNOT q[{}],q[{}]\n".format(qubit_1, target_qubit)
 
-    local_qasm = "X q[{},{}]\n".format(qubit_1, qubit_2)
-    local_qasm += generate_and(qubit_1, qubit_2, target_qubit)
-    local_qasm += "X q[{},{},{}]\n".format(qubit_1, qubit_2, target_qubit)
-    return local_qasm
+    def __init__(self, control_names, dag, kept=()):
+        """
+        Args:
+            control_names: The names of the control variables
+            dag: The ExpressionDAG that holds the expression
+            kept: The ids of the AND/OR nodes to keep (by default none, so everything is recalculated)
+        """
+        self.control_qubits = {name: i for i, name in enumerate(control_names)}
+        self.dag = dag
+        self.kept = frozenset(kept)
+        # the qubit right after the control qubits is the output of the oracle
+        self.output_qubit = len(control_names)
+        self.allocator = AncillaAllocator(self.output_qubit + 1)
+        self.kept_qubits = {}
+        # maps node ids to the peak number of ancillary qubits needed by apply, and to its number of gates
+        self.needs = {}
+        self.gate_counts = {}
+
+    def build(self, root):
+        """
+        Generate the oracle for the whole expression, with its output on the qubit after the control qubits.
+
+        Args:
+            root: The id of the root node of the expression in the DAG
+
+        Returns: A tuple of the following values:
+            - qasm: The list of moments for this expression
+            - target_qubit: The qubit line on which the output of this expression is placed
+            - highest_qubit_used: The highest qubit index used by the oracle
+        """
+        # the ids of the DAG are in topological order, so kept operands are always calculated before their users
+        kept_qasm = []
+        for node in sorted(self.kept):
+            qubit = self.allocator.allocate()
+            kept_qasm += self.apply(node, qubit)
+            self.kept_qubits[node] = qubit
+
+        target_qubit = self.output_qubit
+        local_qasm = kept_qasm + \
+                     [(Gate("H", (target_qubit,)),)] + \
+                     self.apply(root, target_qubit) + \
+                     [(Gate("H", (target_qubit,)),)] + \
+                     kept_qasm[::-1]
+
+        return local_qasm, target_qubit, max(self.allocator.highest_qubit_used, target_qubit)
+
+    def cost(self, root):
+        """
+        Calculate what build would generate, without generating it.
+
+        Args:
+            root: The id of the root node of the expression in the DAG
+
+        Returns: An OracleCost
+        """
+        kept = sorted(self.kept)
+        # while a kept node is calculated, the ones before it are in use, as well as its own line
+        ancillas = max([i + 1 + self.apply_need(node) for i, node in enumerate(kept)] +
+                       [len(kept) + self.apply_need(root)])
+        gate_count = 2 * sum(self.gate_count(node) for node in kept) + self.gate_count(root) + 2
+
+        return OracleCost(self.output_qubit + 1 + ancillas, gate_count)
+
+    def strip(self, node):
+        """
+        Remove the NOTs around a node.
+
+        Returns: A tuple of the id of the node inside the NOTs and whether there was an odd number of them
+        """
+        negated = False
+        while self.dag.nodes[node][0] == "not":
+            node = self.dag.nodes[node][1]
+            negated = not negated
+        return node, negated
+
+    def allocates(self, node):
+        """
+        Returns: Whether evaluating this node takes a new ancillary qubit (so it is an AND or OR that is not kept)
+        """
+        inner, _ = self.strip(node)
+        return self.dag.nodes[inner][0] != "symbol" and inner not in self.kept
+
+    def need(self, node):
+        """
+        Find the peak number of ancillary qubits in use while evaluating a node, including its own output qubit.
+
+        Args:
+            node: The id of the node
+
+        Returns: The number of ancillary qubits
+        """
+        inner, _ = self.strip(node)
+        if not self.allocates(inner):
+            return 0
+        return 1 + self.apply_need(inner)
+
+    def apply_need(self, node):
+        """
+        Find the peak number of ancillary qubits in use while applying a node to a line that is already there.
+
+        Args:
+            node: The id of the node
+
+        Returns: The number of ancillary qubits
+        """
+        if node not in self.needs:
+            operation = self.dag.nodes[node]
+            if operation[0] == "symbol":
+                self.needs[node] = 0
+            elif operation[0] == "not":
+                self.needs[node] = self.apply_need(operation[1])
+            else:
+                first, second = self.order(node)
+                # the first operand stays in use while the second one is calculated (and uncomputed)
+                self.needs[node] = max(self.need(first), int(self.allocates(first)) + self.need(second))
+        return self.needs[node]
+
+    def gate_count(self, node):
+        """
+        Find the number of gates that apply generates for a node.
+
+        Args:
+            node: The id of the node
+
+        Returns: The number of gates
+        """
+        if node not in self.gate_counts:
+            operation = self.dag.nodes[node]
+            if operation[0] == "symbol":
+                count = 1
+            elif operation[0] == "not":
+                count = self.gate_count(operation[1]) + 1
+            else:
+                count = 0
+                lines = []
+                for operand in operation[1:]:
+                    inner, negated = self.strip(operand)
+                    if self.allocates(inner):
+                        # calculated and uncomputed, on a line of its own
+                        count += 2 * self.gate_count(inner)
+                        lines.append((None, negated))
+                    else:
+                        lines.append((inner, negated))
+
+                # mirror the gates of apply: operands on the same line are flipped once, and need just a CNOT
+                same_line = lines[0][0] is not None and lines[0][0] == lines[1][0]
+                if same_line:
+                    count += 2 * int(lines[0][1] or lines[1][1]) + 1
+                else:
+                    count += 2 * (int(lines[0][1]) + int(lines[1][1])) + (1 if operation[0] == "and" else 6)
+            self.gate_counts[node] = count
+        return self.gate_counts[node]
+
+    def order(self, node):
+        """
+        Pick the order in which the operands of an AND or OR are calculated.
+        As in Sethi-Ullman register allocation, the operand that needs the most ancillary qubits goes first,
+        because the output of the first operand has to be kept while the second one is calculated.
+
+        Args:
+            node: The id of the node
+
+        Returns: A tuple of the ids of both operands, in the order to calculate them
+        """
+        _, left, right = self.dag.nodes[node]
+        if self.need(right) > self.need(left):
+            return right, left
+        return left, right
+
+    def evaluate(self, node):
+        """
+        Make the value of a node available on some qubit, allocating an ancillary qubit if needed.
+
+        Args:
+            node: The id of the node
+
+        Returns: A tuple of the following values:
+            - qasm: The list of moments that calculate the node (reverse them to uncompute it)
+            - qubit: The qubit line on which the value is placed
+            - negated: Whether the line holds the negation of the value
+        """
+        operation = self.dag.nodes[node]
+
+        if operation[0] == "symbol":
+            return [], self.control_qubits[operation[1]], False
+        elif operation[0] == "not":
+            inner_qasm, qubit, negated = self.evaluate(operation[1])
+            return inner_qasm, qubit, not negated
+        elif node in self.kept:
+            return [], self.kept_qubits[node], False
+
+        qubit = self.allocator.allocate()
+        return self.apply(node, qubit), qubit, False
+
+    def apply(self, node, target_qubit):
+        """
+        Generate the moments that XOR the value of a node onto a target line, leaving all ancillary qubits at 0.
+
+        Args:
+            node: The id of the node
+            target_qubit: The qubit line to place the output on
+
+        Returns: The list of moments
+        """
+        operation = self.dag.nodes[node]
+
+        if operation[0] == "symbol":
+            return [(Gate("CNOT", (self.control_qubits[operation[1]], target_qubit)),)]
+        elif operation[0] == "not":
+            return self.apply(operation[1], target_qubit) + [(Gate("X", (target_qubit,)),)]
+
+        first, second = self.order(node)
+        first_qasm, first_qubit, first_negated = self.evaluate(first)
+        second_qasm, second_qubit, second_negated = self.evaluate(second)
+
+        # negated operands are flipped just around the gate, so that the other operand never sees them flipped
+        flipped = {qubit for qubit, negated in [(first_qubit, first_negated), (second_qubit, second_negated)]
+                   if negated}
+        flips = [tuple(Gate("X", (qubit,)) for qubit in sorted(flipped))] if flipped else []
+
+        if operation[0] == "and":
+            my_qasm = flips + generate_and(first_qubit, second_qubit, target_qubit) + flips
+        else:
+            my_qasm = flips + generate_or(first_qubit, second_qubit, target_qubit) + flips
+
+        for operand, qubit in [(second, second_qubit), (first, first_qubit)]:
+            if self.allocates(operand):
+                self.allocator.free(qubit)
+
+        return first_qasm + second_qasm + my_qasm + second_qasm[::-1] + first_qasm[::-1]
 
 
-def split_expression_evenly(expr):
+def plan_pebbling(dag, root, control_names, max_ancillas=None):
     """
-    Split a Boolean expression as evenly as possible into a binary tree.
+    Choose which intermediate results of a "pebbling" oracle to keep, and which to recalculate every time they are
+    needed. Keeping a result saves all the gates needed to recalculate and uncompute it, but takes a line for the
+    whole oracle. Starting from keeping nothing (as "reuse qubits" does), the result that saves the most gates while
+    staying within the budget is kept, until no result saves any more gates.
 
     Args:
-        expr: The Boolean expression to split
+        dag: The ExpressionDAG that holds the expression
+        root: The id of the root node of the expression in the DAG
+        control_names: The names of the control variables
+        max_ancillas: The maximum number of ancillary qubits the oracle may use, or None for no limit
 
-    Returns: The same expression, where all gates are applied to exactly 2 elements
+    Returns: A tuple of the following values:
+        - kept: A frozenset with the ids of the nodes to keep
+        - cost: The OracleCost of the oracle with those nodes kept
     """
+    first_ancillary_bit = len(control_names) + 1
 
-    expr_type = type(expr)
-    if len(expr.args) > 2:
-        halfway = int(len(expr.args) / 2)
-        right_expanded = split_expression_evenly(expr_type(*expr.args[halfway:]))
+    # every AND/OR below the root can be kept
+    candidates = set()
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        operation = dag.nodes[node]
+        if operation[0] != "symbol":
+            stack.extend(operation[1:])
+            if operation[0] != "not" and node != root:
+                candidates.add(node)
+
+    kept = frozenset()
+    cost = ReuseQubitsOracleBuilder(control_names, dag, kept).cost(root)
+    if max_ancillas is not None and cost.qubit_count - first_ancillary_bit > max_ancillas:
+        raise ValueError("This oracle needs at least {} ancillary qubits, but the budget is {}".format(
+            cost.qubit_count - first_ancillary_bit, max_ancillas))
+
+    while True:
+        best = None
+        for node in sorted(candidates - kept):
+            option = ReuseQubitsOracleBuilder(control_names, dag, kept | {node}).cost(root)
+            if max_ancillas is not None and option.qubit_count - first_ancillary_bit > max_ancillas:
+                continue
+            if option.gate_count < cost.gate_count and \
+                    (best is None or (option.gate_count, option.qubit_count) < (best[1].gate_count,
+                                                                                best[1].qubit_count)):
+                best = node, option
+
+        if best is None:
+            return kept, cost
+
+        kept = kept | {best[0]}
+        cost = best[1]
+
+
+def generate_sat_oracle_cnf(expr: boolean.Expression, control_names, cnot_mode):
+    """
+    Generate a SAT oracle for an expression in conjunctive normal form, such as the ones from generate_ksat_expression.
+    Every clause is calculated onto its own ancillary qubit with a single multi-controlled NOT on the negated literals
+    (a clause is only false if all of its literals are), and the output is flipped by one multi-controlled NOT on all
+    clause qubits. So a clause of k literals takes one k-controlled NOT, instead of a chain of k-1 ORs with an
+    ancillary qubit each. Clauses of a single literal are read from their variable directly.
+    Clauses on disjoint variables are placed next to each other so they run in parallel, and variables that are in
+    many clauses are copied onto extra lines, so that they do not make every clause wait for the previous one.
 
-        if len(expr.args) > 3:
-            left_expanded = split_expression_evenly(expr_type(*expr.args[:halfway]))
-        else:
-            left_expanded = split_expression_evenly(expr.args[0])
+    Args:
+        expr: The boolean expression in conjunctive normal form (see cnf_clauses)
+        control_names: The names of the variables in the expression (such as "a", "b" and "c")
+        cnot_mode: The method by which the multi-controlled NOTs are made (see cnot_pillar).
+                   The modes with clean ancillary qubits all use the Toffoli tree of "log depth".
+                   The modes without ancillary qubits grow too fast with the number of clauses, so they use
+                   "borrowed" instead, which borrows the other lines of the oracle and needs no extra qubits either
+
+    Returns: A tuple of the following values:
+        - qasm: The list of moments for this expression
+        - target_qubit: The qubit line on which the output of this expression is placed
+                        All other lines are guaranteed to be reset to 0
+        - highest_qubit_used: The highest qubit index used by the oracle
+    """
+    control_qubits = {name: i for i, name in enumerate(control_names)}
+    target_qubit = len(control_names)
 
-        return expr_type(left_expanded, right_expanded)
-    elif len(expr.args) == 2:
-        return expr_type(split_expression_evenly(expr.args[0]),
-                         split_expression_evenly(expr.args[1]))
+    # the phase flip has a control for every clause, and "crot" for example takes 3^n gates for n controls
+    if cnot_mode not in ["normal", "no toffoli", "log depth"]:
+        cnot_mode = "borrowed"
     else:
-        return expr
+        # same ancillary qubits and Toffoli gates as a chain, but much shallower for long clauses and many clauses
+        cnot_mode = "log depth"
+
+    clauses = cnf_clauses(expr)
+    # the scheduler places gates in program order, so clauses on disjoint variables should be next to each other
+    long_clauses = order_clauses_in_rounds([clause for clause in clauses if len(clause) > 1])
+    clause_qubits = list(range(target_qubit + 1, target_qubit + 1 + len(long_clauses)))
+
+    # the output is flipped if every clause qubit is 1 and every single literal is true
+    phase_literals = [(control_qubits[name], negated) for clause in clauses if len(clause) == 1
+                      for name, negated in clause]
+    phase_literals += [(qubit, False) for qubit in clause_qubits]
+
+    # modes that need clean ancillary qubits share them between all multi-controlled NOTs
+    first_scratch_qubit = target_qubit + 1 + len(long_clauses)
+    scratch_count = max([ancillas_needed(cnot_mode, len(clause)) for clause in long_clauses] +
+                        [ancillas_needed(cnot_mode, len(phase_literals))])
+    scratch_qubits = list(range(first_scratch_qubit, first_scratch_qubit + scratch_count))
+    highest_qubit_used = first_scratch_qubit + scratch_count - 1
+
+    # every clause reads its variables a few times on the way in and again on the way out, so variables that are in
+    # many clauses become the critical path. Those are copied onto extra lines, and the clauses spread over the copies.
+    # The borrowed mode is there to save qubits, so it always reads the variables themselves
+    lines = {name: [control_qubits[name]] for name in control_names}
+    copy_qasm = []
+    if cnot_mode != "borrowed":
+        for name in control_names:
+            occurrences = sum(1 for clause in long_clauses for literal_name, _ in clause if literal_name == name)
+            for _ in range((occurrences - 1) // clauses_per_line):
+                highest_qubit_used += 1
+                lines[name].append(highest_qubit_used)
+                copy_qasm.append((Gate("CNOT", (control_qubits[name], highest_qubit_used)),))
+
+    # the number of gates on each line so far, and on each control of a template
+    line_loads = {}
+    control_loads = {}
+
+    def clause_controls(clause):
+        k = len(clause)
+        if k not in control_loads:
+            template = multi_controlled_not(cnot_mode, list(range(k)), k, list(range(k + 1, k + 1 + scratch_count)))
+            control_loads[k] = [sum(1 for moment in template for g in moment if i in g.qubits) for i in range(k)]
+
+        # use the least busy line of every variable, and put the busiest lines on the controls with the fewest gates
+        literals = [(min(lines[name], key=lambda line: line_loads.get(line, 0)), negated) for name, negated in clause]
+        literals.sort(key=lambda literal: line_loads.get(literal[0], 0), reverse=True)
+        controls = sorted(range(k), key=lambda i: control_loads[k][i])
+        chosen = [None] * k
+        for i, (line, negated) in zip(controls, literals):
+            chosen[i] = (line, negated)
+            line_loads[line] = line_loads.get(line, 0) + control_loads[k][i]
+        return chosen
+
+    def flip(qubits):
+        if not qubits:
+            return []
+        return [tuple(Gate("X", (qubit,)) for qubit in qubits)]
+
+    def controlled_not(controls, target, offset=0):
+        if cnot_mode == "borrowed":
+            # any other line of the oracle can be borrowed, whatever state it is in
+            ancillas = [q for q in range(highest_qubit_used + 1) if q not in controls and q != target]
+        else:
+            ancillas = scratch_qubits
+        # clauses start at different lines, so that the scheduler can run clauses on other variables in parallel
+        if ancillas:
+            offset %= len(ancillas)
+            ancillas = ancillas[offset:] + ancillas[:offset]
+        return multi_controlled_not(cnot_mode, controls, target, ancillas)
+
+    # each part is its own inverse, so the clauses are uncomputed by applying the parts in reverse order
+    clause_parts = []
+    offset = 0
+    for clause, qubit in zip(long_clauses, clause_qubits):
+        if cnot_mode == "borrowed":
+            literals = [(control_qubits[name], negated) for name, negated in clause]
+        else:
+            literals = clause_controls(clause)
+        positive = [line for line, negated in literals if not negated]
+        clause_parts += [flip(positive),
+                         controlled_not([line for line, _ in literals], qubit, offset),
+                         flip(positive),
+                         flip([qubit])]
+        offset += max(len(clause) - 2, 1)
+
+    negative = [qubit for qubit, negated in phase_literals if negated]
+    local_qasm = copy_qasm + [moment for part in clause_parts for moment in part]
+    local_qasm += [(Gate("H", (target_qubit,)),)] + \
+                  flip(negative) + \
+                  controlled_not([qubit for qubit, _ in phase_literals], target_qubit) + \
+                  flip(negative) + \
+                  [(Gate("H", (target_qubit,)),)]
+    local_qasm += [moment for part in clause_parts[::-1] for moment in part]
+    local_qasm += copy_qasm
+
+    return local_qasm, target_qubit, max(highest_qubit_used, target_qubit)
+
+
+def order_clauses_in_rounds(clauses):
+    """
+    Order clauses in rounds, where the clauses of a round share no variables and so can be computed at the same time.
+    Every round greedily takes the remaining clauses that do not share a variable with the ones it already has.
+
+    Args:
+        clauses: A list of clauses, each a tuple of (name, negated) literals (see cnf_clauses)
+
+    Returns: The same clauses, one round after the other
+    """
+    ordered = []
+    remaining = clauses
+    while remaining:
+        used = set()
+        postponed = []
+        for clause in remaining:
+            names = {name for name, _ in clause}
+            if names & used:
+                postponed.append(clause)
+            else:
+                used |= names
+                ordered.append(clause)
+        remaining = postponed
+    return ordered
+
+
+def cnf_clauses(expr):
+    """
+    Split a boolean expression in conjunctive normal form (an AND of ORs of variables and negated variables)
+    into its clauses. Use BooleanAlgebra.cnf to bring any other expression into this form.
+
+    Args:
+        expr: The boolean expression (instance of boolean.Expression, not a string)
+
+    Returns: A sorted list of distinct clauses, each a sorted tuple of (name, negated) literals
+    """
+    # BooleanAlgebra.cnf turns a formula that does not depend on its variables into the constant TRUE or FALSE
+    if isinstance(expr, BaseElement):
+        raise ValueError("Expression is always {}: {}".format("true" if expr else "false", expr))
+
+    clauses = set()
+    for clause in (expr.args if type(expr) == AND else [expr]):
+        literals = set()
+        for literal in (clause.args if type(clause) == OR else [clause]):
+            if type(literal) == NOT and type(literal.args[0]) == Symbol:
+                literals.add((literal.args[0], True))
+            elif type(literal) == Symbol:
+                literals.add((literal, False))
+            else:
+                raise ValueError("Expression is not in conjunctive normal form: {}".format(expr))
+
+        # a clause with both a variable and its negation is always true
+        if not any((name, not negated) in literals for name, negated in literals):
+            clauses.add(tuple(sorted(literals)))
+
+    if not clauses:
+        raise ValueError("Expression is always true: {}".format(expr))
+
+    return sorted(clauses)
+
+
+def generate_and(qubit_1, qubit_2, target_qubit):
+    """
+    Generate an AND in qasm code (just a Toffoli).
+    """
+    if qubit_1 == qubit_2:
+        return [(Gate("CNOT", (qubit_1, target_qubit)),)]
+
+    return [(Gate("Toffoli", (qubit_1, qubit_2, target_qubit)),)]
+
+
+def generate_or(qubit_1, qubit_2, target_qubit):
+    """
+    Generate an OR in qasm code (Toffoli with X gates).
+    """
+    if qubit_1 == qubit_2:
+        return [(Gate("CNOT", (qubit_1, target_qubit)),)]
+
+    local_qasm = [(Gate("X", (qubit_1,)), Gate("X", (qubit_2,)))]
+    local_qasm += generate_and(qubit_1, qubit_2, target_qubit)
+    local_qasm += [(Gate("X", (qubit_1,)), Gate("X", (qubit_2,)), Gate("X", (target_qubit,)))]
+    return local_qasm
 
 
 def generate_ksat_expression(n, m, k):
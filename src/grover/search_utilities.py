@@ -1,5 +1,14 @@
 import matplotlib.pyplot as plt
+import numpy as np
 import math
+from functools import lru_cache
+from src.grover.circuit import Gate, relabel
+from src.grover.histogram import Histogram, bit_string
+
+# the maximum number of cached templates per construction (see normal_n_size_cnot, n_size_crot, poly_n_size_crot)
+# templates only depend on the number of control bits, so plot sweeps hit the same few entries over and over
+# fancy_cnot is not cached: it is built in one pass anyway, and 64 of its 2^n sized templates could fill the memory
+template_cache_size = 64
 
 
 def apply(gate, qubit):
@@ -10,10 +19,10 @@ def apply(gate, qubit):
         gate: The gate to apply
         qubit: The target qubit
 
-    Returns: Valid QASM that represents this application
+    Returns: A list of moments that represents this application
 
     """
-    return "{} q[{}]\n".format(gate, qubit)
+    return [(Gate(gate, (qubit,)),)]
 
 
 def fill(character, data_qubits):
@@ -23,35 +32,38 @@ def fill(character, data_qubits):
         character: The QASM gate to apply
         data_qubits: The number of data qubits
 
-    Returns: Valid QASM to append to the program
+    Returns: A list of moments to append to the program
     """
-    # create a list of the qubit indices that need the gate applied
-    indices = ",".join(map(str, range(data_qubits)))
-
-    return "{} q[{}]\n".format(character, indices)
+    # a single moment in which every data qubit gets the gate applied
+    return [tuple(Gate(character, (i,)) for i in range(data_qubits))]
 
 
+@lru_cache(maxsize=template_cache_size)
 def normal_n_size_cnot(n, mode):
     """
     Generate a CNOT with n control bits.
     It is assumed the control bits have indices [0:n-1],
     and the target bit is at index [n].
+    The result is cached, use relabel to place it on other qubits.
 
     Args:
         n: The number of control bits
         mode: The method by which we will make CNOT gates
+              In "log depth" mode the Toffoli gates form a balanced tree, see log_depth_n_size_cnot
 
-    Returns: Valid QASM to append to the program
+    Returns: A tuple of moments to append to the program
     """
 
     if n == 1:
-        local_qasm = "CNOT q[0],q[1]\n"
+        local_qasm = [(Gate("CNOT", (0, 1)),)]
     elif n == 2:
         # if mode == "no toffoli":
         #     local_qasm = alternative_toffoli(0, 1, 2)
         # else:
-        #     local_qasm = "Toffoli q[0],q[1],q[2]\n"
-        local_qasm = "Toffoli q[0],q[1],q[2]\n"
+        #     local_qasm = [(Gate("Toffoli", (0, 1, 2)),)]
+        local_qasm = [(Gate("Toffoli", (0, 1, 2)),)]
+    elif mode == "log depth":
+        local_qasm = log_depth_n_size_cnot(n)
     else:
         # for n > 2, there is no direct instruction in QASM, so we must generate an equivalent circuit
         # the core idea of a large CNOT is that we must AND-gate together all the control bits
@@ -85,21 +97,64 @@ def normal_n_size_cnot(n, mode):
             # if mode == "no toffoli":
             #     gate_list.append(alternative_toffoli(a, b, target))
             # else:
-            #     gate_list.append("Toffoli q[{}],q[{}],q[{}]".format(a, b, target))
-            gate_list.append("Toffoli q[{}],q[{}],q[{}]".format(a, b, target))
+            #     gate_list.append(Gate("Toffoli", (a, b, target)))
+            gate_list.append(Gate("Toffoli", (a, b, target)))
 
         # Apply the complete list of gates in reverse after the target is flipped
         # This undoes all operations on the ancillary qubits (so they remain 0)
         gate_list = gate_list + gate_list[-2::-1]
-        local_qasm = "\n".join(gate_list) + "\n"
+        local_qasm = [(g,) for g in gate_list]
 
-    return local_qasm
+    return tuple(local_qasm)
+
+
+def log_depth_n_size_cnot(n):
+    """
+    Generate a CNOT with n > 2 control bits as a balanced tree of Toffoli gates.
+    Every level of the tree pairs up all remaining bits at once, so the Toffoli gates of a level are parallel.
+    This uses the same n-2 ancillary qubits and Toffoli count as normal_n_size_cnot,
+    but computing and uncomputing take O(log n) layers instead of O(n).
+    It is assumed the control bits have indices [0:n-1], the target bit is at index [n]
+    and the ancillary bits start at index [n+1].
+
+    Args:
+        n: The number of control bits
+
+    Returns: A list of moments, one per level of the tree
+    """
+    bits_to_and = list(range(n))
+    ancillary_count = 0
+    levels = []
+
+    # keep pairing until only the last two bits are left, those are combined onto the target
+    while len(bits_to_and) > 2:
+        level = []
+        next_bits = []
+        for i in range(0, len(bits_to_and) - 1, 2):
+            target = n + 1 + ancillary_count
+            ancillary_count += 1
+            level.append(Gate("Toffoli", (bits_to_and[i], bits_to_and[i + 1], target)))
+            next_bits.append(target)
+
+        # an odd bit out simply moves on to the next level
+        if len(bits_to_and) % 2 == 1:
+            next_bits.append(bits_to_and[-1])
+
+        levels.append(tuple(level))
+        bits_to_and = next_bits
+
+    final = (Gate("Toffoli", (bits_to_and[0], bits_to_and[1], n)),)
+
+    # undo all levels after the target is flipped, so the ancillary qubits remain 0
+    return levels + [final] + levels[::-1]
 
 
+@lru_cache(maxsize=template_cache_size)
 def n_size_crot(n, start_n, target, angle):
     """
     Generate a controlled rotation with n control bits without using Toffoli gates.
     It is assumed the control bits have indices [start_n : start_n + n-1].
+    The result is cached, which also avoids rebuilding the repeated sub-rotations in the recursion.
 
     Args:
         n: The number of control bits
@@ -111,14 +166,14 @@ def n_size_crot(n, start_n, target, angle):
                An angle of pi/4 gives an H-T-H gate
                Etc.
 
-    Returns: Valid QASM to append to the program
+    Returns: A tuple of moments to append to the program
     """
-    local_qasm = ""
+    local_qasm = []
 
     if n == 1:
         # Simply a CROT with the given angle
         local_qasm += apply("H", target)
-        local_qasm += "CR q[{}],q[{}],{}\n".format(start_n, target, angle)
+        local_qasm += [(Gate("CR", (start_n, target), angle),)]
         local_qasm += apply("H", target)
     else:
         # V gate using the lowest control bit
@@ -136,7 +191,130 @@ def n_size_crot(n, start_n, target, angle):
         # controlled V gate using highest as controls and lowest as target (new_angle = angle / 2)
         local_qasm += n_size_crot(n - 1, 0, target, angle / 2)
 
-    return local_qasm
+    return tuple(local_qasm)
+
+
+def dirty_n_size_cnot(controls, target, borrowed):
+    """
+    Generate a CNOT with n control bits as a ladder of Toffoli gates (Barenco et al. 1995, lemma 7.2).
+    The ladder needs n-2 extra qubits, but these may be in any state: they are borrowed and returned unchanged.
+
+    Args:
+        controls: The indices of the control bits
+        target: The index of the target bit
+        borrowed: The indices of at least n-2 other qubits, in an arbitrary state
+
+    Returns: A list of moments with 4(n-2) Toffoli gates
+    """
+    m = len(controls)
+    if m == 1:
+        return [(Gate("CNOT", (controls[0], target)),)]
+    elif m == 2:
+        return [(Gate("Toffoli", (controls[0], controls[1], target)),)]
+
+    a = borrowed[:m - 2]
+    if len(a) < m - 2:
+        raise ValueError("A CNOT with {} control bits needs {} borrowed qubits, got {}".format(m, m - 2, len(a)))
+
+    # each borrowed qubit a[j] is a stepping stone that gets the AND of controls[j + 1] and the stone below it
+    # the target is flipped twice, with and without the AND of all controls, so any junk cancels out
+    descending = [(Gate("Toffoli", (controls[j + 1], a[j - 1], a[j])),) for j in range(m - 3, 0, -1)]
+    half = [(Gate("Toffoli", (controls[m - 1], a[m - 3], target)),)] + \
+        descending + \
+        [(Gate("Toffoli", (controls[0], controls[1], a[0])),)] + \
+        descending[::-1]
+
+    # the second half restores the borrowed qubits
+    return half + half
+
+
+def one_dirty_n_size_cnot(controls, target, borrowed_qubit):
+    """
+    Generate a CNOT with n control bits using just one borrowed qubit (Barenco et al. 1995, corollary 7.4).
+    The controls are split in two halves, which each act as the borrowed qubits for the other half.
+
+    Args:
+        controls: The indices of the control bits
+        target: The index of the target bit
+        borrowed_qubit: The index of a qubit in an arbitrary state, which is returned unchanged
+
+    Returns: A list of moments with a number of gates that grows linearly in n
+    """
+    if len(controls) <= 2:
+        return dirty_n_size_cnot(controls, target, [])
+
+    first_half = controls[:(len(controls) + 1) // 2]
+    second_half = controls[(len(controls) + 1) // 2:]
+
+    # the borrowed qubit gets the AND of the first half, the target the AND of the second half and the borrowed qubit
+    # doing both twice leaves the borrowed qubit as it was, and flips the target by the AND of all controls
+    compute = dirty_n_size_cnot(first_half, borrowed_qubit, second_half + [target])
+    apply_target = dirty_n_size_cnot(second_half + [borrowed_qubit], target, first_half)
+    return compute + apply_target + compute + apply_target
+
+
+def borrowed_n_size_cnot(controls, target, borrowed):
+    """
+    Generate a CNOT with n control bits that uses borrowed (dirty) qubits instead of clean ancillary qubits.
+    The borrowed qubits may be in any state, and are returned in that same state.
+    The construction depends on how many qubits there are to borrow:
+        n-2 or more -> a single Toffoli ladder, 4(n-2) Toffoli gates
+        at least 1 -> two halves that borrow from each other, about 8n Toffoli gates
+        none -> the ancilla-free poly_n_size_crot, O(n^2) gates
+
+    Args:
+        controls: The indices of the control bits
+        target: The index of the target bit
+        borrowed: The indices of the qubits that may be borrowed
+
+    Returns: A list of moments to append to the program
+    """
+    if len(borrowed) >= len(controls) - 2:
+        return dirty_n_size_cnot(controls, target, borrowed)
+    elif len(borrowed) >= 1:
+        return one_dirty_n_size_cnot(controls, target, borrowed[0])
+    return relabel(poly_n_size_crot(len(controls), math.pi), controls + [target])
+
+
+@lru_cache(maxsize=template_cache_size)
+def poly_n_size_crot(n, angle):
+    """
+    Generate a controlled rotation with n control bits without using ancillary qubits, with O(n^2) gates.
+    This is the same recursion as n_size_crot, but the two (n-1)-controlled NOTs borrow the target bit
+    as an ancillary qubit, which makes them linear in size instead of recursive (Barenco et al. 1995, lemma 7.9).
+    It is assumed the control bits have indices [0:n-1], and the target bit is at index [n].
+    The result is cached, use relabel to place it on other qubits.
+
+    Args:
+        n: The number of control bits
+        angle: The angle in radians by which to shift the phase (see n_size_crot), pi gives a CNOT
+
+    Returns: A tuple of moments to append to the program
+    """
+    if n == 1:
+        return n_size_crot(1, 0, 1, angle)
+
+    highest = n - 1
+    others = list(range(n - 1))
+    pillar = one_dirty_n_size_cnot(others, highest, n)
+
+    local_qasm = []
+    # V gate using the lowest control bit
+    local_qasm += n_size_crot(1, highest, n, angle / 2)
+
+    # n-1 CNOT on highest bits
+    local_qasm += pillar
+
+    # V dagger gate on lowest two bits
+    local_qasm += n_size_crot(1, highest, n, -angle / 2)
+
+    # n-1 CNOT on highest bits
+    local_qasm += pillar
+
+    # controlled V gate using highest as controls and lowest as target
+    local_qasm += relabel(poly_n_size_crot(n - 1, angle / 2), others + [n])
+
+    return tuple(local_qasm)
 
 
 def alternative_toffoli(control_1, control_2, target):
@@ -148,46 +326,158 @@ def alternative_toffoli(control_1, control_2, target):
         control_2: Second control bit index
         target: Target bit index
 
-    Returns: Valid QASM that performs a CCNOT
+    Returns: A list of moments that performs a CCNOT
     """
 
-    local_qasm = ""
+    local_qasm = []
     local_qasm += apply("H", target)
-    local_qasm += "CR q[{}],q[{}],{}\n".format(control_2, target, math.pi / 2)
+    local_qasm += [(Gate("CR", (control_2, target), math.pi / 2),)]
     # local_qasm += apply("H", target)
 
-    local_qasm += "CNOT q[{}],q[{}]\n".format(control_1, control_2)
+    local_qasm += [(Gate("CNOT", (control_1, control_2)),)]
 
     # local_qasm += apply("H", target)
-    local_qasm += "CR q[{}],q[{}],{}\n".format(control_2, target, -math.pi / 2)
+    local_qasm += [(Gate("CR", (control_2, target), -math.pi / 2),)]
     # local_qasm += apply("H", target)
 
-    local_qasm += "CNOT q[{}],q[{}]\n".format(control_1, control_2)
+    local_qasm += [(Gate("CNOT", (control_1, control_2)),)]
 
     # local_qasm += apply("H", target)
-    local_qasm += "CR q[{}],q[{}],{}\n".format(control_1, target, math.pi / 2)
+    local_qasm += [(Gate("CR", (control_1, target), math.pi / 2),)]
     local_qasm += apply("H", target)
 
     return local_qasm
 
 
-def cnot_pillar(mode, data_qubits):
+def margolus_toffoli(control_1, control_2, target, inverse=False):
+    """
+    Generate a circuit that performs a Toffoli gate up to a relative phase (the Margolus gate).
+    The state |control_1=1, control_2=0, target=1> gets a phase of -1, but this only uses 3 CNOTs and 4 rotations.
+    A Margolus gate followed later by its inverse is exactly equal to two Toffoli gates,
+    as long as the gates in between only use these three qubits as controls.
+
+    Args:
+        control_1: First control bit index
+        control_2: Second control bit index
+        target: Target bit index
+        inverse: Whether to generate the inverse circuit instead, to uncompute an earlier Margolus gate
+
+    Returns: A list of moments that performs a CCNOT up to a relative phase
+    """
+
+    local_qasm = []
+    local_qasm += [(Gate("Ry", (target,), math.pi / 4),)]
+    local_qasm += [(Gate("CNOT", (control_2, target)),)]
+    local_qasm += [(Gate("Ry", (target,), math.pi / 4),)]
+    local_qasm += [(Gate("CNOT", (control_1, target)),)]
+    local_qasm += [(Gate("Ry", (target,), -math.pi / 4),)]
+    local_qasm += [(Gate("CNOT", (control_2, target)),)]
+    local_qasm += [(Gate("Ry", (target,), -math.pi / 4),)]
+
+    if inverse:
+        # reverse the order of the gates and the direction of the rotations
+        local_qasm = [tuple(g._replace(angle=-g.angle) if g.angle is not None else g for g in moment)
+                      for moment in local_qasm[::-1]]
+
+    return local_qasm
+
+
+def cnot_pillar(mode, data_qubits, borrowed=()):
     """
     Generate a common structure that applies a Hadamard, CNOT, and Hadamard again to the lowest data bit
 
-    Returns: Valid QASM to append to the program
+    Args:
+        mode: The method by which we will make CNOT gates
+        data_qubits: The number of data qubits
+        borrowed: Qubits outside the data qubits that "borrowed" mode may use in whatever state they are in
+
+    Returns: A list of moments to append to the program
     """
-    local_qasm = "H q[{}]\n".format(data_qubits - 1)
-    if mode in ["normal", "no toffoli"]:
+    local_qasm = apply("H", data_qubits - 1)
+    if mode in ["normal", "no toffoli", "log depth"]:
         local_qasm += normal_n_size_cnot(data_qubits - 1, mode)
     elif mode == "crot":
         local_qasm += n_size_crot(data_qubits - 1, 0, data_qubits - 1, math.pi)
     elif mode == "fancy cnot":
         local_qasm += fancy_cnot(data_qubits - 1)
-    local_qasm += "H q[{}]\n".format(data_qubits - 1)
+    elif mode == "poly crot":
+        local_qasm += poly_n_size_crot(data_qubits - 1, math.pi)
+    elif mode == "borrowed":
+        local_qasm += borrowed_n_size_cnot(list(range(data_qubits - 1)), data_qubits - 1, list(borrowed))
+    local_qasm += apply("H", data_qubits - 1)
     return local_qasm
 
 
+def iter_cnot_pillar(mode, data_qubits, borrowed=()):
+    """
+    Generate the same structure as cnot_pillar, but one moment at a time.
+    In "fancy cnot" mode the 2^n sized circuit is generated on the fly instead of being built as one tuple.
+
+    Args:
+        mode: The method by which we will make CNOT gates
+        data_qubits: The number of data qubits
+        borrowed: Qubits outside the data qubits that "borrowed" mode may use in whatever state they are in
+
+    Returns: A generator of moments
+    """
+    if mode != "fancy cnot":
+        yield from cnot_pillar(mode, data_qubits, borrowed)
+        return
+
+    yield from apply("H", data_qubits - 1)
+    yield from iter_fancy_cnot(data_qubits - 1)
+    yield from apply("H", data_qubits - 1)
+
+
+def multi_controlled_not(mode, controls, target, ancillas=()):
+    """
+    Generate a CNOT with any number of control bits on arbitrary qubits, by relabelling a template.
+
+    Args:
+        mode: The method by which we will make CNOT gates (see cnot_pillar)
+        controls: The indices of the control bits
+        target: The index of the target bit
+        ancillas: The indices of the ancillary bits, if the mode needs any (see ancillas_needed)
+
+    Returns: A list of moments to append to the program
+    """
+    n = len(controls)
+    if mode == "borrowed":
+        # this construction depends on how many qubits can be borrowed, so it is not a fixed template
+        return borrowed_n_size_cnot(list(controls), target, list(ancillas))
+    elif mode in ["normal", "no toffoli", "log depth"]:
+        template = normal_n_size_cnot(n, mode)
+    elif mode == "crot":
+        template = n_size_crot(n, 0, n, math.pi)
+    elif mode == "fancy cnot":
+        template = fancy_cnot(n)
+    elif mode == "poly crot":
+        template = poly_n_size_crot(n, math.pi)
+    else:
+        raise ValueError("Invalid value for MODE: {}".format(mode))
+
+    # templates have their controls at [0:n-1], the target at [n] and ancillas after that
+    mapping = list(controls) + [target] + list(ancillas)
+    if len(mapping) < n + 1 + ancillas_needed(mode, n):
+        raise ValueError("Mode '{}' needs {} ancillary bits for {} controls".format(mode, ancillas_needed(mode, n), n))
+    return relabel(template, mapping)
+
+
+def ancillas_needed(mode, n):
+    """
+    Calculate how many ancillary bits a CNOT with n control bits needs in the given mode.
+
+    Args:
+        mode: The method by which we will make CNOT gates (see cnot_pillar)
+        n: The number of control bits
+
+    Returns: The number of ancillary bits
+    """
+    if mode in ["normal", "no toffoli", "log depth"]:
+        return max(n - 2, 0)
+    return 0
+
+
 def search_oracle(search_term, data_qubits):
     """
     Generate a common structure that is used in the oracle circuit.
@@ -196,19 +486,12 @@ def search_oracle(search_term, data_qubits):
         search_term: The search term for which to generate an oracle
         data_qubits: The number of data qubits
 
-    Returns: Valid QASM to append to the program
+    Returns: A list of moments to append to the program
     """
     if "0" not in search_term:
-        return "\n"
+        return []
 
-    local_qasm = "X q["
-    for i in range(data_qubits):
-        if search_term[i] == "0":
-            local_qasm += str(i) + ","
-
-    # remove last comma and add closing bracket
-    local_qasm = local_qasm[:-1] + "]\n"
-    return local_qasm
+    return [tuple(Gate("X", (i,)) for i in range(data_qubits) if search_term[i] == "0")]
 
 
 def int_to_bits(int_str, qubit_count):
@@ -228,53 +511,43 @@ def int_to_bits(int_str, qubit_count):
     return str(bin(int(int_str)))[2:].zfill(qubit_count)
 
 
-def interpret_results(result_dict, qubit_count, data_qubits, plot=True):
+def interpret_results(result_dict, qubit_count, data_qubits, plot=True, dense=True):
     """
     Parse the result dictionary given by the API into a readable format, and plot it.
+    Only the bars returned by the API are looked at, so this stays fast for large numbers of ancillary qubits.
 
     Args:
         result_dict: The dictionary given by qi.execute_qasm
+        qubit_count: The total number of qubits used in the qasm program
+        data_qubits: The number of qubits used by Grover's Algorithm (aka non-ancillary)
         plot: Whether to plot the results in a bar chart
+        dense: Whether to return the full list of 2^qubit_count bars instead of the sparse Histogram
 
-    Returns: Parsed result
+    Returns: Parsed result, either a list of (name, probability) pairs or a Histogram (see src.grover.histogram)
     """
-
-    num_of_measurements = 2 ** qubit_count
-
-    # we still store the histogram bars in here, and later sort them in ascending order
-    ordered_bars = [None for _ in range(num_of_measurements)]
-
-    for i in range(num_of_measurements):
-        # find result in dictionary and add to list of bars
-        # zero-valued bars don't show up in the dictionary, hence the try-except
-        try:
-            bar = result_dict["histogram"][str(i)]
-        except KeyError:
-            bar = 0
-
-        # generate corresponding binary name (so "11" instead of "3")
-        name = int_to_bits(i, qubit_count)
-
-        ordered_bars[i] = (name, bar)
+    histogram = Histogram.from_result(result_dict, qubit_count, data_qubits)
 
     if plot:
-        for b in ordered_bars:
-            # check if the given bar has 0's for all the ancillary qubits
-            # if it does not, we assume it is irrelevant for the histogram, so we don't plot it
-            if int(b[0], 2) < 2 ** data_qubits:
-                plt.bar(b[0][-data_qubits:], b[1])
-            # if a result is returned where some ancillary qubits were not zero, we have a problem
-            elif b[1] != 0:
-                raise ValueError("\tNonzero result from 'impossible' measurement:\n"
-                                 "\tColumn {} has fraction {}. This means not all control bits were 0!".format(b[0],
-                                                                                                               b[1]))
+        # if a result is returned where some ancillary qubits were not zero, we have a problem
+        leaked = histogram.leaked() & (histogram.probabilities != 0)
+        if leaked.any():
+            i = np.flatnonzero(leaked)[0]
+            raise ValueError("\tNonzero result from 'impossible' measurement:\n"
+                             "\tColumn {} has fraction {}. This means not all control bits were 0!".format(
+                                 bit_string(histogram.indices[i], qubit_count), histogram.probabilities[i]))
+
+        # only the bars that have 0's for all the ancillary qubits are relevant for the histogram
+        for name, bar in histogram.dense(data_only=True):
+            plt.bar(name, bar)
 
         # set styling for the x-axis markers
         plt.xticks(fontsize=6, rotation=45, ha="right")
         plt.title("Measurements, q[0] is the last bit, ancillary qubits omitted")
         plt.show()
 
-    return ordered_bars
+    if dense:
+        return histogram.dense()
+    return histogram
 
 
 def gray_code(n):
@@ -284,71 +557,74 @@ def gray_code(n):
     Args:
         n: The size for each element in the Gray code
 
-    Returns: An array of strings forming a Gray code
+    Returns: A tuple of strings forming a Gray code
     """
 
     if n == 1:
-        return ["0", "1"]
+        return "0", "1"
     else:
         g_previous = gray_code(n - 1)
-        mirrored_paste = g_previous + g_previous[::-1]
-        g_current = mirrored_paste[:]
-        for i in range(2**n):
-            if i < 2**(n-1):
-                g_current[i] = g_current[i] + "0"
-            else:
-                g_current[i] = g_current[i] + "1"
-        return g_current
+        # the first half gets a 0 appended, the mirrored second half a 1
+        return tuple(g + "0" for g in g_previous) + tuple(g + "1" for g in g_previous[::-1])
 
 
 def fancy_cnot(n):
     """
     Generate a circuit equivalent to an n-bit CNOT.
     This avoids using Toffoli gates or ancillary qubits.
+    Use relabel to place it on other qubits.
     Args:
         n: Number of control bits
 
-    Returns: Valid QASM that represents a CNOT
+    Returns: A tuple of moments that represents a CNOT
 
     """
-    gray_code_list = gray_code(n)[1:]
-    local_qasm = apply("H", n)
+    return tuple(iter_fancy_cnot(n))
 
-    for i in range(len(gray_code_list)):
-        if i == 0:
-            local_qasm += "CR q[0],q[{}],{}\n".format(n, math.pi/(2**(n-1)))
-        else:
-            prev_gray = gray_code_list[i-1]
-            cur_gray = gray_code_list[i]
 
-            flip_idx = -1
-            for j in range(len(cur_gray)):
-                if cur_gray[j] != prev_gray[j]:
-                    flip_idx = j
-                    break
+def iter_fancy_cnot(n):
+    """
+    Generate the same circuit as fancy_cnot, but one moment at a time.
+    The Gray code is calculated on the fly (element i is i XOR (i >> 1), bit j being character j of gray_code),
+    so nothing of size 2^n is ever kept in memory.
 
-            last_1_bit_cur = len(cur_gray) - 1 - cur_gray[::-1].index("1")
-            last_1_bit_prev = len(prev_gray) - 1 - prev_gray[::-1].index("1")
+    Args:
+        n: Number of control bits
 
-            bit_a = flip_idx
+    Returns: A generator of moments that represents a CNOT
+    """
+    yield from apply("H", n)
+    yield (Gate("CR", (0, n), math.pi/(2**(n-1))),)
 
-            if flip_idx == last_1_bit_cur:
-                bit_b = last_1_bit_prev
-            else:
-                bit_b = last_1_bit_cur
+    prev_gray = 1
+    for i in range(2, 2**n):
+        cur_gray = i ^ (i >> 1)
 
-            control_bit = min(bit_a, bit_b)
-            target_bit = max(bit_a, bit_b)
+        # exactly one bit differs between neighbouring elements of a Gray code
+        flip_idx = (cur_gray ^ prev_gray).bit_length() - 1
 
-            local_qasm += "CNOT q[{}],q[{}]\n".format(control_bit, target_bit)
+        last_1_bit_cur = cur_gray.bit_length() - 1
+        last_1_bit_prev = prev_gray.bit_length() - 1
 
-            parity = cur_gray.count("1") % 2
-            if parity == 0:
-                angle = -math.pi/(2**(n-1))
-            else:
-                angle = math.pi/(2**(n-1))
+        bit_a = flip_idx
+
+        if flip_idx == last_1_bit_cur:
+            bit_b = last_1_bit_prev
+        else:
+            bit_b = last_1_bit_cur
 
-            local_qasm += "CR q[{}],q[{}],{}\n".format(target_bit, n, angle)
+        control_bit = min(bit_a, bit_b)
+        target_bit = max(bit_a, bit_b)
 
-    local_qasm += apply("H", n)
-    return local_qasm
+        yield (Gate("CNOT", (control_bit, target_bit)),)
+
+        parity = bin(cur_gray).count("1") % 2
+        if parity == 0:
+            angle = -math.pi/(2**(n-1))
+        else:
+            angle = math.pi/(2**(n-1))
+
+        yield (Gate("CR", (target_bit, n), angle),)
+        prev_gray = cur_gray
+
+    yield from apply("H", n)
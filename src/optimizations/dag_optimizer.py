@@ -0,0 +1,254 @@
+from collections import deque
+import math
+from src.grover.circuit import Gate, Subcircuit, Circuit, is_single_qubit
+
+# multi-qubit gates that annihilate when applied twice in a row
+# the value tells how many of the leading qubits are controls that may be given in any order
+self_inverse = {
+    "CNOT": 1,
+    "Toffoli": 2,
+    "CZ": 2,
+    "SWAP": 2
+}
+
+# gates whose angles can be added up when applied twice in a row
+# CR is a controlled phase, so it is symmetric in its two qubits
+mergeable = ["CR", "Rx", "Ry", "Rz"]
+
+
+def peephole_optimize(circuit, table):
+    """
+    Cancel and merge gates in every subcircuit, using a dependency DAG instead of adjacent lines.
+    Gates are combined whenever no other gate touches the same qubits in between,
+    and after each rewrite only the affected neighbourhood is checked again.
+
+    Args:
+        circuit: The Circuit to optimize
+        table: A dictionary of single-qubit gate sequences and their replacement, such as {"HXH": "Z"}
+
+    Returns: An equivalent Circuit in which no rule of the table (or gate cancellation) applies any more
+    """
+    subcircuits = [Subcircuit(sub.name, sub.iterations, peephole_optimize_moments(sub.moments, table))
+                   for sub in circuit.subcircuits]
+    return Circuit(circuit.qubit_count, subcircuits)
+
+
+def peephole_optimize_moments(moments, table):
+    """
+    Cancel and merge gates in a list of moments (see peephole_optimize).
+
+    Args:
+        moments: A list of moments
+        table: A dictionary of single-qubit gate sequences and their replacement, such as {"HXH": "Z"}
+
+    Returns: An equivalent list of moments
+    """
+    dag = GateDAG(moments)
+    dag.optimize(table)
+    return dag.to_moments()
+
+
+class GateDAG:
+    """
+    Dependency DAG of a list of moments.
+    Every gate is a node, and for every qubit it acts on a node knows the previous and next gate on that qubit.
+    Removing a node simply links its neighbours together, so the DAG can be rewritten in place.
+    """
+
+    def __init__(self, moments):
+        self.gates = []
+        self.moment_of = []
+        self.alive = []
+        self.prev = []
+        self.next = []
+        self.moment_count = len(moments)
+
+        last = {}
+        for moment_index, moment in enumerate(moments):
+            for g in moment:
+                node = len(self.gates)
+                self.gates.append(g)
+                self.moment_of.append(moment_index)
+                self.alive.append(True)
+                self.prev.append({})
+                self.next.append({})
+
+                # instructions without qubit operands (such as measure_all) act as a barrier
+                if len(g.qubits) == 0:
+                    last = {}
+
+                for q in g.qubits:
+                    p = last.get(q)
+                    self.prev[node][q] = p
+                    self.next[node][q] = None
+                    if p is not None:
+                        self.next[p][q] = node
+                    last[q] = node
+
+    def remove(self, node):
+        """
+        Remove a node from the DAG, linking its neighbours on every qubit together.
+
+        Args:
+            node: The index of the node to remove
+        """
+        self.alive[node] = False
+        for q in self.gates[node].qubits:
+            p, n = self.prev[node][q], self.next[node][q]
+            if p is not None:
+                self.next[p][q] = n
+            if n is not None:
+                self.prev[n][q] = p
+
+    def successor(self, node):
+        """
+        Find the node that directly follows the given node on all of its qubits.
+
+        Args:
+            node: The index of the node
+
+        Returns: The index of the successor, or None if the next gates differ per qubit
+        """
+        successors = {self.next[node][q] for q in self.gates[node].qubits}
+        if len(successors) != 1:
+            return None
+        return successors.pop()
+
+    def neighbourhood(self, nodes, depth):
+        """
+        Collect the nodes that precede the given nodes, up to a certain distance on each qubit.
+        After a rewrite these are the only nodes for which a new rule could start to match.
+
+        Args:
+            nodes: The nodes around which to look
+            depth: How many gates to walk back on every qubit
+
+        Returns: A list of node indices (including the given nodes)
+        """
+        found = []
+        for node in nodes:
+            if node is None:
+                continue
+            found.append(node)
+            for q in self.gates[node].qubits:
+                p = self.prev[node][q]
+                for _ in range(depth):
+                    if p is None:
+                        break
+                    found.append(p)
+                    p = self.prev[p][q]
+        return found
+
+    def optimize(self, table):
+        """
+        Apply the rewrite rules with a worklist until no rule applies any more.
+
+        Args:
+            table: A dictionary of single-qubit gate sequences and their replacement, such as {"HXH": "Z"}
+        """
+        largest = max(map(len, table))
+        worklist = deque(range(len(self.gates)))
+
+        while len(worklist) > 0:
+            node = worklist.popleft()
+            if not self.alive[node]:
+                continue
+
+            if is_single_qubit(self.gates[node]):
+                changed = self.match_sequence(node, table, largest)
+            else:
+                changed = self.match_pair(node)
+
+            worklist.extend(self.neighbourhood(changed, largest - 1))
+
+    def match_sequence(self, node, table, largest):
+        """
+        Try to replace the single-qubit gate sequence starting at this node using the table.
+
+        Args:
+            node: The first node of the sequence
+            table: A dictionary of single-qubit gate sequences and their replacement
+            largest: The length of the longest sequence in the table
+
+        Returns: A list of nodes around which the DAG changed
+        """
+        qubit = self.gates[node].qubits[0]
+
+        chain = [node]
+        while len(chain) < largest:
+            n = self.next[chain[-1]][qubit]
+            if n is None or not is_single_qubit(self.gates[n]):
+                break
+            chain.append(n)
+
+        # try the longest sequences first
+        for length in range(len(chain), 1, -1):
+            sequence = "".join(self.gates[n].name for n in chain[:length])
+            if sequence not in table:
+                continue
+
+            before, after = self.prev[node][qubit], self.next[chain[length - 1]][qubit]
+            for n in chain[1:length]:
+                self.remove(n)
+
+            # the replacement takes the place of the first gate, which had the qubit to itself in that moment
+            if table[sequence] == "":
+                self.remove(node)
+                return [before, after]
+            self.gates[node] = Gate(table[sequence], (qubit,))
+            return [node, after]
+
+        return []
+
+    def match_pair(self, node):
+        """
+        Try to cancel or merge this gate (a multi-qubit gate or a rotation) with the gate that directly follows it.
+
+        Args:
+            node: The node of the first gate
+
+        Returns: A list of nodes around which the DAG changed
+        """
+        first = self.gates[node]
+        other = self.successor(node)
+        if other is None:
+            return []
+        second = self.gates[other]
+
+        if first.name != second.name or set(first.qubits) != set(second.qubits):
+            return []
+
+        surrounding = [self.prev[node][q] for q in first.qubits] + [self.next[other][q] for q in first.qubits]
+
+        if first.name in self_inverse:
+            # the gates are only equal if the targets match, the controls may be given in any order
+            controls = self_inverse[first.name]
+            if first.qubits[controls:] != second.qubits[controls:]:
+                return []
+            self.remove(node)
+            self.remove(other)
+            return surrounding
+
+        if first.name in mergeable:
+            angle = first.angle + second.angle
+            self.remove(other)
+            # a full turn is the identity
+            if math.isclose(math.remainder(angle, 2 * math.pi), 0, abs_tol=1e-12):
+                self.remove(node)
+                return surrounding
+            self.gates[node] = Gate(first.name, first.qubits, angle)
+            return [node] + surrounding
+
+        return []
+
+    def to_moments(self):
+        """
+        Convert the DAG back into moments. Every remaining gate stays in the moment it came from.
+
+        Returns: A list of moments without empty moments
+        """
+        moments = [[] for _ in range(self.moment_count)]
+        for node in range(len(self.gates)):
+            if self.alive[node]:
+                moments[self.moment_of[node]].append(self.gates[node])
+        return [tuple(m) for m in moments if len(m) > 0]
@@ -1,4 +1,9 @@
-from src.grover.search_utilities import alternative_toffoli
+from src.grover.search_utilities import alternative_toffoli, margolus_toffoli
+from src.grover.circuit import Circuit, Subcircuit, render_qasm
+from src.grover.parser import parse_qasm
+from src.optimizations.dag_optimizer import peephole_optimize, peephole_optimize_moments
+from src.optimizations.scheduler import schedule, schedule_asap, circuit_depth
+from bisect import bisect_left, bisect_right
 # from src.optimizations.bruteforcer import *
 # optimizations = generate_optimization_dict()
 
@@ -8,458 +13,324 @@ optimizations = {
     "XX": "",
     "ZX": "Y"
 }
-largest_opt = 3
 
-forbidden = [
-    ".grover_loop",
-    "Toffoli",
-    "CNOT",
-    "CR"
-]
+# gates that do not change the computational basis state of any of their qubits
+diagonal_gates = ["Z", "S", "Sdag", "T", "Tdag", "CR", "CZ"]
 
+# the number of moments that streaming optimizations keep in memory at once
+stream_window = 4096
 
-def apply_optimizations(qasm, qubit_count, data_qubits):
+
+def apply_optimizations(circuit):
     """
-    Apply 3 types of optimization to the given QASM code:
+    Apply 2 types of optimization to the given circuit:
         Combine groups of gates, such as H-X-H, to faster equivalent gates, Z in this case.
-        Shift gates to be executed in parallel.
-        Clean QASM code itself (q[1,2,3] becomes q[1:3])
+        Schedule gates in parallel layers, so the circuit depth is as small as possible.
 
     Args:
-        qasm: Valid QASM code to optimize
-        qubit_count: The total number of qubits
-        data_qubits: The number of qubits that are not ancillaries
+        circuit: The Circuit to optimize
 
-    Returns: A equivalent piece of QASM with optimizations applied
+    Returns: An equivalent Circuit with optimizations applied
     """
 
-    # run "speed" mode until QASM does not change
-    prev_qasm = ""
-    while prev_qasm != qasm:
-        prev_qasm = qasm[:]
-        qasm = optimize(qasm, qubit_count, data_qubits, mode="speed")
-
-    # run "style" mode until QASM does not change
-    prev_qasm = ""
-    while prev_qasm != qasm:
-        prev_qasm = qasm[:]
-        qasm = optimize(qasm, qubit_count, data_qubits, mode="style")
-
-    prev_qasm = ""
-    while prev_qasm != qasm:
-        prev_qasm = qasm[:]
-        qasm = optimize_toffoli(qasm)
+    # combine and cancel gates in a single worklist pass over the dependency DAG
+    circuit = optimize(circuit, mode="speed")
 
-    # tidy up "ugly" optimized code
-    qasm = clean_code(qasm)
+    # move every gate to the earliest layer its qubits allow
+    circuit = optimize(circuit, mode="style")
 
-    return qasm
+    return circuit
 
 
-def remove_gate_from_line(local_qasm_line, gate_symbol, qubit_index):
+def optimize_qasm(qasm):
     """
-    Removes the application of a specific gate on a specific qubit.
+    Optimize a cQASM program given as text, for example one that was generated earlier or written by hand.
+    Since the program is parsed first, already optimized (q[0:3]) code can be optimized again.
 
     Args:
-        local_qasm_line: The line from which this call should be removed.
-        gate_symbol: The symbol representing the gate
-        qubit_index: The index of the target qubit
+        qasm: A valid cQASM program
 
-    Returns: The same line of QASM, with the gate removed.
+    Returns: An equivalent cQASM program with optimizations applied
     """
+    return render_qasm(apply_optimizations(parse_qasm(qasm)))
 
-    # if gate applied to single qubit, remove gate call entirely
-    single_application = "{} q[{}]".format(gate_symbol, qubit_index)
-    if single_application in local_qasm_line:
-        # if there is a parallel bar right
-        local_qasm_line = local_qasm_line.replace(single_application + " | ", "")
-        # else: if there is a parallel bar left
-        local_qasm_line = local_qasm_line.replace(" | " + single_application, "")
-        # else: if it is the only gate in parallelized brackets
-        local_qasm_line = local_qasm_line.replace("{" + single_application + "}", "")
-        # else: if it is not parellelized at all
-        local_qasm_line = local_qasm_line.replace(single_application, "")
 
-    # else remove just the number
-    else:
-        local_qasm_line = local_qasm_line.replace(",{},".format(qubit_index), ",")
-        local_qasm_line = local_qasm_line.replace("[{},".format(qubit_index), "[")
-        local_qasm_line = local_qasm_line.replace(",{}]".format(qubit_index), "]")
-
-    return local_qasm_line
+def stream_optimizations(circuit, window=stream_window):
+    """
+    Streaming counterpart of apply_optimizations, for circuits whose moments are generated lazily.
+    The optimizations are applied to a sliding window of moments, so memory use is bounded by the window size.
+    Gates can not be combined or moved across more than about half a window,
+    so the result may be slightly less optimized than that of apply_optimizations.
 
+    Args:
+        circuit: The Circuit to optimize, the moments of each subcircuit may be any iterable
+        window: The number of moments to optimize at once
 
-def add_gate_to_line(local_qasm_line, gate_symbol, qubit_index):
+    Returns: An equivalent Circuit in which the moments of each subcircuit are a generator
     """
-    Add in parallel the application of a gate on a qubit.
-    Args:
-        local_qasm_line: The existing line of QASM to add the gate in.
-        gate_symbol: The symbol representing the gate.
-        qubit_index: The index of the target qubit.
+    return stream_moments(circuit, optimize_window, window)
+
 
-    Returns: The same line of QASM with the gate added.
+def stream_replace_toffoli_with_alt(circuit, relative_phase=None, window=stream_window):
     """
+    Streaming counterpart of replace_toffoli_with_alt.
+    Compute/uncompute pairs are only recognised if both Toffoli gates are within the same window,
+    all other Toffoli gates get the exact replacement.
 
-    # if another operation is already called on this qubit, we have to put the new gate on a new line
-    if "[" + str(qubit_index) + "]" in local_qasm_line \
-            or "[" + str(qubit_index) + "," in local_qasm_line \
-            or "," + str(qubit_index) + "," in local_qasm_line \
-            or "," + str(qubit_index) + "]" in local_qasm_line:
-        local_qasm_line += "\n{} q[{}]\n".format(gate_symbol, qubit_index)
-
-    # if the line is not empty, we need to consider what's already present
-    elif local_qasm_line != "":
-        # a bracket indicates this line is parallelized with the { gate | gate | gate } syntax
-        if "{" in local_qasm_line:
-            # remove } from the line and add it back at the end
-            local_qasm_line = local_qasm_line.rstrip("}| \n") + \
-                              " | " + \
-                              "{} q[{}]".format(gate_symbol, qubit_index) + \
-                              "}\n"
-
-        # no bracket means we have to add the parallelization syntax ourselves
-        else:
-            local_qasm_line = "{" + local_qasm_line.rstrip("\n") + \
-                              " | " + \
-                              "{} q[{}]".format(gate_symbol, qubit_index) + "}\n"
+    Args:
+        circuit: The Circuit that contains Toffoli gates to replace, the moments of each subcircuit may be any iterable
+        relative_phase: Whether to use Margolus gates for compute/uncompute pairs, or None to decide for every window
+                        (see replace_toffoli_with_alt)
+        window: The number of moments to process at once
 
-    # else, if the line IS empty, we can just put this gate in directly
-    else:
-        local_qasm_line = "{} q[{}]\n".format(gate_symbol, qubit_index)
-    return local_qasm_line
+    Returns: An equivalent Circuit in which the moments of each subcircuit are a generator
+    """
+    return stream_moments(circuit, lambda moments: lower_toffoli_moments(moments, relative_phase), window)
 
 
-def remove_toffoli_from_line(local_qasm_line, qubit_1, qubit_2, target_qubit):
+def optimize_window(moments):
     """
-    Remove a specific Toffoli gate from a line of qasm.
+    Apply the same optimizations as apply_optimizations to a single list of moments.
 
     Args:
-        local_qasm_line: The line of qasm
-        qubit_1: The first control qubit of the Toffoli gate
-        qubit_2: The second control qubit
-        target_qubit: The target qubit
-
-    Returns: The same line of qasm without the Toffoli gate call
+        moments: A list of moments
 
+    Returns: An equivalent list of moments
     """
-    single_application = "Toffoli q[{}],q[{}],q[{}]".format(qubit_1, qubit_2, target_qubit)
-
-    # if there is a parallel bar right
-    local_qasm_line = local_qasm_line.replace(single_application + " | ", "")
-    # else: if there is a parallel bar left
-    local_qasm_line = local_qasm_line.replace(" | " + single_application, "")
-    # else: if it is the only gate in parallelized brackets
-    local_qasm_line = local_qasm_line.replace("{" + single_application + "}", "")
-    # else: if it is not parellelized at all
-    local_qasm_line = local_qasm_line.replace(single_application, "")
-    return local_qasm_line
+    return schedule_asap(peephole_optimize_moments(moments, optimizations))
 
 
-def add_toffoli_to_line(local_qasm_line, qubit_1, qubit_2, target_qubit):
+def stream_moments(circuit, func, window):
     """
-    Add a single Toffoli gate application to the given line of qasm.
+    Apply a function that transforms a list of moments to every subcircuit, a window of moments at a time.
 
     Args:
-        local_qasm_line: The line of qasm
-        qubit_1: The first control qubit
-        qubit_2: The second control qubit
-        target_qubit: The target qubit
+        circuit: The Circuit to transform, the moments of each subcircuit may be any iterable
+        func: A function that takes a list of moments and returns an equivalent list of moments
+        window: The number of moments to give to the function at once
 
-    Returns: The same line of qasm with the Toffoli gate added in parallel
+    Returns: A new Circuit in which the moments of each subcircuit are a generator
     """
+    subcircuits = [Subcircuit(sub.name, sub.iterations, windowed(sub.moments, func, window))
+                   for sub in circuit.subcircuits]
+    return Circuit(circuit.qubit_count, subcircuits)
 
-    single_application = "Toffoli q[{}],q[{}],q[{}]".format(qubit_1, qubit_2, target_qubit)
 
-    # if the line is not empty, we need to consider what's already present
-    if local_qasm_line != "":
-        # a bracket indicates this line is parallelized with the { gate_1 | gate_2 | gate_3 } syntax
-        if "{" in local_qasm_line:
-            # remove } from the line and add it back at the end
-            local_qasm_line = local_qasm_line.rstrip("}| \n") + \
-                              " | " + \
-                              single_application + \
-                              "}\n"
+def windowed(moments, func, window):
+    """
+    Apply a function that transforms a list of moments to a stream of moments, using a sliding window.
+    Whenever the window is full, it is transformed and its first half is passed on.
+    The second half stays, so gates near the edge can still be combined with the moments that follow.
 
-        # no bracket means we have to add the parallelization syntax ourselves
-        else:
-            local_qasm_line = "{" + local_qasm_line.rstrip("\n") + \
-                              " | " + \
-                              single_application + "}\n"
+    Args:
+        moments: Any iterable of moments
+        func: A function that takes a list of moments and returns an equivalent list of moments
+        window: The maximum number of moments to keep in memory
 
-    # else, if the line IS empty, we can just put this gate in directly
-    else:
-        local_qasm_line = single_application + "\n"
-    return local_qasm_line
+    Returns: A generator of moments
+    """
+    buffer = []
+    for moment in moments:
+        buffer.append(moment)
+        if len(buffer) >= window:
+            buffer = func(buffer)
+            done = max(len(buffer) - window // 2, 0)
+            yield from buffer[:done]
+            buffer = buffer[done:]
 
+    yield from func(buffer)
 
-def optimize(qasm, qubit_count, data_qubits, mode="speed"):
+
+def map_moments(circuit, func):
     """
-    Apply a single pass of performance-oriented optimizations to the given QASM.
+    Apply a function to the moments of every subcircuit.
+    Subcircuits act as a barrier: no gates are ever moved from one subcircuit to another.
 
     Args:
-        qasm: A valid QASM program to optimize.
-        qubit_count: The total number of qubits
-        data_qubits: The number of qubits that are not ancillaries
-        mode: Setting that determines the type of optimization:
-            "speed" -> combine gates into equivalent smaller gates
-            "style" -> parallelize gates for speedup and aesthetics
+        circuit: The Circuit to transform
+        func: A function that takes a list of moments and returns a new list of moments
 
-    Returns: Functionally the same QASM code, with one run of optimizations applied.
+    Returns: A new Circuit with the transformed moments, with empty moments removed
     """
+    subcircuits = []
+    for sub in circuit.subcircuits:
+        moments = [tuple(m) for m in func([list(m) for m in sub.moments]) if len(m) > 0]
+        subcircuits.append(Subcircuit(sub.name, sub.iterations, moments))
+    return Circuit(circuit.qubit_count, subcircuits)
 
-    qasm_lines = qasm.split("\n")
-    gates_applied = []
-    for i in range(qubit_count):
-        gates_applied.append([])
 
-    for qasm_line_index in range(len(qasm_lines)):
-        line = qasm_lines[qasm_line_index]
-        if len(line) == 0:
-            continue
-
-        gate = line.split()[0].lstrip("{")
-        if gate not in ["H", "X", "Y", "Z"]:
-            gate = "_"
-
-        if ":" in line:
-            raise ValueError("Optimizer does not work well with q[0:3] notation!\n"
-                             "Line: {}".format(line))
-
-        if "[" in line:
-            for element in line.split(" | "):
-                gate = element.split()[0].lstrip("{")
-                if gate not in ["H", "X", "Y", "Z"]:
-                    gate = "_"
-
-                alt_affected_qubits = []
-                for possibly_affected in range(qubit_count):
-                    hits = [
-                        ",{},".format(possibly_affected),
-                        "[{},".format(possibly_affected),
-                        ",{}]".format(possibly_affected),
-                        "[{}]".format(possibly_affected)
-                    ]
-                    if any(h in element for h in hits):
-                        alt_affected_qubits.append(possibly_affected)
-
-                for a in alt_affected_qubits:
-                    gates_applied[a].append((qasm_line_index, gate))
-        else:
-            for a in range(data_qubits):
-                gates_applied[a].append((qasm_line_index, gate))
-
-    for qubit_index in range(len(gates_applied)):
-        gates = gates_applied[qubit_index]
-        skip_counter = 0
-        for gate_index in range(len(gates)):
-            if skip_counter > 0:
-                skip_counter -= 1
-                continue
-
-            if mode == "speed":
-                for offset in range(0, largest_opt - 1):
-                    next_gates = "".join(map(lambda _: _[1], gates[gate_index:gate_index+largest_opt-offset]))
-                    if next_gates in optimizations:
-                        replacement = optimizations[next_gates]
-
-                        line_indices = list(map(lambda _: _[0], gates[gate_index:gate_index+largest_opt-offset]))
-                        # first, remove all gates that are to be replaced
-                        for idx, line_number in enumerate(line_indices):
-                            qasm_lines[line_number] = remove_gate_from_line(qasm_lines[line_number],
-                                                                            next_gates[idx],
-                                                                            qubit_index)
-
-                        # add replacement gate to first line index
-                        # unless there is no replacement gate, of course
-                        if replacement != "":
-                            qasm_lines[line_indices[0]] = add_gate_to_line(qasm_lines[line_indices[0]],
-                                                                           replacement,
-                                                                           qubit_index)
-
-                        # ensure we skip a few gates
-                        skip_counter += len(next_gates)
-
-            elif mode == "style":
-                # check if we can shift left to align with other gates
-                current_line, current_gate = gates[gate_index]
-                prev_line = current_line - 1
-
-                if any(f in qasm_lines[current_line] or f in qasm_lines[prev_line] for f in forbidden):
-                    continue
-                # if this or the previous line has a break statement, no shifting possible
-                if current_gate == "_" or (gates[gate_index - 1][1] == "_" and gates[gate_index - 1][0] == prev_line):
-                    continue
-
-                if qasm_lines[prev_line] == "":
-                    continue
-
-                # having passed these checks, we can try to actually shift
-                if current_gate in ["H", "X", "Y", "Z"] and str(qubit_index) not in qasm_lines[prev_line]:
-                    # remove from current line
-                    qasm_lines[current_line] = remove_gate_from_line(qasm_lines[current_line], current_gate, qubit_index)
-                    # add to left
-                    qasm_lines[prev_line] = add_gate_to_line(qasm_lines[prev_line], current_gate, qubit_index)
-
-    # remove blank lines
-    qasm_lines = list(filter(lambda x: x not in ["", "{}", " "], qasm_lines))
-    return "\n".join(qasm_lines).replace("\n\n", "\n")
-
-
-def optimize_toffoli(qasm):
+def optimize(circuit, mode="speed"):
     """
-    Specific style optimizer capable of left-shifting and annihilating Toffoli gates.
+    Apply performance-oriented optimizations to the given circuit.
 
     Args:
-        qasm: QASM to optimize
+        circuit: The Circuit to optimize.
+        mode: Setting that determines the type of optimization:
+            "speed" -> combine gates into equivalent smaller gates, until no more combinations are possible
+            "style" -> parallelize gates by scheduling each one in the earliest possible layer
 
-    Returns: Equivalent QASM with Toffoli gates optimized.
+    Returns: Functionally the same Circuit, with optimizations applied.
     """
+    if mode == "speed":
+        return peephole_optimize(circuit, optimizations)
+    elif mode == "style":
+        return schedule(circuit, strategy="asap")
+    raise ValueError("Invalid optimization mode: {} instead of 'speed' or 'style'".format(mode))
+
 
-    qasm_lines = qasm.split("\n")
-    for current_line_index in range(1, len(qasm_lines)):
-        cur_line = qasm_lines[current_line_index]
-        prev_line = qasm_lines[current_line_index - 1]
-        if "Toffoli" in cur_line and "Toffoli" in prev_line and ".grover_loop" not in prev_line:
-            # find all Toffoli triplets in both lines
-            prev_line_gates = prev_line.strip("{} |").split(" | ")
-            prev_line_toffolis = list(filter(lambda x: "Toffoli" in x, prev_line_gates))
-
-            cur_line_gates = cur_line.strip("{} |").split(" | ")
-            cur_line_toffolis = list(filter(lambda x: "Toffoli" in x, cur_line_gates))
-
-            any_updated = False
-            for c_t in cur_line_toffolis:
-                if any_updated:
-                    break
-
-                c_qubit_1, c_qubit_2, c_target_qubit = tuple(map(int, c_t.strip("Toffoli q[]").split("],q[")))
-                shiftable = True
-
-                for p_t in prev_line_toffolis:
-                    p_qubit_1, p_qubit_2, p_target_qubit = tuple(map(int, p_t.strip("Toffoli q[]").split("],q[")))
-
-                    if {c_qubit_1, c_qubit_2} == {p_qubit_1, p_qubit_2} and c_target_qubit == p_target_qubit:
-                        # remove toffolis from both lines
-                        cur_line = remove_toffoli_from_line(cur_line, c_qubit_1, c_qubit_2, c_target_qubit)
-                        prev_line = remove_toffoli_from_line(prev_line, p_qubit_1, p_qubit_2, p_target_qubit)
-                        shiftable = False
-                        any_updated = True
-                        break
-                    elif len({c_qubit_1, c_qubit_2, c_target_qubit}.intersection(
-                            {p_qubit_1, p_qubit_2, p_target_qubit})) != 0:
-                        shiftable = False
-                        break
-
-                # check if anything has blocked us from shifting left
-                if shiftable:
-                    # otherwise we can go!
-                    cur_line = remove_toffoli_from_line(cur_line, c_qubit_1, c_qubit_2, c_target_qubit)
-                    prev_line = add_toffoli_to_line(prev_line, c_qubit_1, c_qubit_2, c_target_qubit)
-
-                    any_updated = True
-
-            if any_updated:
-                qasm_lines[current_line_index] = cur_line
-                qasm_lines[current_line_index - 1] = prev_line
-
-    # remove blank lines
-    qasm_lines = list(filter(lambda x: x not in ["", "{}", " "], qasm_lines))
-    return "\n".join(qasm_lines).replace("\n\n", "\n")
-
-
-def replace_toffoli_with_alt(qasm):
+def replace_toffoli_with_alt(circuit, relative_phase=None):
     """
     Replace all Toffoli gates (including parallelized ones) by their alternative representation.
     See src.grover.search_utilies.alternative_toffoli for more details.
 
     Args:
-        qasm: The full qasm program that contains Toffoli gates to replace
+        circuit: The full Circuit that contains Toffoli gates to replace
+        relative_phase: Whether to use the cheaper Margolus gate (see src.grover.search_utilities.margolus_toffoli)
+                        for Toffoli gates that are computed and later uncomputed, such as those on ancillary qubits.
+                        None uses them in every subcircuit where they do not make it deeper (see lower_toffoli_moments)
 
-    Returns: The same qasm with Toffoli gates replaced.
+    Returns: The same Circuit with Toffoli gates replaced.
     """
-    qasm_lines = qasm.split("\n")
-    for current_line_index in range(len(qasm_lines)):
-        cur_line = qasm_lines[current_line_index]
-        if "Toffoli" in cur_line:
-            # find all Toffoli triplets in this line
+    return map_moments(circuit, lambda moments: lower_toffoli_moments(moments, relative_phase))
 
-            cur_line_gates = cur_line.strip("{} |").split(" | ")
-            cur_line_toffolis = list(filter(lambda x: "Toffoli" in x, cur_line_gates))
 
-            multiple = len(cur_line_toffolis) > 1
+def lower_toffoli_moments(moments, relative_phase=None):
+    """
+    Replace the Toffoli gates in a list of moments, with or without Margolus gates (see replace_toffoli_with_alt).
+    A Margolus gate has 3 instead of 5 two-qubit gates, but uses its target in every moment, so in some circuits
+    the exact replacement can be scheduled in fewer layers.
 
-            line_strings = []
-            for i in range(7):
-                if multiple:
-                    line_strings.append("{")
-                else:
-                    line_strings.append("")
+    Args:
+        moments: A list of moments, each a list of gates
+        relative_phase: Whether to use Margolus gates for compute/uncompute pairs, or None to use them
+                        unless that makes the moments deeper (after optimization) than the exact replacement
 
-            for current_t in cur_line_toffolis:
-                qubit_1, qubit_2, target_qubit = tuple(map(int, current_t.strip("Toffoli q[]").split("],q[")))
-                alt_qasm_lines = alternative_toffoli(qubit_1, qubit_2, target_qubit).split("\n")
-                for j in range(7):
-                    line_strings[j] += alt_qasm_lines[j]
-                    if multiple:
-                        line_strings[j] += " | "
+    Returns: A new list of moments without Toffoli gates
+    """
+    pairs = find_uncompute_pairs(moments) if relative_phase is not False else {}
+    if relative_phase is not None or len(pairs) == 0:
+        return replace_toffoli_moments(moments, pairs)
 
-            if multiple:
-                for i in range(7):
-                    line_strings[i] = line_strings[i][:-3] + "}"
+    exact = replace_toffoli_moments(moments, {})
+    relative = replace_toffoli_moments(moments, pairs)
+    if len(optimize_window(relative)) <= len(optimize_window(exact)):
+        return relative
+    return exact
 
-            cur_line = "\n".join(line_strings)
 
-            qasm_lines[current_line_index] = cur_line
+def uses_as_control(gate, qubit):
+    """
+    Check whether a gate leaves the computational basis state of a qubit alone, for example because it is a control.
 
-    # remove blank lines
-    qasm_lines = list(filter(lambda x: x not in ["", "{}", " "], qasm_lines))
-    return "\n".join(qasm_lines).replace("\n\n", "\n")
+    Args:
+        gate: The Gate record
+        qubit: The index of the qubit
 
+    Returns: True if the gate is diagonal on this qubit, or only uses it as a control
+    """
+    if gate.name in ["CNOT", "Toffoli"]:
+        return qubit in gate.qubits[:-1]
+    return gate.name in diagonal_gates
 
-def clean_code(qasm):
+
+def find_uncompute_pairs(moments):
     """
-    Clean given QASM by rewriting each line to a more readable format.
-    For example, "{ X q[0] | H q[3,4,5] | X q[1] | X q[2] }"
-    Would become "{ X q[0:2] | H q[3:5]"
+    Find pairs of equal Toffoli gates where the second one uncomputes the first.
+    This is the case when all gates in between only use the three qubits as controls,
+    which is the pattern of the ancillary qubits in normal_n_size_cnot and the SAT oracles.
 
     Args:
-        qasm: Valid QASM code to clean
+        moments: A list of moments
+
+    Returns: A dictionary that maps (moment index, qubits) of every paired Toffoli to "compute" or "uncompute"
+    """
+    # flatten the moments, and keep a list of gate positions for every qubit
+    positions = []
+    wires = {}
+    for moment_index, moment in enumerate(moments):
+        for g in moment:
+            for q in g.qubits:
+                wires.setdefault(q, []).append(len(positions))
+            positions.append((moment_index, g))
+
+    def wire_is_control(qubit, start, end):
+        # check all gates on this qubit strictly between the two positions
+        wire = wires[qubit]
+        for k in wire[bisect_right(wire, start):bisect_left(wire, end)]:
+            if not uses_as_control(positions[k][1], qubit):
+                return False
+        return True
+
+    pairs = {}
+    for i, (moment_index, g) in enumerate(positions):
+        if g.name != "Toffoli" or (moment_index, g.qubits) in pairs:
+            continue
+
+        # walk along the target to find the Toffoli that uncomputes this one
+        control_1, control_2, target = g.qubits
+        wire = wires[target]
+        for j in wire[bisect_right(wire, i):]:
+            other_index, other = positions[j]
+            if other.name == "Toffoli" and other.qubits[2] == target and {control_1, control_2} == set(other.qubits[:2]):
+                if wire_is_control(control_1, i, j) and wire_is_control(control_2, i, j):
+                    pairs[(moment_index, g.qubits)] = "compute"
+                    pairs[(other_index, other.qubits)] = "uncompute"
+                break
+            if not uses_as_control(other, target):
+                break
 
-    Returns: The same QASM code with improved formatting.
+    return pairs
+
+
+def replace_toffoli_moments(moments, pairs):
     """
+    Replace the Toffoli gates in a list of moments (see replace_toffoli_with_alt).
 
-    qasm_lines = qasm.split("\n")
-    for idx in range(len(qasm_lines)):
-        line = qasm_lines[idx]
-        gate_dict = {}
-        new_line = ""
-        if "Toffoli" not in line and "CR" not in line and "CNOT" not in line and ("{" in line or "," in line):
-            line = line.strip("{}")
-            elements = line.split("|")
-            for e in elements:
-                gate, target = e.split()
-                indices = list(map(int, target.strip("q[]").split(",")))
-                if gate not in gate_dict:
-                    gate_dict[gate] = indices
-                else:
-                    gate_dict[gate] += indices
-
-            parallel = len(gate_dict.keys()) > 1
-            if parallel:
-                new_line += "{ "
-            for gate, indices in gate_dict.items():
-                if max(indices) - min(indices) + 1 == len(indices) > 1:
-                    new_line += "{} q[{}:{}]".format(gate, min(indices), max(indices))
-                else:
-                    new_line += "{} q[{}]".format(gate, ",".join(map(str, indices)))
-                new_line += " | "
+    Args:
+        moments: A list of moments, each a list of gates
+        pairs: The result of find_uncompute_pairs, Toffoli gates in here are replaced by Margolus gates
 
-            new_line = new_line[:-3]
-            if parallel:
-                new_line += " }"
+    Returns: A new list of moments without Toffoli gates
+    """
+    new_moments = []
+    # the last moment in which every qubit was used
+    last_used = {}
+    # the control order of every Margolus gate that has not been uncomputed yet, by target and controls
+    orders = {}
+    for moment_index, moment in enumerate(moments):
+        toffolis = [g for g in moment if g.name == "Toffoli"]
+        if len(toffolis) == 0:
+            new_moments.append(moment)
         else:
-            new_line = line
+            # all alternative circuits have the same length, so parallel Toffolis stay parallel
+            # any other gates in this moment are kept in the first of the new moments
+            replaced = [[g for g in moment if g.name != "Toffoli"]]
+            for t in toffolis:
+                role = pairs.get((moment_index, t.qubits))
+                control_1, control_2, target = t.qubits
+                key = (target, frozenset((control_1, control_2)))
+                if role is None:
+                    alt_moments = alternative_toffoli(control_1, control_2, target)
+                elif role == "compute":
+                    # the first control is only used halfway through a Margolus gate, so give it the control that
+                    # is ready last, which lets the scheduler overlap this gate with the one that computes it
+                    if last_used.get(control_2, -1) > last_used.get(control_1, -1):
+                        control_1, control_2 = control_2, control_1
+                    orders[key] = (control_1, control_2)
+                    alt_moments = margolus_toffoli(control_1, control_2, target)
+                else:
+                    # the relative phases only cancel if the uncompute uses the same control order
+                    control_1, control_2 = orders.pop(key)
+                    alt_moments = margolus_toffoli(control_1, control_2, target, inverse=True)
+                while len(replaced) < len(alt_moments):
+                    replaced.append([])
+                for j in range(len(alt_moments)):
+                    replaced[j] += alt_moments[j]
+
+            new_moments += replaced
 
-        qasm_lines[idx] = new_line
+        for g in moment:
+            for q in g.qubits:
+                last_used[q] = moment_index
 
-    return "\n".join(qasm_lines)
+    return new_moments
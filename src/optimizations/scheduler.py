@@ -0,0 +1,83 @@
+from src.grover.circuit import Circuit, Subcircuit
+
+
+def schedule(circuit, strategy="asap"):
+    """
+    Reschedule every subcircuit so that each gate is placed in the earliest (or latest) layer its qubits allow.
+    Every layer becomes a single { a | b | c } line when rendered.
+    Subcircuits act as a barrier: no gates are ever moved from one subcircuit to another.
+
+    Args:
+        circuit: The Circuit to schedule
+        strategy: "asap" to put gates as early as possible, "alap" to put them as late as possible
+
+    Returns: An equivalent Circuit with the minimal number of moments for the given gate order
+    """
+    if strategy == "asap":
+        schedule_func = schedule_asap
+    elif strategy == "alap":
+        schedule_func = schedule_alap
+    else:
+        raise ValueError("Invalid scheduling strategy: {} instead of 'asap' or 'alap'".format(strategy))
+
+    subcircuits = [Subcircuit(sub.name, sub.iterations, schedule_func(sub.moments)) for sub in circuit.subcircuits]
+    return Circuit(circuit.qubit_count, subcircuits)
+
+
+def schedule_asap(moments):
+    """
+    Assign every gate to the first layer after the last gate on any of its qubits.
+
+    Args:
+        moments: A list of moments
+
+    Returns: A list of layers (moments), as short as the dependencies between the gates allow
+    """
+    layers = []
+    # the first layer in which each qubit is free
+    ready = {}
+    # gates without qubit operands (such as measure_all) act on everything, so nothing may pass them
+    barrier = 0
+
+    for moment in moments:
+        for g in moment:
+            if len(g.qubits) == 0:
+                layer = max([barrier] + list(ready.values()))
+                barrier = layer + 1
+            else:
+                layer = max([barrier] + [ready.get(q, 0) for q in g.qubits])
+
+            while len(layers) <= layer:
+                layers.append([])
+            layers[layer].append(g)
+
+            for q in g.qubits:
+                ready[q] = layer + 1
+
+    return [tuple(layer) for layer in layers]
+
+
+def schedule_alap(moments):
+    """
+    Assign every gate to the last layer before the next gate on any of its qubits.
+
+    Args:
+        moments: A list of moments
+
+    Returns: A list of layers (moments), as short as the dependencies between the gates allow
+    """
+    # scheduling the reversed circuit as early as possible is the same as scheduling this one as late as possible
+    reversed_layers = schedule_asap([tuple(reversed(m)) for m in reversed(moments)])
+    return [tuple(reversed(layer)) for layer in reversed(reversed_layers)]
+
+
+def circuit_depth(circuit):
+    """
+    Calculate the depth of a circuit: the number of layers that is executed, including repeated subcircuits.
+
+    Args:
+        circuit: The Circuit to measure
+
+    Returns: The total number of layers that is executed
+    """
+    return sum(sub.iterations * len(sub.moments) for sub in circuit.subcircuits)
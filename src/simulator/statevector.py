@@ -0,0 +1,581 @@
+from collections import namedtuple
+import itertools
+import numpy as np
+import math
+import time
+from src.grover.parser import parse_qasm
+from src.grover.histogram import SearchScorer
+from src.grover.analytic import grover_iterations
+from src.optimizations.optimizer import find_uncompute_pairs, uses_as_control
+
+sqrt_half = 1 / math.sqrt(2)
+
+# 2x2 matrices of the single-qubit gates that do not take an angle
+single_qubit_matrices = {
+    "I": np.array([[1, 0], [0, 1]]),
+    "H": np.array([[sqrt_half, sqrt_half], [sqrt_half, -sqrt_half]]),
+    "X": np.array([[0, 1], [1, 0]]),
+    "Y": np.array([[0, -1j], [1j, 0]]),
+    "Z": np.array([[1, 0], [0, -1]]),
+    "S": np.array([[1, 0], [0, 1j]]),
+    "Sdag": np.array([[1, 0], [0, -1j]]),
+    "T": np.array([[1, 0], [0, np.exp(1j * math.pi / 4)]]),
+    "Tdag": np.array([[1, 0], [0, np.exp(-1j * math.pi / 4)]])
+}
+
+# instructions that do not change the state vector, so they can be skipped
+ignored_instructions = ["measure", "measure_all", "measure_z", "display", "barrier"]
+
+# probabilities below this value are rounding errors, and are left out of the histogram
+probability_cutoff = 1e-12
+
+# the largest number of general single-qubit gates that is applied in one pass, as a 2^n x 2^n matrix
+# beyond 4 the matrix multiplication starts to cost more than the memory traffic it saves
+fusion_width = 4
+
+# matrix elements smaller than this are rounding errors, for example in the product H H
+fusion_tolerance = 1e-12
+
+# kernels are applied to chunks of 2^chunk_qubits amplitudes at a time
+# 2^16 complex128 amplitudes take 1 MB, so every pass of a kernel over a chunk stays in the cache
+default_chunk_qubits = 16
+
+# A group of single-qubit gates on distinct qubits that is applied together (see compile_layer).
+# diagonal is a list of (qubit, d0, d1) tuples, applied as one multiplication with their outer product,
+# flips is a list of qubits that are all flipped in one pass,
+# and general is a list of (qubits, tensor) pairs with the fused matrix of up to fusion_width qubits.
+Layer = namedtuple("Layer", ["diagonal", "flips", "general"])
+
+
+def rotation_matrix(name, angle):
+    """
+    Generate the 2x2 matrix of a rotation gate.
+
+    Args:
+        name: "Rx", "Ry" or "Rz"
+        angle: The angle in radians
+
+    Returns: A 2x2 NumPy array
+    """
+    c, s = math.cos(angle / 2), math.sin(angle / 2)
+    if name == "Rx":
+        return np.array([[c, -1j * s], [-1j * s, c]])
+    elif name == "Ry":
+        return np.array([[c, -s], [s, c]])
+    elif name == "Rz":
+        return np.array([[c - 1j * s, 0], [0, c + 1j * s]])
+    raise ValueError("Unknown rotation gate: {}".format(name))
+
+
+def select(state, qubit_count, fixed):
+    """
+    Take a view of the state vector in which some qubits have a fixed value.
+    Since this only uses slices, writing to the view changes the state itself (even if every qubit is fixed).
+    Qubit q is axis qubit_count - 1 - q, so that bit q of a flattened index is the value of qubit q.
+
+    Args:
+        state: The state vector, with one axis of size 2 per qubit
+        qubit_count: The number of qubits
+        fixed: A dictionary that maps qubit indices to 0 or 1
+
+    Returns: A view of the state vector in which the axes of the fixed qubits have size 1
+    """
+    index = [slice(None)] * qubit_count
+    for q, bit in fixed.items():
+        index[qubit_count - 1 - q] = slice(bit, bit + 1)
+    return state[tuple(index)]
+
+
+def apply_matrix(state, qubit_count, matrix, target, controls=()):
+    """
+    Apply a (controlled) single-qubit gate to the state vector in place.
+    Only the amplitudes where all controls are 1 are touched, and no full-size matrix is ever built.
+
+    Args:
+        state: The state vector, with one axis of size 2 per qubit
+        qubit_count: The number of qubits
+        matrix: The 2x2 matrix of the gate
+        target: The index of the target qubit
+        controls: The indices of the control qubits
+    """
+    fixed = {c: 1 for c in controls}
+    fixed[target] = 0
+    zero = select(state, qubit_count, fixed)
+    fixed[target] = 1
+    one = select(state, qubit_count, fixed)
+
+    (a, b), (c, d) = matrix
+    if b == 0 and c == 0:
+        # diagonal gates only need a multiplication
+        if a != 1:
+            zero *= a
+        if d != 1:
+            one *= d
+    elif a == 0 and d == 0 and b == 1 and c == 1:
+        # an X gate only swaps the amplitudes
+        swap = zero.copy()
+        zero[...] = one
+        one[...] = swap
+    else:
+        new_zero = a * zero + b * one
+        one[...] = c * zero + d * one
+        zero[...] = new_zero
+
+
+def apply_gate(state, qubit_count, gate):
+    """
+    Apply a single gate record to the state vector in place.
+
+    Args:
+        state: The state vector, with one axis of size 2 per qubit
+        qubit_count: The number of qubits
+        gate: The Gate record to apply
+    """
+    name, qubits = gate.name, gate.qubits
+
+    if name in single_qubit_matrices:
+        apply_matrix(state, qubit_count, single_qubit_matrices[name], qubits[0])
+    elif name in ["Rx", "Ry", "Rz"]:
+        apply_matrix(state, qubit_count, rotation_matrix(name, gate.angle), qubits[0])
+    elif name in ["CNOT", "Toffoli"]:
+        apply_matrix(state, qubit_count, single_qubit_matrices["X"], qubits[-1], qubits[:-1])
+    elif name == "CZ":
+        apply_matrix(state, qubit_count, single_qubit_matrices["Z"], qubits[-1], qubits[:-1])
+    elif name == "CR":
+        # a controlled phase only changes the amplitudes where both qubits are 1
+        select(state, qubit_count, {qubits[0]: 1, qubits[1]: 1})[...] *= np.exp(1j * gate.angle)
+    elif name == "SWAP":
+        one_zero = select(state, qubit_count, {qubits[0]: 1, qubits[1]: 0})
+        zero_one = select(state, qubit_count, {qubits[0]: 0, qubits[1]: 1})
+        swap = one_zero.copy()
+        one_zero[...] = zero_one
+        zero_one[...] = swap
+    elif name not in ignored_instructions:
+        raise ValueError("The local simulator does not support gate '{}'".format(name))
+
+
+def gate_matrix(gate):
+    """
+    Find the 2x2 matrix of a single-qubit gate.
+
+    Args:
+        gate: The Gate record
+
+    Returns: A 2x2 NumPy array, or None if this is not a single-qubit gate the simulator knows
+    """
+    if len(gate.qubits) != 1:
+        return None
+    if gate.name in single_qubit_matrices:
+        return single_qubit_matrices[gate.name]
+    if gate.name in ["Rx", "Ry", "Rz"]:
+        return rotation_matrix(gate.name, gate.angle)
+    return None
+
+
+def compile_moments(moments, clean=(), layer_width=default_chunk_qubits):
+    """
+    Compile a list of moments into a list of kernels that can be replayed on the state vector.
+    Runs of single-qubit gates on the same qubit are multiplied into one matrix (so H X H becomes a single Z),
+    and the fused gates on distinct qubits are collected into layers that each take one pass over the state.
+    Single-qubit gates are only applied once a multi-qubit gate needs their qubit, which is allowed
+    because gates on other qubits commute with them.
+
+    Every kernel also gets the set of qubits that are provably |0> while it runs, so it can skip the half of
+    the state in which they are 1. A qubit is clean until a gate changes its basis state, and becomes clean
+    again when the Toffoli that computed it is uncomputed (see find_uncompute_pairs), which is how the
+    ancillary qubits of the generated circuits are used.
+
+    Args:
+        moments: A list of moments
+        clean: The qubits that are |0> before the first moment
+        layer_width: The largest number of qubits in a layer, so that enough other qubits are left to chunk over
+
+    Returns: A tuple of the following values:
+        - kernels: A list of (kernel, clean qubits) pairs, where a kernel is either a Layer or a multi-qubit Gate
+        - clean: The set of qubits that are |0> after the last moment
+    """
+    kernels = []
+    # the product of the single-qubit gates on each qubit that have not been applied yet
+    pending = {}
+    clean = set(clean)
+    # the clean targets of compute Toffolis, which are clean again after their uncompute Toffoli
+    computed = set()
+    pairs = find_uncompute_pairs(moments) if len(clean) > 0 else {}
+
+    def flush(qubits):
+        matrices = [(q, pending.pop(q)) for q in qubits if q in pending]
+        for i in range(0, len(matrices), layer_width):
+            layer = compile_layer(matrices[i:i + layer_width])
+            kernels.append((layer, frozenset(clean.difference(kernel_qubits(layer)))))
+
+    for moment_index, moment in enumerate(moments):
+        for g in moment:
+            if g.name in ignored_instructions:
+                continue
+
+            matrix = gate_matrix(g)
+            if matrix is not None:
+                q = g.qubits[0]
+                pending[q] = matrix @ pending[q] if q in pending else matrix
+            else:
+                flush(g.qubits)
+                kernels.append((g, frozenset(clean.difference(g.qubits))))
+
+            role = pairs.get((moment_index, g.qubits))
+            target = g.qubits[-1] if len(g.qubits) > 0 else None
+            if role == "compute" and target in clean:
+                computed.add(target)
+            elif role == "uncompute" and target in computed:
+                computed.remove(target)
+                clean.add(target)
+                continue
+
+            for q in g.qubits:
+                if not uses_as_control(g, q):
+                    clean.discard(q)
+
+    flush(sorted(pending))
+    return kernels, clean
+
+
+def compile_layer(matrices):
+    """
+    Sort fused single-qubit matrices on distinct qubits by the cheapest way to apply them.
+
+    Args:
+        matrices: A list of (qubit, 2x2 matrix) pairs
+
+    Returns: A Layer
+    """
+    diagonal, flips, general = [], [], []
+    for q, matrix in matrices:
+        (a, b), (c, d) = np.where(abs(matrix) < fusion_tolerance, 0, matrix)
+        if b == 0 and c == 0:
+            # the identity (such as H H) does not need to be applied at all
+            if abs(a - 1) > fusion_tolerance or abs(d - 1) > fusion_tolerance:
+                diagonal.append((q, a, d))
+        elif a == 0 and d == 0:
+            # an anti-diagonal matrix is X diag(c, b): a phase followed by a flip
+            if abs(c - 1) > fusion_tolerance or abs(b - 1) > fusion_tolerance:
+                diagonal.append((q, c, b))
+            flips.append(q)
+        else:
+            general.append((q, matrix))
+
+    chunks = []
+    for i in range(0, len(general), fusion_width):
+        chunk = general[i:i + fusion_width]
+        tensor = chunk[0][1]
+        for _, matrix in chunk[1:]:
+            tensor = np.kron(tensor, matrix)
+        # one axis for every output qubit, followed by one for every input qubit
+        chunks.append((tuple(q for q, _ in chunk), tensor.reshape((2,) * (2 * len(chunk)))))
+
+    return Layer(diagonal, flips, chunks)
+
+
+def apply_layer(state, qubit_count, layer):
+    """
+    Apply a Layer of single-qubit gates to the state vector in place.
+
+    Args:
+        state: The state vector, with one axis of size 2 per qubit
+        qubit_count: The number of qubits
+        layer: The Layer to apply
+    """
+    if len(layer.diagonal) > 0:
+        factor = np.ones((1,) * qubit_count, dtype=state.dtype)
+        for q, d0, d1 in layer.diagonal:
+            shape = [1] * qubit_count
+            shape[qubit_count - 1 - q] = 2
+            factor = factor * np.array([d0, d1], dtype=state.dtype).reshape(shape)
+        state *= factor
+
+    if len(layer.flips) > 0:
+        state[...] = np.flip(state, [qubit_count - 1 - q for q in layer.flips])
+
+    for qubits, tensor in layer.general:
+        k = len(qubits)
+        axes = [qubit_count - 1 - q for q in qubits]
+        result = np.tensordot(tensor, state, axes=(list(range(k, 2 * k)), axes))
+        state[...] = np.moveaxis(result, list(range(k)), axes)
+
+
+def kernel_qubits(kernel):
+    """
+    Find all qubits a kernel acts on.
+
+    Args:
+        kernel: A Layer or a Gate record
+
+    Returns: A set of qubit indices
+    """
+    if isinstance(kernel, Layer):
+        return {q for q, _, _ in kernel.diagonal} | set(kernel.flips) | {q for qubits, _ in kernel.general for q in qubits}
+    return set(kernel.qubits)
+
+
+def iter_chunks(state, qubit_count, fixed, busy, chunk_qubits=default_chunk_qubits):
+    """
+    Split the state vector into views of at most 2^chunk_qubits amplitudes, by also fixing the highest free qubits.
+    The chunks are generated in memory order, so a pass over all chunks walks through the state from start to end.
+
+    Args:
+        state: The state vector, with one axis of size 2 per qubit
+        qubit_count: The number of qubits
+        fixed: A dictionary of qubits with a fixed value (such as the clean qubits, which are always 0)
+        busy: The qubits that must not be fixed, because a kernel acts on them
+        chunk_qubits: The number of qubits that may be left free in a chunk
+
+    Returns: A generator of (chunk, fixed qubits) pairs, where chunk is a view (see select)
+    """
+    free = [q for q in reversed(range(qubit_count)) if q not in fixed and q not in busy]
+    outer = free[:max(qubit_count - len(fixed) - chunk_qubits, 0)]
+
+    for bits in itertools.product((0, 1), repeat=len(outer)):
+        chunk_fixed = dict(fixed)
+        chunk_fixed.update(zip(outer, bits))
+        yield select(state, qubit_count, chunk_fixed), chunk_fixed
+
+
+def apply_kernels(state, qubit_count, kernels, chunk_qubits=default_chunk_qubits):
+    """
+    Replay a list of compiled kernels on the state vector in place, one chunk at a time.
+    Each kernel only touches the part of the state in which its clean qubits are 0.
+
+    Args:
+        state: The state vector, with one axis of size 2 per qubit
+        qubit_count: The number of qubits
+        kernels: A list of (kernel, clean qubits) pairs (see compile_moments)
+        chunk_qubits: The number of qubits that may be left free in a chunk
+    """
+    for kernel, clean in kernels:
+        fixed = {q: 0 for q in clean}
+        for chunk, _ in iter_chunks(state, qubit_count, fixed, kernel_qubits(kernel), chunk_qubits):
+            if isinstance(kernel, Layer):
+                apply_layer(chunk, qubit_count, kernel)
+            else:
+                apply_gate(chunk, qubit_count, kernel)
+
+
+def allocate_state(qubit_count, dtype=np.complex128, path=None):
+    """
+    Allocate the state vector |0...0>.
+
+    Args:
+        qubit_count: The number of qubits
+        dtype: The NumPy data type of the amplitudes, complex64 halves the memory that is needed
+        path: A file to keep the state vector in (as a numpy.memmap), or None to keep it in memory
+              Parts of the state that are never written (because they belong to clean qubits) take no disk space.
+
+    Returns: The state vector, with one axis of size 2 per qubit
+    """
+    shape = (2,) * qubit_count
+    if path is None:
+        state = np.zeros(shape, dtype=dtype)
+    else:
+        state = np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+    state[(0,) * qubit_count] = 1
+    return state
+
+
+def run_circuit(state, circuit, chunk_qubits=default_chunk_qubits):
+    """
+    Apply a circuit to a state vector in place, starting from |0...0>.
+    Every subcircuit is compiled once (see compile_moments), and the kernels of subcircuits
+    such as .grover_loop(n) are replayed the given number of times.
+
+    Args:
+        state: The state vector |0...0> (see allocate_state)
+        circuit: The Circuit to simulate
+        chunk_qubits: The number of qubits that may be left free in a chunk
+
+    Returns: The set of qubits that are provably |0> at the end
+    """
+    clean = set(range(circuit.qubit_count))
+
+    for sub in circuit.subcircuits:
+        kernels, end_clean = compile_moments(sub.moments, clean, chunk_qubits)
+        # a repeated subcircuit starts where its last iteration ended, so only the qubits that are clean
+        # at both ends may be assumed to be clean at the start
+        while sub.iterations > 1 and not end_clean >= clean:
+            clean = clean & end_clean
+            kernels, end_clean = compile_moments(sub.moments, clean, chunk_qubits)
+
+        for _ in range(sub.iterations):
+            apply_kernels(state, circuit.qubit_count, kernels, chunk_qubits)
+        clean = end_clean
+
+    return clean
+
+
+def simulate_circuit(circuit, dtype=np.complex128, path=None, chunk_qubits=default_chunk_qubits):
+    """
+    Calculate the final state vector of a circuit, starting from |0...0> (see run_circuit).
+
+    Args:
+        circuit: The Circuit to simulate
+        dtype: The NumPy data type of the amplitudes
+        path: A file to keep the state vector in (as a numpy.memmap), or None to keep it in memory
+        chunk_qubits: The number of qubits that may be left free in a chunk
+
+    Returns: The state vector as a flat array, where bit q of an index is the value of qubit q
+    """
+    state = allocate_state(circuit.qubit_count, dtype, path)
+    run_circuit(state, circuit, chunk_qubits)
+    return state.reshape(-1)
+
+
+def sparse_probabilities(state, qubit_count, clean=(), chunk_qubits=default_chunk_qubits):
+    """
+    Find the outcomes with a non-zero probability, one chunk at a time, skipping the parts where clean qubits are 1.
+
+    Args:
+        state: The state vector, with one axis of size 2 per qubit
+        qubit_count: The number of qubits
+        clean: The qubits that are known to be |0>
+        chunk_qubits: The number of qubits that may be left free in a chunk
+
+    Returns: A tuple of NumPy arrays: the outcomes (where bit q is the value of qubit q) and their probabilities
+    """
+    all_indices, all_probabilities = [], []
+    for chunk, fixed in iter_chunks(state, qubit_count, {q: 0 for q in clean}, (), chunk_qubits):
+        probabilities = np.abs(chunk.reshape(-1)) ** 2
+        positions = np.flatnonzero(probabilities > probability_cutoff)
+
+        # turn the positions within the chunk back into outcomes of the whole state
+        coordinates = np.unravel_index(positions, chunk.shape)
+        indices = np.full(len(positions), sum(bit << q for q, bit in fixed.items()), dtype=np.int64)
+        for axis in range(qubit_count):
+            if chunk.shape[axis] == 2:
+                indices += coordinates[axis].astype(np.int64) << (qubit_count - 1 - axis)
+
+        all_indices.append(indices)
+        all_probabilities.append(probabilities[positions])
+
+    return np.concatenate(all_indices), np.concatenate(all_probabilities)
+
+
+def simulate_qasm(qasm, dtype=np.complex128, path=None):
+    """
+    Calculate the final state vector of a cQASM program (see simulate_circuit).
+
+    Args:
+        qasm: A valid cQASM program
+        dtype: The NumPy data type of the amplitudes
+        path: A file to keep the state vector in (as a numpy.memmap), or None to keep it in memory
+
+    Returns: The state vector as a flat array, where bit q of an index is the value of qubit q
+    """
+    return simulate_circuit(parse_qasm(qasm), dtype, path)
+
+
+def execute_qasm_locally(qasm, number_of_shots=1, sample=False, seed=None, dtype=np.complex128, path=None,
+                         chunk_qubits=default_chunk_qubits):
+    """
+    Run a cQASM program on the local simulator, and return the result in the same shape as qi.execute_qasm.
+
+    Args:
+        qasm: A valid cQASM program
+        number_of_shots: The number of shots, only used when sampling
+        sample: Whether to sample measurements, instead of returning the exact probabilities
+                (the exact probabilities are what the QI simulators return for programs without measurements)
+        seed: The seed for the random number generator used in sampling
+        dtype: The NumPy data type of the amplitudes, complex64 halves the memory that is needed
+        path: A file to keep the state vector in (as a numpy.memmap), or None to keep it in memory
+        chunk_qubits: The number of qubits that may be left free in a chunk
+
+    Returns: A dictionary with the following values:
+        - histogram: A dictionary that maps the (base 10) measurement outcome as a string to its probability
+        - execution_time_in_seconds: The time the simulation took
+        - number_of_shots: The number of shots
+    """
+    start = time.time()
+    circuit = parse_qasm(qasm)
+    state = allocate_state(circuit.qubit_count, dtype, path)
+    clean = run_circuit(state, circuit, chunk_qubits)
+    indices, probabilities = sparse_probabilities(state, circuit.qubit_count, clean, chunk_qubits)
+    return probabilities_to_result(indices, probabilities, start, number_of_shots, sample, seed)
+
+
+def probabilities_to_result(indices, probabilities, start, number_of_shots=1, sample=False, seed=None):
+    """
+    Turn the probabilities of the possible outcomes into a result dictionary in the same shape as qi.execute_qasm.
+
+    Args:
+        indices: A NumPy array of outcomes
+        probabilities: A NumPy array with the probability of every outcome
+        start: The time at which the simulation started
+        number_of_shots: The number of shots, only used when sampling
+        sample: Whether to sample measurements, instead of returning the exact probabilities
+        seed: The seed for the random number generator used in sampling
+
+    Returns: A result dictionary (see execute_qasm_locally)
+    """
+    if sample:
+        rng = np.random.default_rng(seed)
+        probabilities = rng.multinomial(number_of_shots, probabilities / probabilities.sum()) / number_of_shots
+
+    # zero-valued bars don't show up in the histogram, just like in the QI API
+    histogram = {str(i): float(p) for i, p in zip(indices, probabilities) if p > probability_cutoff}
+
+    return {
+        "histogram": histogram,
+        "execution_time_in_seconds": time.time() - start,
+        "number_of_shots": number_of_shots
+    }
+
+
+def simulate_search(search_targets, iterations=None, dtype=np.float64):
+    """
+    Calculate the final state vector of a Grover search straight from the targets, without any gates.
+    The oracle only flips the sign of the targets and the diffusion reflects every amplitude in the mean,
+    so each iteration is two vectorized passes over the state instead of one per gate.
+    The ancillary qubits of the generated circuits always return to 0, so they are left out,
+    and all amplitudes stay real, so a real data type is enough.
+
+    Args:
+        search_targets: A list of bit strings to search for (as in generate_search_qasm)
+        iterations: The number of Grover iterations, or None to use the number generate_search_qasm picks
+        dtype: The NumPy data type of the amplitudes
+
+    Returns: The state vector of the data qubits, where bit q of an index is the value of qubit q
+    """
+    data_qubits = len(search_targets[0])
+    if iterations is None:
+        iterations = int(grover_iterations(data_qubits, len(search_targets)))
+
+    # the oracle of a target that is listed twice flips its sign twice
+    targets, counts = np.unique(SearchScorer(search_targets).target_indices, return_counts=True)
+    flipped = targets[counts % 2 == 1]
+
+    size = 2 ** data_qubits
+    state = np.full(size, 1 / math.sqrt(size), dtype=dtype)
+    for _ in range(iterations):
+        state[flipped] *= -1
+        # H X (multi-controlled Z) X H flips the sign of the uniform superposition
+        state -= 2 * state.mean()
+
+    return state
+
+
+def execute_search_locally(search_targets, iterations=None, number_of_shots=1, sample=False, seed=None):
+    """
+    Run a Grover search with the phase-oracle shortcut (see simulate_search),
+    and return the result in the same shape as qi.execute_qasm.
+    The outcomes have the same indices as for the generated cQASM, since the ancillary qubits are 0.
+
+    Args:
+        search_targets: A list of bit strings to search for (as in generate_search_qasm)
+        iterations: The number of Grover iterations, or None to use the number generate_search_qasm picks
+        number_of_shots: The number of shots, only used when sampling
+        sample: Whether to sample measurements, instead of returning the exact probabilities
+        seed: The seed for the random number generator used in sampling
+
+    Returns: A result dictionary (see execute_qasm_locally)
+    """
+    start = time.time()
+    probabilities = simulate_search(search_targets, iterations) ** 2
+    indices = np.flatnonzero(probabilities > probability_cutoff)
+    return probabilities_to_result(indices, probabilities[indices], start, number_of_shots, sample, seed)
+
@@ -9,8 +9,8 @@ qi = QuantumInspireAPI()
 backend = qi.get_backend_type_by_name('QX single-node simulator')
 shot_count = 500
 
-cnot_modes = ["normal", "no toffoli", "crot", "fancy cnot"]
-sat_modes = ["reuse gates", "reuse qubits"]
+cnot_modes = ["normal", "no toffoli", "crot", "fancy cnot", "poly crot", "log depth", "borrowed"]
+sat_modes = ["reuse gates", "reuse qubits", "pebbling", "cnf"]
 
 # test multi element search for all modes
 search_targets = [
@@ -0,0 +1,360 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import boolean
+import numpy as np
+from src.grover.run import *
+from src.backends.backends import Backend, LocalBackend, execute_on
+from src.backends.batch import execute_batch, execute_batch_in_order
+from src.backends.cache import ResultCache
+from src.grover.analytic import grover_iterations, success_probability
+from src.grover.expression_dag import ExpressionDAG
+from src.simulator.statevector import execute_qasm_locally, allocate_state, apply_gate, run_circuit, \
+    ignored_instructions, simulate_search, execute_search_locally
+
+# the same smoke test as basic_tests.py, but on the local simulator so no login or network is needed
+# results are never taken from the result cache, so every run really simulates the circuits
+
+qi = LocalBackend()
+backend = None
+shot_count = 500
+
+cnot_modes = ["normal", "no toffoli", "crot", "fancy cnot", "poly crot", "log depth", "borrowed"]
+sat_modes = ["reuse gates", "reuse qubits", "pebbling", "cnf"]
+
+# test multi element search for all modes
+search_targets = [
+    "000100"[::-1],
+    "100111"[::-1],
+]
+
+for cnot_mode in cnot_modes:
+    qasm, _, qubit_count, data_qubits = generate_search_qasm(search_targets, cnot_mode)
+    _, target_probs, non_target_prob, _ = execute_search_qasm(search_targets, qi, qasm, shot_count, backend, qubit_count, data_qubits, plot=False, cache=None)
+
+    assert non_target_prob < 0.1, "Probability of missing target >0.1 for basic multi element search! (mode {})".format(cnot_mode)
+    assert sum(target_probs) + non_target_prob > 0.999, "Total probability not 1, incorrent QASM produced? (mode {})".format(cnot_mode)
+
+
+# test sat solver for all cnot modes and sat modes
+boolean_expr = "(a and b and c and d) or (a and b and not(c) and not(d))"
+solutions = {"1111", "1100"}
+
+for cnot_mode in cnot_modes:
+    for sat_mode in sat_modes:
+        qasm, _, qubit_count, data_qubits = generate_sat_qasm(boolean_expr, cnot_mode, sat_mode=sat_mode)
+        suggested_solutions = execute_sat_qasm(qi, qasm, shot_count, backend, qubit_count, data_qubits, plot=False, cache=None)[1]
+
+        assert set(suggested_solutions) == solutions, "Invalid solution set " \
+                                                      "(cnot mode '{}', sat mode '{}')".format(cnot_mode, sat_mode)
+
+
+class FakeBackend(Backend):
+    """
+    Backend that runs nothing: the result of a program is the program itself.
+    Every program fails the first few times it is executed, and can be made to take a while.
+    """
+
+    name = "fake"
+
+    def __init__(self, failures=0, delays=None):
+        """
+        Args:
+            failures: How many times every program fails before it succeeds
+            delays: A dictionary from programs to the number of seconds they take
+        """
+        self.failures = failures
+        self.delays = delays or {}
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def submit(self, qasm, shot_count):
+        with self.lock:
+            self.calls.append((qasm, time.monotonic()))
+            attempt = sum(1 for called_qasm, _ in self.calls if called_qasm == qasm)
+        return qasm, shot_count, attempt
+
+    def result(self, job):
+        qasm, shot_count, attempt = job
+        time.sleep(self.delays.get(qasm, 0))
+        if attempt <= self.failures:
+            raise RuntimeError("Attempt {} of {} failed".format(attempt, qasm))
+        return {"histogram": {"0": 1.0}, "execution_time_in_seconds": 0, "qasm": qasm, "shot_count": shot_count}
+
+    def capabilities(self):
+        return {"max_qubits": None, "native_gates": None}
+
+
+# test that a backend without capabilities cannot be created
+class IncompleteBackend(Backend):
+    def submit(self, qasm, shot_count):
+        return qasm
+
+    def result(self, job):
+        return {"histogram": {}, "execution_time_in_seconds": 0}
+
+
+try:
+    IncompleteBackend()
+    assert False, "A backend should implement submit, result and capabilities"
+except TypeError:
+    pass
+
+# test that failed batch jobs are retried, with a delay that doubles every time
+fake = FakeBackend(failures=2)
+batch_results = list(execute_batch([("a", 1, fake)], retries=2, retry_delay=0.05))
+times = [called_time for _, called_time in fake.calls]
+assert len(batch_results) == 1 and batch_results[0].error is None and batch_results[0].attempts == 3, \
+    "Job should succeed on its third attempt: {}".format(batch_results)
+assert times[1] - times[0] >= 0.05 and times[2] - times[1] >= 0.1, "Retries should back off: {}".format(times)
+
+fake = FakeBackend(failures=3)
+batch_results = list(execute_batch([("a", 1, fake)], retries=2, retry_delay=0.01))
+assert batch_results[0].result is None and isinstance(batch_results[0].error, RuntimeError) and \
+    batch_results[0].attempts == 3, "Job should give up after 2 retries: {}".format(batch_results)
+try:
+    execute_batch_in_order([("a", 1, FakeBackend(failures=3))], retries=2, retry_delay=0.01)
+    assert False, "execute_batch_in_order should raise the error of a failed job"
+except RuntimeError:
+    pass
+
+# test that a failed job does not wait for the rest of the batch, and leaves the jobs that did not start unexecuted
+fake = FakeBackend(failures=1, delays={"b": 0.5, "c": 0.5, "d": 0.5})
+start_time = time.monotonic()
+try:
+    execute_batch_in_order([("a", 1, fake), ("b", 1, fake), ("c", 1, fake), ("d", 1, fake)], max_workers=2, retries=0)
+    assert False, "execute_batch_in_order should raise the error of a failed job"
+except RuntimeError:
+    pass
+assert time.monotonic() - start_time < 0.4, "Failed batch should not wait for the running jobs"
+time.sleep(0.6)
+assert sorted(qasm for qasm, _ in fake.calls) == ["a", "b"], "Pending jobs should not run: {}".format(fake.calls)
+
+# test that a retry waiting for its delay does not keep a worker from the other jobs
+fake = FakeBackend(failures=1, delays={"b": 0.1})
+start_time = time.monotonic()
+list(execute_batch([("a", 1, fake), ("b", 1, fake)], max_workers=1, retries=1, retry_delay=0.3))
+b_times = [called_time for qasm, called_time in fake.calls if qasm == "b"]
+# "b" fails at 0.1s and may be retried at 0.4s, but a sleeping retry of "a" would hold the only worker until 0.6s
+assert b_times[1] - start_time < 0.55, "Retry should start when its delay is over: {}".format(b_times[1] - start_time)
+
+# test that batch results come back as the jobs finish, but in job order from execute_batch_in_order
+fake = FakeBackend(delays={"a": 0.3, "b": 0.15, "c": 0})
+jobs = [("a", 1, fake), ("b", 2, fake), ("c", 3, fake)]
+finished = [batch_result.index for batch_result in execute_batch(jobs, max_workers=3)]
+assert finished == [2, 1, 0], "Jobs should be yielded as they finish: {}".format(finished)
+results = execute_batch_in_order(jobs, max_workers=3)
+assert [(result["qasm"], result["shot_count"]) for result in results] == [("a", 1), ("b", 2), ("c", 3)], \
+    "Results should be in job order: {}".format(results)
+
+def same_histogram(histogram_1, histogram_2, tolerance=1e-5):
+    """
+    Check whether two histograms give the same probabilities (up to the precision of complex64).
+    """
+    outcomes = set(histogram_1) | set(histogram_2)
+    return all(abs(histogram_1.get(outcome, 0) - histogram_2.get(outcome, 0)) < tolerance for outcome in outcomes)
+
+
+def simulate_gate_by_gate(qasm):
+    """
+    Reference simulation that applies every gate to the whole state, without fusing, chunking or skipping clean qubits.
+    """
+    circuit = parse_qasm(qasm)
+    state = allocate_state(circuit.qubit_count)
+    for sub in circuit.subcircuits:
+        for _ in range(sub.iterations):
+            for moment in sub.moments:
+                for g in moment:
+                    if g.name not in ignored_instructions:
+                        apply_gate(state, circuit.qubit_count, g)
+    probabilities = np.abs(state.reshape(-1)) ** 2
+    return {str(i): p for i, p in enumerate(probabilities) if p > 1e-12}
+
+
+def unitary(moments, qubit_count):
+    """
+    Calculate the matrix of a list of moments, where bit q of a row or column index is the value of qubit q.
+    """
+    columns = []
+    for index in range(2 ** qubit_count):
+        state = np.zeros((2,) * qubit_count, dtype=np.complex128)
+        state.reshape(-1)[index] = 1
+        for moment in moments:
+            for g in moment:
+                apply_gate(state, qubit_count, g)
+        columns.append(state.reshape(-1).copy())
+    return np.array(columns).T
+
+
+# test that a Margolus gate is a Toffoli gate up to a diagonal phase, and that it is exactly undone by its inverse
+toffoli = unitary([(Gate("Toffoli", (0, 1, 2)),)], 3)
+for controls in [(0, 1), (1, 0)]:
+    margolus = unitary(margolus_toffoli(*controls, 2), 3)
+    phases = margolus @ toffoli.conj().T
+    assert np.allclose(phases, np.diag(np.diag(phases))) and np.allclose(np.abs(np.diag(phases)), 1), \
+        "Margolus gate should be a Toffoli gate up to a diagonal phase"
+    assert np.allclose(unitary(margolus_toffoli(*controls, 2) + margolus_toffoli(*controls, 2, inverse=True), 3),
+                       np.eye(8)), "Margolus gate followed by its inverse should be the identity"
+
+# test that the default "no toffoli" lowering is never deeper than either fixed choice, and still finds the targets
+for targets in [["0110", "1011"], ["000100"[::-1], "100111"[::-1]]]:
+    depths = [generate_search_qasm(targets, "no toffoli", relative_phase=relative_phase)[1]
+              for relative_phase in [False, True, None]]
+    assert depths[2] == min(depths), "Default Toffoli lowering should not be deeper: {}".format(depths)
+    qasm, _, qubit_count, data_qubits = generate_search_qasm(targets, "no toffoli", relative_phase=True)
+    _, target_probs, non_target_prob, _ = execute_search_qasm(targets, qi, qasm, shot_count, backend, qubit_count,
+                                                              data_qubits, plot=False, cache=None)
+    assert non_target_prob < 0.1, "Search with Margolus gates should find its targets"
+
+# test that the analytic outcome matches a gate-level simulation, also for several targets and past the optimum
+for targets, iterations in [(["101"], 0), (["101"], None), (["101"], 5), (["0110", "1011"], None),
+                            (["0110", "1011"], 4), (["01101", "11000", "00111"], None), (["01101", "11000", "00111"], 7)]:
+    circuit, data_qubits = build_search_circuit(targets, "normal")
+    assert circuit.subcircuits[1].iterations == grover_iterations(data_qubits, len(targets)), \
+        "grover_iterations should give the number of iterations of the generated circuit"
+    if iterations is not None:
+        circuit = circuit._replace(subcircuits=[circuit.subcircuits[0],
+                                                circuit.subcircuits[1]._replace(iterations=iterations)])
+    histogram = execute_qasm_locally(render_qasm(circuit))["histogram"]
+    simulated_probs = [histogram.get(str(int(t[::-1], 2)), 0) for t in targets]
+    target_prob, non_target_prob = success_probability(data_qubits, len(targets), iterations)
+    assert np.allclose(simulated_probs, target_prob) and np.isclose(1 - sum(simulated_probs), non_target_prob), \
+        "Analytic outcome {} differs from simulation {} for {} after {} iterations".format(
+            target_prob, simulated_probs, targets, iterations)
+
+# test that the phase-oracle shortcut gives the same outcome as simulating the generated circuit gate by gate
+for targets in [["0110"], ["0110", "1011"], ["10110", "00001", "11111"], ["011", "011", "110"]]:
+    shortcut = execute_search_locally(targets)["histogram"]
+    assert same_histogram(shortcut, {str(i): p for i, p in enumerate(simulate_search(targets) ** 2) if p > 1e-12}), \
+        "execute_search_locally should give the probabilities of simulate_search"
+    for mode in ["normal", "no toffoli", "crot", "poly crot", "fancy cnot", "borrowed", "log depth"]:
+        qasm, _, _, _ = generate_search_qasm(targets, mode)
+        assert same_histogram(shortcut, execute_qasm_locally(qasm)["histogram"]), \
+            "Phase-oracle shortcut disagrees with the {} circuit for {}".format(mode, targets)
+
+# test that the "cnf" oracle replaces the CNOT modes as documented in generate_sat_qasm
+expr_string = "(a or not(b) or c) and (not(a) or b or d) and (b or not(c) or not(d))"
+for cnot_mode in cnot_modes:
+    oracle_qasm, qubit_count, data_qubits = generate_sat_oracle(expr_string, "cnf", cnot_mode=cnot_mode)
+    gate_names = {g.name for moment in oracle_qasm for g in moment}
+    assert "CR" not in gate_names, "The cnf oracle should not use controlled rotations (mode {})".format(cnot_mode)
+    oracle_mode = "log depth" if cnot_mode in ["normal", "no toffoli", "log depth"] else "borrowed"
+    assert oracle_qasm == generate_sat_oracle(expr_string, "cnf", cnot_mode=oracle_mode)[0], \
+        "The cnf oracle in mode {} should be the one of mode {}".format(cnot_mode, oracle_mode)
+
+# test that the polynomial templates are cached, but the exponential fancy cnot template is not
+assert normal_n_size_cnot(5, "normal") is normal_n_size_cnot(5, "normal"), "Normal CNOT templates should be cached"
+assert poly_n_size_crot(5, math.pi) is poly_n_size_crot(5, math.pi), "Poly crot templates should be cached"
+assert fancy_cnot(5) is not fancy_cnot(5) and fancy_cnot(5) == tuple(iter_fancy_cnot(5)), \
+    "Fancy CNOT templates should be built again every time"
+
+# test that the chunked and memory-mapped simulation (for programs that do not fit in memory) gives the same results
+qasm, _, _, _ = generate_search_qasm(search_targets, "normal")
+expected = execute_qasm_locally(qasm)["histogram"]
+assert same_histogram(expected, simulate_gate_by_gate(qasm)), "Local simulator disagrees with the gate by gate reference"
+assert same_histogram(expected, execute_qasm_locally(qasm, chunk_qubits=3)["histogram"]), \
+    "Chunked simulation gives another histogram"
+state_directory = tempfile.mkdtemp()
+state_path = os.path.join(state_directory, "state")
+assert same_histogram(expected, execute_qasm_locally(qasm, dtype=np.complex64, path=state_path,
+                                                     chunk_qubits=3)["histogram"]), \
+    "Memory-mapped complex64 simulation gives another histogram"
+shutil.rmtree(state_directory)
+
+# q[2] and q[3] are |0> when the loop starts the first time, but not after an iteration, so they are no longer clean
+qasm = """version 1.0
+qubits 6
+H q[0:1]
+.loop(3)
+Toffoli q[0],q[1],q[2]
+X q[3]
+CNOT q[2],q[3]
+Toffoli q[0],q[3],q[4]
+Toffoli q[0],q[3],q[4]
+H q[0]
+CNOT q[1],q[5]
+"""
+assert run_circuit(allocate_state(6), parse_qasm(qasm), 2) == {4}, "Only q[4] should be clean at the end"
+expected = simulate_gate_by_gate(qasm)
+assert same_histogram(expected, execute_qasm_locally(qasm)["histogram"], 1e-12), \
+    "Simulation with dropped clean qubits gives another histogram"
+assert same_histogram(expected, execute_qasm_locally(qasm, chunk_qubits=2)["histogram"], 1e-12), \
+    "Chunked simulation with dropped clean qubits gives another histogram"
+
+# test that commuted and regrouped sub-terms share one node, and so one ancillary qubit
+algebra = boolean.BooleanAlgebra()
+dag = ExpressionDAG()
+assert dag.add(algebra.parse("(a and b) or c")) == dag.add(algebra.parse("c or (b and a)")), \
+    "Commuted sub-terms should be the same node"
+expr = algebra.parse("((a and b) or c) and (d or c or (b and a))")
+oracle_qasm, target_qubit, highest_qubit_used = generate_sat_oracle_reuse_gates(expr, sorted(expr.symbols, reverse=True))
+# one ancillary qubit for "a and b", one for the OR with c, and one for the OR with d
+assert highest_qubit_used - target_qubit == 3, "Shared sub-terms should use one ancillary qubit each, not {}".format(
+    highest_qubit_used - target_qubit)
+expr = algebra.parse("(a or not(c) or not(d) or e) and (b or d or e or not(f)) and (not(b) or c or e or not(f))")
+oracle_qasm, target_qubit, highest_qubit_used = generate_sat_oracle_reuse_gates(expr, sorted(expr.symbols, reverse=True))
+# three ORs per clause and one AND, minus the "e or not(f)" that the last two clauses share
+assert highest_qubit_used - target_qubit == 9, "Clauses should share a common pair of literals"
+
+# test that pebbling oracles stay within their ancilla budget, and still find the solutions
+clause_expr = "(a or not(b) or c) and (not(a) or b or d) and (b or not(c) or not(d)) and (a or c or d)"
+_, _, data_qubits = generate_sat_oracle(clause_expr, "reuse gates")
+for max_ancillas in range(5, 12):
+    oracle_qasm, oracle_qubits, _ = generate_sat_oracle(clause_expr, "pebbling", max_ancillas)
+    assert oracle_qubits <= data_qubits + max_ancillas, "Pebbling oracle uses {} qubits, budget is {} ancillas".format(
+        oracle_qubits, max_ancillas)
+    assert max(q for moment in oracle_qasm for g in moment for q in g.qubits) < oracle_qubits, \
+        "Pebbling oracle uses more qubits than it reports"
+
+try:
+    generate_sat_oracle(clause_expr, "pebbling", 4)
+    assert False, "Pebbling oracle should not accept a budget below its minimum"
+except ValueError:
+    pass
+
+qasm, _, qubit_count, data_qubits = generate_sat_qasm(boolean_expr, "log depth", "pebbling", max_ancillas=4)
+suggested_solutions = execute_sat_qasm(qi, qasm, shot_count, backend, qubit_count, data_qubits, plot=False, cache=None)[1]
+assert qubit_count <= data_qubits + 4, "Pebbling search uses {} qubits, budget is 4 ancillas".format(qubit_count)
+assert set(suggested_solutions) == solutions, "Invalid solution set (pebbling with the smallest budget)"
+
+# test that the result cache only executes a program once, and never mixes up backends
+cache_directory = tempfile.mkdtemp()
+cache = ResultCache(cache_directory)
+fake = FakeBackend()
+execute_on(fake, "a", 1, cache=cache)
+execute_on(fake, "a", 1, cache=cache)
+assert len(fake.calls) == 1 and (cache.hits, cache.misses) == (1, 1), "Second run should come from the cache"
+execute_on(fake, "a", 2, cache=cache)
+assert len(fake.calls) == 2, "Another shot count should not come from the cache"
+assert len({LocalBackend().name, LocalBackend(sample=True, seed=1).name, LocalBackend(sample=True, seed=2).name,
+            LocalBackend(dtype=np.complex64).name}) == 4, "Simulators with different results should not share a name"
+
+# test that the least recently used results are evicted when the cache is too large
+cache.clear()
+cache.put("a", 1, "fake", {"histogram": {"0": 1.0}})
+file_size = os.path.getsize(cache.path(cache.key("a", 1, "fake")))
+cache.max_size = 2 * file_size
+cache.put("b", 1, "fake", {"histogram": {"1": 1.0}})
+# file times are not always precise enough to tell two writes apart, so "b" is made the oldest explicitly
+os.utime(cache.path(cache.key("a", 1, "fake")), (1000, 1000))
+os.utime(cache.path(cache.key("b", 1, "fake")), (2000, 2000))
+assert cache.get("a", 1, "fake") is not None, "Result should still be cached"
+cache.put("c", 1, "fake", {"histogram": {"2": 1.0}})
+assert cache.get("b", 1, "fake") is None, "Least recently used result should be evicted"
+assert cache.get("a", 1, "fake") is not None and cache.get("c", 1, "fake") is not None, \
+    "Recently used results should stay cached"
+
+# test that a disabled cache executes every program and stores nothing
+shutil.rmtree(cache_directory)
+cache_directory = tempfile.mkdtemp()
+cache = ResultCache(cache_directory, enabled=False)
+fake = FakeBackend()
+execute_on(fake, "a", 1, cache=cache)
+execute_on(fake, "a", 1, cache=cache)
+assert len(fake.calls) == 2 and cache.hits == 0, "Disabled cache should execute every program"
+assert os.listdir(cache_directory) == [], "Disabled cache should not store results"
+shutil.rmtree(cache_directory)
+
+print("\n\nAll tests passed!")